@@ -0,0 +1,9 @@
+"""
+Asynchronous Server Gateway Interface (ASGI) entry point
+
+    gunicorn --worker-class uvicorn.workers.UvicornWorker --workers 2 asgi:app
+    uvicorn asgi:app --port 8000 --reload
+"""
+from service.asgi import create_asgi_app
+
+app = create_asgi_app()
@@ -0,0 +1,118 @@
+"""
+Concurrent Connection Benchmark
+
+Compares the throughput and latency of the servers as the number of
+concurrent client connections grows. The servers are gunicorn with sync
+workers (wsgi.py), gunicorn with threaded workers, and uvicorn running the
+ASGI app (asgi.py). Each one runs the same number of workers, pinned to the
+same --cpus CPUs, and receives the same mix of reads by id, reads by code
+and updates.
+
+Usage:
+    python -m benchmarks.bench_concurrency --connections 1 16 64 --cpus 1 --workers 2
+    python -m benchmarks.bench_concurrency --output concurrency.json
+
+Set DATABASE_URI to benchmark against PostgreSQL, which is where waiting on
+the database, and so the async engine, matters. Otherwise a scratch SQLite
+database is used. Run it on a machine with more CPUs than --cpus, since the
+client runs on the CPUs left over.
+"""
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+import platform
+from datetime import datetime, timezone
+
+from benchmarks.bench_service import (
+    Gunicorn, Uvicorn, app, db, measure, new_promotion, pinned, seed
+)
+
+# Share of the requests that read by id, read by code and update
+MIX = (("read", 6), ("read_by_code", 3), ("update", 1))
+
+
+def workload(rows, count):
+    """Returns count requests in the proportions of MIX, shuffled"""
+    requests = []
+    total = sum(weight for _, weight in MIX)
+    for name, weight in MIX:
+        for _ in range(count * weight // total):
+            promo_id, code = random.choice(rows)
+            if name == "read":
+                requests.append(("GET", f"/promotions/{promo_id}", None))
+            elif name == "read_by_code":
+                requests.append(("GET", f"/promotions/code/{code}", None))
+            else:
+                requests.append(("PUT", f"/promotions/{promo_id}", new_promotion(code)))
+    random.shuffle(requests)
+    return requests
+
+
+def servers(args):
+    """Returns (label, function that starts the server) for each server"""
+    return [
+        ("gunicorn sync", lambda: Gunicorn(args.workers, 1, args.cpus)),
+        (f"gunicorn {args.threads} threads", lambda: Gunicorn(args.workers, args.threads, args.cpus)),
+        ("uvicorn asgi", lambda: Uvicorn(args.workers, 0, args.cpus)),
+    ]
+
+
+def main(argv=None):
+    """Runs every server at every number of connections and prints a table"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, default=1000, help="promotions to seed")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per run")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 16, 64], help="concurrent connections")
+    parser.add_argument("--workers", type=int, default=2, help="workers of every server")
+    parser.add_argument("--threads", type=int, default=8, help="threads per threaded gunicorn worker")
+    parser.add_argument("--cpus", type=int, default=1, help="CPUs every server may use")
+    parser.add_argument("--warmup", type=int, default=50, help="untimed GETs before each run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    random.seed(0)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+    with app.app_context():
+        print(f"database: {db.engine.url.render_as_string(hide_password=True)}")
+        database = db.engine.dialect.name
+        rows = seed(args.rows)
+        print()
+    # keep the client off the servers' CPUs when there are others
+    rest = set(os.sched_getaffinity(0)) - set(pinned(args.cpus))
+    if rest:
+        os.sched_setaffinity(0, rest)
+
+    results = {}
+    print(f"{'server':>20} {'connections':>11} {'req/sec':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>6}")
+    for label, start in servers(args):
+        target = start()
+        try:
+            for connections in args.connections:
+                result = measure(target, workload(rows, args.requests), connections, args.warmup)
+                results.setdefault(label, {})[str(connections)] = result
+                print(f"{label:>20} {connections:>11} {result['rps']:>10.1f} {result['p50_ms']:>9.2f} "
+                      f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['errors']:>6}")
+        finally:
+            target.close()
+
+    if args.output:
+        meta = {
+            "database": database,
+            "workers": args.workers,
+            "cpus": args.cpus,
+            "rows": args.rows,
+            "python": platform.python_version(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"meta": meta, "servers": results}, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+Redemption Throughput Benchmark
+
+Measures redemptions/sec against a single hot promotion code, first with
+every redemption going to the database and then with per-worker leases.
+
+Usage:
+    python -m benchmarks.bench_redeem --threads 8 --redemptions 4000 --lease-size 100
+
+Set DATABASE_URI to benchmark against PostgreSQL, otherwise a scratch SQLite
+database is used. Only the benchmark's own promotion is touched.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DATABASE_URI", "sqlite:////tmp/promotions-bench.db")
+
+# pylint: disable=wrong-import-position
+from wsgi import app  # noqa: E402
+from service.models import Promotions, Type, db  # noqa: E402
+from service.common.leases import leases  # noqa: E402
+
+CODE = "BENCH-REDEEM"
+
+
+def seed(quantity):
+    """Creates (or resets) the hot promotion and returns its id"""
+    promotion = Promotions.find_by_code(CODE)
+    if promotion:
+        promotion.delete()
+    promotion = Promotions(
+        cust_promo_code=CODE,
+        type=Type.PERCENT,
+        value=10,
+        quantity=quantity,
+        start_date=date.today(),
+        end_date=date.today(),
+        active=True,
+        product_id=1,
+        dev_created_at=date.today(),
+    )
+    promotion.create()
+    return promotion.promo_id
+
+
+def run(threads, redemptions, lease_size):
+    """Returns (redemptions/sec, successful redemptions) for one mode"""
+    promo_id = seed(redemptions)
+    leases.size = lease_size
+    client = app.test_client()
+
+    def worker(count):
+        ok = 0
+        for _ in range(count):
+            if client.post(f"/promotions/code/{CODE}/redeem").status_code == 200:
+                ok += 1
+        return ok
+
+    per_thread = redemptions // threads
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        redeemed = sum(pool.map(worker, [per_thread] * threads))
+    elapsed = time.perf_counter() - start
+    leases.release_all()
+    db.session.expire_all()
+    left = Promotions.find(promo_id).quantity
+    assert left == redemptions - redeemed, "quantity does not add up"
+    return redeemed / elapsed, redeemed
+
+
+def main(argv=None):
+    """Runs the benchmark with and without leases and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--redemptions", type=int, default=4000)
+    parser.add_argument("--lease-size", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+    with app.app_context():
+        db.create_all()
+        print(f"database: {db.engine.url.render_as_string(hide_password=True)}")
+        for label, size in (("direct", 0), (f"leased x{args.lease_size}", args.lease_size)):
+            rate, redeemed = run(args.threads, args.redemptions, size)
+            print(f"{label:>16}: {rate:10.1f} redemptions/sec ({redeemed} redeemed)")
+        Promotions.find_by_code(CODE).delete()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Listing Serialization Benchmark
+
+Measures rows/sec for serializing a listing, first by loading Promotions
+objects and dumping serialize() as jsonify() does, and then by encoding
+plain row tuples with the row serializer. Both must produce the same bytes.
+
+Usage:
+    python -m benchmarks.bench_serialize --rows 20000 --repeat 5
+
+Set DATABASE_URI to benchmark against PostgreSQL, otherwise a scratch SQLite
+database is used. Only the benchmark's own promotions are touched.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from datetime import date, timedelta
+
+os.environ.setdefault("DATABASE_URI", "sqlite:////tmp/promotions-bench.db")
+
+# pylint: disable=wrong-import-position
+from wsgi import app  # noqa: E402
+from service.models import Promotions, Type, db  # noqa: E402
+from service.common.serializer import select_rows, encode_rows  # noqa: E402
+
+PREFIX = "BENCH-SERIALIZE-"
+
+
+def benchmark_query():
+    """Returns a query for just the benchmark's promotions"""
+    return Promotions.query.filter(Promotions.cust_promo_code.startswith(PREFIX))
+
+
+def seed(count):
+    """Creates count promotions for the benchmark, replacing any old ones"""
+    Promotions.delete_where(benchmark_query())
+    today = date.today()
+    promotions = [
+        Promotions(
+            cust_promo_code=f"{PREFIX}{number}",
+            type=list(Type)[number % len(Type)],
+            value=None if number % 7 == 0 else number % 100,
+            quantity=number,
+            start_date=today,
+            end_date=today + timedelta(days=number % 30),
+            active=number % 2 == 0,
+            product_id=number % 500,
+            dev_created_at=today,
+        )
+        for number in range(count)
+    ]
+    Promotions.create_many(promotions, batch_size=1000)
+
+
+def with_orm():
+    """Serializes the listing the way GET /promotions used to"""
+    promotions = benchmark_query().order_by(Promotions.promo_id).all()
+    return app.json.dumps([promotion.serialize() for promotion in promotions], separators=(",", ":")).encode()
+
+
+def with_rows():
+    """Serializes the listing from row tuples"""
+    return encode_rows(select_rows(benchmark_query()).order_by(Promotions.promo_id).all())
+
+
+def run(serialize, count, repeat):
+    """Returns the best rows/sec of repeat runs, and the bytes of the last"""
+    best = 0.0
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        body = serialize()
+        best = max(best, count / (time.perf_counter() - start))
+    return best, body
+
+
+def main(argv=None):
+    """Seeds the promotions, runs both serializers and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+    with app.app_context():
+        db.create_all()
+        print(f"database: {db.engine.url.render_as_string(hide_password=True)}")
+        seed(args.rows)
+        before, expected = run(with_orm, args.rows, args.repeat)
+        after, body = run(with_rows, args.rows, args.repeat)
+        assert body == expected, "the row serializer does not match serialize()"
+        print(f"{'orm + serialize':>16}: {before:10.1f} rows/sec")
+        print(f"{'rows + template':>16}: {after:10.1f} rows/sec ({after / before:.1f}x)")
+        Promotions.delete_where(benchmark_query())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
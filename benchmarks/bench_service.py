@@ -0,0 +1,409 @@
+"""
+Service Benchmark Suite
+
+Seeds the promotions made by PromotionsFactory and measures requests/sec
+and p50/p95/p99 latency of each route. It also times serialize() and
+deserialize() on their own. The requests go through the Flask test client
+in this process (--target inprocess), or over HTTP to a gunicorn it
+launches, running wsgi.py (--target gunicorn) or the ASGI app with uvicorn
+workers (--target uvicorn). The results can be written as JSON and compared
+against a stored baseline. The run fails when a route or micro-benchmark is
+slower than the baseline by more than --tolerance.
+
+Usage:
+    python -m benchmarks.bench_service --rows 1000 10000 --requests 500
+    python -m benchmarks.bench_service --target gunicorn --workers 4 --concurrency 8
+    python -m benchmarks.bench_service --output results.json --baseline benchmarks/baseline.json
+    python -m benchmarks.bench_service --save-baseline
+
+Set DATABASE_URI to benchmark against PostgreSQL, otherwise a scratch SQLite
+database is used. Only the benchmark's own promotions are touched. The
+sizes run from smallest to largest, and each one tops up the rows of the
+last, so --rows 1000 1000000 seeds a million rows once.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import http.client
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DATABASE_URI", "sqlite:////tmp/promotions-bench.db")
+
+# pylint: disable=wrong-import-position
+from wsgi import app  # noqa: E402
+from sqlalchemy import func  # noqa: E402
+from service.models import Promotions, db  # noqa: E402
+from tests.factories import PromotionsFactory  # noqa: E402
+
+PREFIX = "BENCH-SERVICE-"
+CREATED = "BENCH-NEW-"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# The metrics compared with the baseline, and whether bigger is better
+COMPARED = {"rps": True, "p95_ms": False, "ops_per_sec": True, "p95_us": False}
+
+
+######################################################################
+# Data
+######################################################################
+def benchmark_query():
+    """Returns a query for just the benchmark's seeded promotions"""
+    return Promotions.query.filter(Promotions.cust_promo_code.startswith(PREFIX))
+
+
+def seed(count, batch_size=5000):
+    """Tops up the benchmark's promotions to count rows, returning their ids"""
+    Promotions.delete_where(Promotions.query.filter(Promotions.cust_promo_code.startswith(CREATED)))
+    existing = benchmark_query().count()
+    last = db.session.query(func.max(Promotions.cust_promo_code)).filter(
+        Promotions.cust_promo_code.startswith(PREFIX)
+    ).scalar()
+    number = int(last[len(PREFIX):]) + 1 if last else 0
+    for first in range(existing, count, batch_size):
+        promotions = PromotionsFactory.build_batch(min(batch_size, count - first))
+        for promotion in promotions:
+            promotion.promo_id = None
+            promotion.cust_promo_code = f"{PREFIX}{number:07d}"
+            number += 1
+        Promotions.create_many(promotions, batch_size=1000)
+        print(f"  seeded {first + len(promotions)} of {count} promotions", end="\r", flush=True)
+    db.session.expire_all()
+    rows = db.session.query(Promotions.promo_id, Promotions.cust_promo_code).filter(
+        Promotions.cust_promo_code.startswith(PREFIX)
+    )
+    return [tuple(row) for row in rows.order_by(Promotions.promo_id).limit(count)]
+
+
+def new_promotion(code):
+    """Returns the JSON body of a promotion for POST and PUT"""
+    data = PromotionsFactory.build().serialize()
+    data["cust_promo_code"] = code
+    return data
+
+
+######################################################################
+# Scenarios: a name and a function that returns the requests to time
+######################################################################
+def scenarios(rows, count, full_list):
+    """Returns (name, [(method, path, body), ...]) for every route"""
+    picks = [random.choice(rows) for _ in range(count)]
+    listing = [
+        ("health", [("GET", "/health", None)] * count),
+        ("list_page", [("GET", "/promotions?limit=100", None)] * count),
+        ("list_filtered", [("GET", "/promotions?active=true&limit=100", None)] * count),
+        ("read", [("GET", f"/promotions/{promo_id}", None) for promo_id, _ in picks]),
+        ("read_by_code", [("GET", f"/promotions/code/{code}", None) for _, code in picks]),
+        ("create", [("POST", "/promotions", new_promotion(f"{CREATED}{number}")) for number in range(count)]),
+        ("update", [("PUT", f"/promotions/{promo_id}", new_promotion(code)) for promo_id, code in picks]),
+        ("delete", None),  # deletes the promotions made by "create"
+    ]
+    if full_list:
+        listing.insert(1, ("list_all", [("GET", "/promotions", None)] * max(1, count // 10)))
+    return listing
+
+
+def created_promotions():
+    """Returns DELETE requests for the promotions made by the create scenario"""
+    db.session.expire_all()
+    ids = db.session.query(Promotions.promo_id).filter(Promotions.cust_promo_code.startswith(CREATED)).all()
+    return [("DELETE", f"/promotions/{promo_id}", None) for promo_id, in ids]
+
+
+######################################################################
+# Targets
+######################################################################
+class InProcess:
+    """Sends the requests through the Flask test client"""
+
+    name = "inprocess"
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, body):
+        """Returns the status of one request"""
+        response = self.client.open(path, method=method, json=body)
+        response.close()
+        return response.status_code
+
+    def close(self):
+        """Nothing to stop"""
+
+
+def pinned(cpus):
+    """Returns the first cpus CPUs this process may run on, all of them for 0"""
+    allowed = sorted(os.sched_getaffinity(0))
+    return allowed[:cpus] if cpus else allowed
+
+
+class Gunicorn:
+    """Sends the requests over HTTP to a gunicorn launched for the run,
+    kept on the first cpus CPUs when cpus is set"""
+
+    name = "gunicorn"
+
+    def __init__(self, workers, threads, cpus=0):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        # the server inherits the CPUs this process may use when it starts
+        own = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, pinned(cpus))
+        try:
+            self.process = subprocess.Popen(self.command(workers, threads), cwd=ROOT)  # pylint: disable=consider-using-with
+        finally:
+            os.sched_setaffinity(0, own)
+        self.local = threading.local()
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and self.process.poll() is None:
+            try:
+                if self.request("GET", "/health", None) == 200:
+                    return
+            except OSError:
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError(f"{self.name} did not start")
+
+    def request(self, method, path, body):
+        """Returns the status of one request, keeping a connection per thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        try:
+            conn.request(method, path, payload, headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.local.conn = None
+            conn.close()
+            raise
+        return response.status
+
+    def command(self, workers, threads):
+        """Returns the command that starts the server"""
+        return [
+            sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{self.port}",
+            "--workers", str(workers), "--threads", str(threads), "--log-level", "warning", "wsgi:app",
+        ]
+
+    def close(self):
+        """Stops the server"""
+        self.process.terminate()
+        self.process.wait(30)
+
+
+class Uvicorn(Gunicorn):
+    """Sends the requests over HTTP to the ASGI app under gunicorn with
+    uvicorn workers, as deployed. It has no threads per worker. uvicorn's own
+    --workers leaves Nagle's algorithm on for the shared socket, which adds
+    the client's delayed ACK to every response"""
+
+    name = "uvicorn"
+
+    def command(self, workers, _threads):
+        return [
+            sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{self.port}", "--workers", str(workers),
+            "--worker-class", "uvicorn.workers.UvicornWorker", "--log-level", "warning", "asgi:app",
+        ]
+
+
+TARGETS = {"inprocess": InProcess, "gunicorn": Gunicorn, "uvicorn": Uvicorn}
+
+
+######################################################################
+# Measurements
+######################################################################
+def percentiles(samples, scale):
+    """Returns p50, p95 and p99 of the samples, multiplied by scale"""
+    if len(samples) < 2:
+        value = samples[0] * scale if samples else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return cuts[49] * scale, cuts[94] * scale, cuts[98] * scale
+
+
+def measure(target, requests, concurrency, warmup):
+    """Sends the requests from concurrency threads and summarizes them"""
+    for method, path, body in requests[:warmup]:
+        if method == "GET":
+            target.request(method, path, body)
+    chunks = [requests[index::concurrency] for index in range(concurrency)]
+
+    def worker(chunk):
+        latencies = []
+        errors = 0
+        for method, path, body in chunk:
+            start = time.perf_counter()
+            code = target.request(method, path, body)
+            latencies.append(time.perf_counter() - start)
+            errors += code >= 400
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(worker, chunks))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for chunk, _ in results for latency in chunk]
+    p50, p95, p99 = percentiles(latencies, 1000)
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in results),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+    }
+
+
+def micro(function, count, batch=100):
+    """Times function(index) count times in batches, per call"""
+    per_call = []
+    start = time.perf_counter()
+    for first in range(0, count, batch):
+        batch_start = time.perf_counter()
+        for index in range(first, min(first + batch, count)):
+            function(index)
+        per_call.append((time.perf_counter() - batch_start) / (min(first + batch, count) - first))
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = percentiles(per_call, 1e6)
+    return {"ops_per_sec": round(count / elapsed, 1), "p50_us": round(p50, 3), "p95_us": round(p95, 3),
+            "p99_us": round(p99, 3)}
+
+
+def micro_benchmarks(count):
+    """Times serialize() and deserialize() of factory promotions"""
+    promotions = PromotionsFactory.build_batch(1000)
+    documents = [promotion.serialize() for promotion in promotions]
+    return {
+        "serialize": micro(lambda index: promotions[index % 1000].serialize(), count),
+        "deserialize": micro(lambda index: Promotions().deserialize(documents[index % 1000]), count),
+    }
+
+
+def run_size(target, size, args):
+    """Seeds size promotions and measures every route against them"""
+    print(f"{size} promotions")
+    rows = seed(size)
+    print()
+    results = {}
+    for name, requests in scenarios(rows, args.requests, size <= args.full_list_max):
+        requests = created_promotions() if requests is None else requests
+        results[name] = measure(target, requests, args.concurrency, args.warmup)
+        result = results[name]
+        print(f"  {name:>14}: {result['rps']:10.1f} req/sec  p50 {result['p50_ms']:8.3f} ms  "
+              f"p95 {result['p95_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms  errors {result['errors']}")
+    return results
+
+
+######################################################################
+# Baseline
+######################################################################
+def compare(baseline, results, tolerance):
+    """Prints how the results moved from the baseline, returning the regressions"""
+    regressions = []
+    for key in ("target", "database", "concurrency"):
+        if baseline["meta"].get(key) != results["meta"].get(key):
+            print(f"warning: the baseline ran with {key}={baseline['meta'].get(key)}, not {results['meta'].get(key)}")
+    pairs = [(f"{size} rows {name}", base, results["sizes"][size][name])
+             for size, routes in baseline.get("sizes", {}).items() if size in results["sizes"]
+             for name, base in routes.items() if name in results["sizes"][size]]
+    pairs += [(name, base, results["micro"][name]) for name, base in baseline.get("micro", {}).items()
+              if name in results.get("micro", {})]
+    for label, base, now in pairs:
+        for metric, bigger_is_better in COMPARED.items():
+            if metric not in base or metric not in now or not base[metric]:
+                continue
+            change = now[metric] / base[metric] - 1
+            worse = -change if bigger_is_better else change
+            flag = "REGRESSION" if worse > tolerance else ""
+            print(f"  {label:>28} {metric:>11}: {base[metric]:12.3f} -> {now[metric]:12.3f} ({change:+7.1%}) {flag}")
+            if flag:
+                regressions.append((label, metric, change))
+    return regressions
+
+
+def parse_args(argv):
+    """Returns the command line options"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000], help="promotions to seed, 1000 to 1000000")
+    parser.add_argument("--requests", type=int, default=300, help="requests per route")
+    parser.add_argument("--target", choices=tuple(TARGETS), default="inprocess")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn or uvicorn workers")
+    parser.add_argument("--threads", type=int, default=1, help="threads per gunicorn worker")
+    parser.add_argument("--cpus", type=int, default=0, help="CPUs the server may use, 0 for all")
+    parser.add_argument("--concurrency", type=int, default=1, help="client threads")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed GETs before each route")
+    parser.add_argument("--full-list-max", type=int, default=10000, help="largest size to list whole")
+    parser.add_argument("--micro", type=int, default=50000, help="calls per micro-benchmark")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with this JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help=f"write the results to {BASELINE}")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed before failing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs the suite, writes the results and compares them with the baseline"""
+    args = parse_args(argv)
+    random.seed(0)
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+    with app.app_context():
+        db.create_all()
+        print(f"database: {db.engine.url.render_as_string(hide_password=True)}")
+        target = InProcess() if args.target == "inprocess" else TARGETS[args.target](args.workers, args.threads, args.cpus)
+        results = {
+            "meta": {
+                "target": target.name,
+                "database": db.engine.dialect.name,
+                "workers": args.workers if args.target != "inprocess" else None,
+                "cpus": args.cpus if args.target != "inprocess" else None,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            },
+            "sizes": {},
+        }
+        try:
+            for size in sorted(args.rows):
+                results["sizes"][str(size)] = run_size(target, size, args)
+        finally:
+            target.close()
+        results["micro"] = micro_benchmarks(args.micro)
+        for name, result in results["micro"].items():
+            print(f"  {name:>14}: {result['ops_per_sec']:10.1f} ops/sec  p50 {result['p50_us']:8.3f} us")
+
+    for path in filter(None, (args.output, BASELINE if args.save_baseline else None)):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"wrote {path}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
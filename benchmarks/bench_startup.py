@@ -0,0 +1,102 @@
+"""
+Cold Start Benchmark
+
+Times ``flask db-upgrade`` on an empty database and on a current one, then
+starts gunicorn again and again and measures the time from spawning it to
+the first 200 from GET /health. The workers only check the schema version,
+as they do in production with DB_MIGRATE_ON_BOOT=false.
+
+Usage:
+    python -m benchmarks.bench_startup --runs 10 --workers 2
+
+Set DATABASE_URI to benchmark against PostgreSQL, otherwise a scratch SQLite
+database is used. The scratch file is deleted first, so the first upgrade
+builds the whole schema, while on PostgreSQL it only runs what is pending.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRATCH = "/tmp/promotions-startup.db"
+
+
+def environment():
+    """Returns the environment of the commands the benchmark runs"""
+    env = dict(os.environ, FLASK_APP="wsgi:app", DB_MIGRATE_ON_BOOT="false")
+    env.setdefault("DATABASE_URI", f"sqlite:///{SCRATCH}")
+    return env
+
+
+def db_upgrade(env):
+    """Returns the seconds ``flask db-upgrade`` took and what it printed"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-m", "flask", "db-upgrade"], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    return time.perf_counter() - start, result.stdout.strip()
+
+
+def healthy(port):
+    """Returns True once GET /health answers 200"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request("GET", "/health")
+        return conn.getresponse().status == 200
+    except (OSError, http.client.HTTPException):
+        return False
+    finally:
+        conn.close()
+
+
+def cold_start(env, workers, timeout=60):
+    """Returns the seconds from spawning gunicorn to its first served request"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    command = [
+        sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+        "--workers", str(workers), "--log-level", "warning", "wsgi:app",
+    ]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env)  # pylint: disable=consider-using-with
+    try:
+        while time.perf_counter() - start < timeout and process.poll() is None:
+            if healthy(port):
+                return time.perf_counter() - start
+            time.sleep(0.01)
+        raise RuntimeError("gunicorn did not start")
+    finally:
+        process.terminate()
+        process.wait(30)
+
+
+def main(argv=None):
+    """Times the migrations and the cold starts and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--runs", type=int, default=10, help="gunicorn starts to time")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    args = parser.parse_args(argv)
+
+    env = environment()
+    if env["DATABASE_URI"] == f"sqlite:///{SCRATCH}" and os.path.exists(SCRATCH):
+        os.remove(SCRATCH)
+    for label in ("db-upgrade", "db-upgrade again"):
+        seconds, output = db_upgrade(env)
+        print(f"{label:>18}: {seconds * 1000:8.0f} ms  ({output})")
+
+    samples = [cold_start(env, args.workers) for _ in range(args.runs)]
+    print(
+        f"{'cold start':>18}: {statistics.median(samples) * 1000:8.0f} ms p50, "
+        f"{max(samples) * 1000:.0f} ms max over {args.runs} runs of {args.workers} workers"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
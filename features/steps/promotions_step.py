@@ -29,18 +29,24 @@ from behave import given
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_403_FORBIDDEN = 403
 
 
 @given("the following promotions")
 def step_impl(context):
     """Delete all promotions and load new ones"""
 
-    # List all of the promotions and delete them one by one
+    # Reset the table in one call, falling back to deleting the promotions
+    # one by one if the service does not allow resets (ALLOW_RESET)
     rest_endpoint = f"{context.base_url}/promotions"
-    context.resp = requests.get(rest_endpoint)
-    assert context.resp.status_code == HTTP_200_OK
-    for promotion in context.resp.json():
-        context.resp = requests.delete(f"{rest_endpoint}/{promotion['promo_id']}")
+    context.resp = requests.post(f"{rest_endpoint}/reset")
+    if context.resp.status_code == HTTP_403_FORBIDDEN:
+        context.resp = requests.get(rest_endpoint)
+        assert context.resp.status_code == HTTP_200_OK
+        for promotion in context.resp.json():
+            context.resp = requests.delete(f"{rest_endpoint}/{promotion['promo_id']}")
+            assert context.resp.status_code == HTTP_204_NO_CONTENT
+    else:
         assert context.resp.status_code == HTTP_204_NO_CONTENT
 
     # load the database with new promotions
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings, read from the working directory at startup
+
+The workers write their Prometheus samples to PROMETHEUS_MULTIPROC_DIR so
+that GET /metrics on any of them reports the whole pod. The folder is
+emptied when gunicorn starts and the files of a worker that exits stop
+counting towards the in-progress gauge.
+"""
+import os
+import shutil
+
+# Must be set before a worker imports prometheus_client
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/promotions-metrics")
+
+
+def on_starting(_server):
+    """Starts every run with no samples from the last one"""
+    folder = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    if folder:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+
+def child_exit(_server, worker):
+    """Drops the live gauges of a worker that exited"""
+    if os.environ["PROMETHEUS_MULTIPROC_DIR"]:
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+
+        multiprocess.mark_process_dead(worker.pid)
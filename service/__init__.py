@@ -18,7 +18,9 @@ Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
+import os
 import sys
+import time
 from flask import Flask
 from service import config
 from service.common import log_handlers
@@ -27,25 +29,58 @@ from service.common import log_handlers
 ############################################################
 # Initialize the Flask instance
 ############################################################
-def create_app():
+def create_app():  # pylint: disable=too-many-locals
     """Initialize the core application."""
+    started = time.perf_counter()
     # Create Flask application
     app = Flask(__name__)
     app.config.from_object(config)
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    from service.models import db, code_cache
+    from service.common import pool
+    pool.init_app(app)
     db.init_app(app)
+    code_cache.configure(app.config["CODE_CACHE_SIZE"], app.config["CODE_CACHE_TTL"])
+
+    from service.common.metrics import metrics
+    metrics.init_app(app)
+
+    from service.common.profiler import profiler
+    profiler.init_app(app)
+
+    from service.common.leases import leases
+    leases.init_app(app)
+
+    from service.common.pricing import promotion_index
+    promotion_index.ttl = app.config["PRICING_INDEX_TTL"]
+
+    from service.common.snapshot import snapshot
+    snapshot.init_app(app)
+
+    from service.common.replica import replica
+    replica.init_app(app)
+
+    from service.common.compression import compression
+    compression.init_app(app)
+
+    from service.common.assets import assets
+    assets.init_app(app)
 
     with app.app_context():
         # Dependencies require we import the routes AFTER the Flask app is created
         # pylint: disable=wrong-import-position, wrong-import-order, unused-import
         from service import routes, models  # noqa: F401 E402
-        from service.common import error_handlers, cli_commands  # noqa: F401, E402
+        from service.common import error_handlers, cli_commands, migrations  # noqa: F401, E402
 
+        # Only read the schema version, "flask db-upgrade" runs the migrations
         try:
-            db.create_all()
+            migrations.check(
+                db.engine,
+                migrate=app.config["DB_MIGRATE_ON_BOOT"],
+                strict=not os.environ.get("FLASK_RUN_FROM_CLI"),
+            )
         except Exception as error:  # pylint: disable=broad-except
             app.logger.critical("%s: Cannot continue", error)
             # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -58,6 +93,6 @@ def create_app():
         app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
 
-        app.logger.info("Service initialized!")
+        app.logger.info("Service initialized in %.0f ms!", (time.perf_counter() - started) * 1000)
 
         return app
@@ -0,0 +1,473 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Async Promotion Service
+
+Serves the promotions over ASGI (see asgi.py) next to the WSGI app in
+wsgi.py. /health and the routes that create, read, update and delete one
+Promotion run as coroutines on an async SQLAlchemy engine, psycopg on
+PostgreSQL and aiosqlite on SQLite. A worker keeps serving other requests
+while a query waits on the database. They share the Promotions model, its
+validation and the JSON, ETags and errors of service/routes.py.
+
+Every other route is passed to the Flask app on a pool of ASGI_THREADS
+threads, so the whole API is served. Each part of those responses is sent
+as soon as Flask produces it, so streamed listings stay streamed.
+
+The async routes always read from the primary, and the profiler and
+response compression only apply to the routes that Flask serves.
+"""
+import sys
+import json
+import asyncio
+import logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app as app
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound, UnsupportedMediaType
+from werkzeug.routing import Map, Rule
+from werkzeug.sansio.request import Request as SansIORequest
+from service.models import Promotions, DataValidationError, code_cache
+from service.common import status  # HTTP Status Codes
+from service.common.leases import leases
+from service.common.metrics import metrics
+from service.common.pool import MeteredAsyncQueuePool, MeteredQueuePool
+from service.common.serializer import FIELDS, parse_fields, encoder, encode_row
+from service.common.shared_snapshot import Entry
+from service.common.snapshot import snapshot, encode
+
+logger = logging.getLogger("flask.app")
+
+# The async driver of each database SQLALCHEMY_DATABASE_URI can name
+ASYNC_DRIVERS = {"postgresql": "postgresql+psycopg", "sqlite": "sqlite+aiosqlite"}
+
+# The routes served here, with the names of their Flask views
+ROUTES = Map([
+    Rule("/health", methods=["GET"], endpoint="health_check"),
+    Rule("/promotions", methods=["POST"], endpoint="create_promotions"),
+    Rule("/promotions/<int:promo_id>", methods=["GET"], endpoint="get_promotions"),
+    Rule("/promotions/code/<string:code>", methods=["GET"], endpoint="get_promotions_by_code"),
+    Rule("/promotions/<int:promo_id>", methods=["PUT"], endpoint="update_promotions"),
+    Rule("/promotions/<int:promo_id>", methods=["DELETE"], endpoint="delete_promotion"),
+])
+
+# The "error" of the JSON body of each error, as in service/common/error_handlers.py
+ERRORS = {
+    status.HTTP_400_BAD_REQUEST: "Bad Request",
+    status.HTTP_404_NOT_FOUND: "Not Found",
+    status.HTTP_415_UNSUPPORTED_MEDIA_TYPE: "Unsupported media type",
+    status.HTTP_500_INTERNAL_SERVER_ERROR: "Internal Server Error",
+}
+
+
+class Request(SansIORequest):
+    """An ASGI request with the same parsing as a Flask request"""
+
+    def __init__(self, scope, body):
+        super().__init__(
+            scope["method"],
+            scope.get("scheme", "http"),
+            scope.get("server"),
+            scope.get("root_path", ""),
+            scope["path"],
+            scope["query_string"],
+            Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]]),
+            (scope.get("client") or (None,))[0],
+        )
+        self.body = body
+
+    def get_json(self):
+        """Returns the body parsed as JSON"""
+        try:
+            return json.loads(self.body)
+        except ValueError as error:
+            raise BadRequest(f"Failed to decode JSON object: {error}") from error
+
+
+def create_engine(config):
+    """Returns an async engine for SQLALCHEMY_DATABASE_URI with the same options"""
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"There is no async driver for {url.get_backend_name()}")
+    options = dict(config["SQLALCHEMY_ENGINE_OPTIONS"])
+    if options.get("poolclass") is MeteredQueuePool:
+        options["poolclass"] = MeteredAsyncQueuePool
+    return create_async_engine(url.set(drivername=driver), **options)
+
+
+######################################################################
+#  A S G I   A P P L I C A T I O N
+######################################################################
+class AsyncService:
+    """The promotion service as an ASGI application
+
+    Args:
+        flask_app (Flask): the app from create_app(), for its config and
+            the routes that are not served here
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.engine = None
+        self.sessions = None
+        self.executor = None
+        self.routes = ROUTES.bind("localhost")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope {scope['type']}")
+        if self.engine is None:
+            self.startup()
+        body = await read_body(receive)
+        try:
+            rule, args = self.routes.match(scope["path"], scope["method"], return_rule=True)
+        except HTTPException:
+            await self.forward(scope, body, send)
+            return
+        response = await self.handle(rule, args, Request(scope, body))
+        await respond(send, *response, head=scope["method"] == "HEAD")
+
+    async def lifespan(self, receive, send):
+        """Opens the engine when the server starts and closes it when it stops"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def startup(self):
+        """Creates the async engine and the threads that run Flask"""
+        self.engine = create_engine(self.app.config)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.executor = ThreadPoolExecutor(self.app.config["ASGI_THREADS"], thread_name_prefix="flask")
+        if metrics.enabled:
+            metrics.watch(self.engine.sync_engine)
+        logger.info("Serving ASGI with the %s async engine", self.engine.dialect.driver)
+
+    async def shutdown(self):
+        """Closes the engine's connections and stops the threads"""
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.executor.shutdown()
+            self.engine = None
+
+    async def handle(self, rule, args, request):
+        """Runs one of the async routes and returns (status, body, headers)"""
+        if metrics.enabled:
+            metrics.begin(request.method, rule.rule)
+        with self.app.app_context():
+            try:
+                code, body, headers = await getattr(self, rule.endpoint)(request, **args)
+            except DataValidationError as error:
+                code, body, headers = error_response(status.HTTP_400_BAD_REQUEST, str(error))
+            except HTTPException as error:
+                code, body, headers = error_response(error.code, str(error))
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception("Error handling %s %s", request.method, request.path)
+                code, body, headers = error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, str(error))
+        if metrics.enabled:
+            metrics.end(code)
+        if body:
+            headers.setdefault("Content-Type", "application/json")
+        return code, body, list(headers.items())
+
+    async def forward(self, scope, body, send):
+        """Runs a request through the Flask app on a thread, which sends the
+        response through the event loop as Flask produces it"""
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message):
+            # blocks the thread until the message is sent, so a slow client
+            # holds back the stream rather than letting it pile up in memory
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        environ = wsgi_environ(scope, body)
+        head = scope["method"] == "HEAD"
+        await loop.run_in_executor(self.executor, call_wsgi, self.app, environ, send_from_thread, head)
+
+    ######################################################################
+    #  R O U T E S
+    ######################################################################
+
+    async def health_check(self, _request):
+        """Let them know our heart is still beating"""
+        return status.HTTP_200_OK, encode({"status": 200, "message": "Healthy"}) + b"\n", {}
+
+    async def create_promotions(self, request):
+        """Creates a Promotion from the body that is posted"""
+        logger.info("Request to create a promotion")
+        check_content_type(request, "application/json")
+
+        promotion = Promotions().deserialize(request.get_json())
+        promotion.promo_id = None
+        async with self.sessions() as session:
+            session.add(promotion)
+            await commit(session, promotion, promotion.cached_codes())
+
+        logger.info("Promotions with ID: %d created.", promotion.promo_id)
+        location_url = f"{request.root_url}promotions/{promotion.promo_id}"
+        return status.HTTP_201_CREATED, encode(promotion.serialize()) + b"\n", {"Location": location_url}
+
+    async def get_promotions(self, request, promo_id):
+        """Returns a Promotion by its id, only some fields if asked"""
+        logger.info("Request for promotion with id: %s", promo_id)
+
+        fields = parse_fields(request.args.get("fields"))
+        view = snapshot.view() if fields == FIELDS else None
+        if view is not None:
+            entry = view.get(promo_id)
+        else:
+            names = fields + tuple(name for name in ("promo_id", "version") if name not in fields)
+            row = await self.first_row(Promotions.promo_id == promo_id, names)
+            entry = row and Entry(row.promo_id, row.version, encoder(fields)(row))
+        if not entry:
+            raise NotFound(f"Promotion with id '{promo_id}' was not found.")
+
+        logger.info("Returning promotion: %s", promo_id)
+        return entry_response(request, entry, fields)
+
+    async def get_promotions_by_code(self, request, code):
+        """Returns a Promotion by its customer facing code, ignoring case"""
+        logger.info("Request for promotion with code: %s", code)
+
+        view = snapshot.view()
+        entry = view.by_code(code) if view is not None else code_cache.get(code.lower())
+        if entry is None and view is None:
+            row = await self.first_row(func.lower(Promotions.cust_promo_code) == code.lower(), FIELDS + ("version",))
+            if row:
+                entry = Entry(row.promo_id, row.version, encode_row(row))
+                code_cache.set(code.lower(), entry)
+        if not entry:
+            raise NotFound(f"Promotion with code '{code}' was not found.")
+
+        logger.info("Returning promotion: %s", entry.promo_id)
+        return entry_response(request, entry)
+
+    async def update_promotions(self, request, promo_id):
+        """Updates a Promotion from the body that is posted"""
+        logger.info("Request to update promotion with id: %d", promo_id)
+        check_content_type(request, "application/json")
+
+        await release(promo_id)
+        async with self.sessions() as session:
+            promotion = await session.get(Promotions, promo_id)
+            if not promotion:
+                raise NotFound(f"Promotion with id: '{promo_id}' was not found.")
+            promotion.deserialize(request.get_json())
+            promotion.promo_id = promo_id
+            await commit(session, promotion, promotion.cached_codes())
+
+        logger.info("Promotion with ID: %d updated.", promotion.promo_id)
+        return status.HTTP_200_OK, encode(promotion.serialize()) + b"\n", {}
+
+    async def delete_promotion(self, _request, promo_id):
+        """Deletes a Promotion by its id"""
+        logger.info("Request to delete promo with id: %d", promo_id)
+
+        await release(promo_id)
+        async with self.sessions() as session:
+            promotion = await session.get(Promotions, promo_id)
+            if promotion:
+                codes = promotion.cached_codes()
+                await session.delete(promotion)
+                await commit(session, promotion, codes)
+
+        logger.info("Promotion with ID: %d delete complete.", promo_id)
+        return status.HTTP_204_NO_CONTENT, b"", {}
+
+    async def first_row(self, criterion, names):
+        """Returns the named columns of the first Promotion matching criterion"""
+        statement = select(*(getattr(Promotions, name) for name in names)).where(criterion).limit(1)
+        async with self.sessions() as session:
+            return (await session.execute(statement)).first()
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+async def commit(session, promotion, codes):
+    """Commits a write to a Promotion with the same bookkeeping as the
+    Flask routes, see Promotions.changing and Promotions.changed"""
+    try:
+        await session.run_sync(promotion.forfeit_leases)
+        await session.flush()
+        await session.run_sync(Promotions.changing, [promotion.promo_id], False)
+        await session.commit()
+    except Exception as error:
+        await session.rollback()
+        logger.error("Error saving record: %s", promotion)
+        raise DataValidationError(error) from error
+    Promotions.changed([promotion.promo_id], False, codes)
+
+
+async def release(promo_id):
+    """Gives back the units this worker leased for a Promotion before it changes"""
+    if leases.outstanding(promo_id):
+        # restocking goes through Flask's session
+        await asyncio.to_thread(leases.release, promo_id)
+    else:
+        leases.release(promo_id)
+
+
+def check_content_type(request, content_type):
+    """Checks that the media type is correct"""
+    if request.headers.get("Content-Type") != content_type:
+        logger.error("Invalid Content-Type: %s", request.headers.get("Content-Type"))
+        raise UnsupportedMediaType(f"Content-Type must be {content_type}")
+
+
+def entry_response(request, entry, fields=FIELDS):
+    """Returns a Promotion, or 304 Not Modified if the client has this version"""
+    etag = f"{entry.promo_id}.{entry.version}"
+    if fields != FIELDS:
+        etag += ":" + ",".join(fields)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": app.config["CACHE_CONTROL"]}
+    if request.if_none_match.contains_weak(etag):
+        return status.HTTP_304_NOT_MODIFIED, b"", headers
+    return status.HTTP_200_OK, entry.body + b"\n", headers
+
+
+def error_response(code, message):
+    """Returns the JSON error that the Flask error handlers send"""
+    if code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+        logger.error(message)
+    else:
+        logger.warning(message)
+    body = encode({"status": code, "error": ERRORS.get(code, "Error"), "message": message}) + b"\n"
+    return code, body, {}
+
+
+######################################################################
+#  A S G I   <-->   W S G I
+######################################################################
+async def read_body(receive):
+    """Returns the whole body of a request"""
+    chunks = []
+    more = True
+    while more:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+async def respond(send, code, body, headers, head=False):
+    """Sends a whole response"""
+    raw = encode_headers(headers)
+    if not any(name == b"content-length" for name, _ in raw):
+        raw.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": code, "headers": raw})
+    await send({"type": "http.response.body", "body": b"" if head else body})
+
+
+def encode_headers(headers):
+    """Returns (name, value) headers as the lower case bytes of ASGI"""
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+
+def wsgi_environ(scope, body):
+    """Returns the WSGI environ of an ASGI request"""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ, send, head=False):
+    """Runs a WSGI app and sends its response as ASGI messages
+
+    Every part the app yields goes out as its own http.response.body with
+    more_body set, and an empty one ends the response. The headers wait for
+    the first part, since the app may still replace them until then.
+
+    Args:
+        wsgi_app (callable): the WSGI app
+        environ (dict): the WSGI environ of the request
+        send (callable): sends an ASGI message, blocking until it is sent
+        head (bool): True to send the headers without the body
+    """
+    started = {}
+
+    def start_response(status_line, headers, _exc_info=None):
+        started["status"] = int(status_line.split(" ", 1)[0])
+        started["headers"] = headers
+
+    def begin():
+        if not started.get("sent"):
+            started["sent"] = True
+            send({"type": "http.response.start", "status": started["status"], "headers": encode_headers(started["headers"])})
+
+    iterable = wsgi_app(environ, start_response)
+    try:
+        for chunk in iterable:
+            if chunk and not head:
+                begin()
+                send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+    begin()
+    send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def create_asgi_app():
+    """Creates the Flask app and wraps it in the ASGI app"""
+    # pylint: disable=import-outside-toplevel
+    from service import create_app
+    from service.common import log_handlers
+
+    flask_app = create_app()
+    if not logging.getLogger("gunicorn.error").handlers:
+        # running under uvicorn rather than gunicorn's uvicorn worker
+        log_handlers.init_logging(flask_app, "uvicorn.error")
+    return AsyncService(flask_app)
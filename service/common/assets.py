@@ -0,0 +1,180 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Static Assets
+
+``python -m service.common.assets`` builds the static files for production.
+Every file is copied under a name that contains a hash of its content, for
+example css/flatly_bootstrap.min.0c1d2e3f4a5b.css, with gzip and brotli
+copies compressed ahead of time at the highest level. index.html is
+rewritten to point at the hashed names and manifest.json records them.
+
+A hashed name always has the same content, so those files are served from
+/assets with a year long immutable Cache-Control and are never revalidated.
+index.html keeps its name and is revalidated with its ETag. Without a build,
+for example in development, the app serves service/static as before.
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import mimetypes
+from flask import abort, send_from_directory
+from service.common.compression import brotli, compressible, negotiate
+
+MANIFEST = "manifest.json"
+
+# Precompressed copies by encoding, in order of preference
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+IMMUTABLE = 365 * 24 * 60 * 60
+
+# Files smaller than this are not worth a compressed copy
+MIN_SIZE = 1024
+
+
+class Assets:
+    """Serves the hashed, precompressed static files of a build"""
+
+    def __init__(self):
+        self.folder = None
+        self.files = {}
+
+    @property
+    def enabled(self):
+        """True when a build was found"""
+        return bool(self.files)
+
+    def init_app(self, app):
+        """Loads the manifest of the build in ASSETS_FOLDER, if there is one"""
+        self.folder = app.config["ASSETS_FOLDER"] or os.path.join(app.static_folder, "dist")
+        self.files = {}
+        path = os.path.join(self.folder, MANIFEST)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                manifest = json.load(file)
+            # hashed name -> the encodings it has a precompressed copy in
+            self.files = {entry["file"]: tuple(entry["encodings"]) for entry in manifest.values()}
+            app.logger.info("Serving %d static assets from %s", len(self.files), self.folder)
+
+    def send_index(self):
+        """Sends the rewritten index.html, revalidated on every use"""
+        response = self._send("index.html")
+        response.cache_control.no_cache = True
+        return response
+
+    def send_asset(self, filename):
+        """Sends a hashed file, cached for a year without revalidation"""
+        if filename == "index.html":
+            abort(404)
+        response = self._send(filename, IMMUTABLE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def _send(self, filename, max_age=None):
+        """Sends a file of the build in the best encoding the client accepts"""
+        if filename not in self.files:
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encoding = negotiate(self.files[filename]) if self.files[filename] else None
+        name = filename + SUFFIXES[encoding] if encoding else filename
+        response = send_from_directory(self.folder, name, mimetype=mimetype, max_age=max_age, conditional=True)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if compressible(mimetype):
+            response.vary.add("Accept-Encoding")
+        return response
+
+
+######################################################################
+# Build
+######################################################################
+def build(static_folder, output):
+    """Writes the hashed and precompressed static files and their manifest
+
+    Args:
+        static_folder (str): the folder with the source files
+        output (str): the folder to write the build to
+    """
+    manifest = {}
+    for root, folders, names in os.walk(static_folder):
+        folders[:] = [folder for folder in folders if os.path.join(root, folder) != output]
+        for name in names:
+            source = os.path.join(root, name)
+            path = os.path.relpath(source, static_folder).replace(os.sep, "/")
+            if path == "index.html":
+                continue
+            with open(source, "rb") as file:
+                data = file.read()
+            stem, extension = os.path.splitext(path)
+            hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+            manifest[path] = {"file": hashed, "encodings": write(output, hashed, data)}
+
+    with open(os.path.join(static_folder, "index.html"), encoding="utf-8") as file:
+        index = file.read()
+
+    def hashed_url(match):
+        entry = manifest.get(match.group(2))
+        return f"{match.group(1)}assets/{entry['file']}" if entry else match.group(0)
+
+    index = re.sub(r"""(["'])static/([^"'?#]+)""", hashed_url, index)
+    manifest["index.html"] = {"file": "index.html", "encodings": write(output, "index.html", index.encode())}
+
+    with open(os.path.join(output, MANIFEST), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+def write(output, name, data):
+    """Writes a file and its compressed copies, returning their encodings"""
+    path = os.path.join(output, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+    mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if len(data) < MIN_SIZE or not compressible(mimetype):
+        return []
+    copies = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli:
+        copies["br"] = brotli.compress(data, quality=11)
+    encodings = []
+    for encoding, suffix in SUFFIXES.items():
+        if encoding in copies and len(copies[encoding]) < len(data):
+            with open(path + suffix, "wb") as file:
+                file.write(copies[encoding])
+            encodings.append(encoding)
+    return encodings
+
+
+def main(argv=None):
+    """Builds service/static into service/static/dist, or the given folders"""
+    argv = sys.argv[1:] if argv is None else argv
+    static_folder = argv[0] if argv else os.path.join(os.path.dirname(__file__), "..", "static")
+    output = argv[1] if len(argv) > 1 else os.path.join(static_folder, "dist")
+    manifest = build(os.path.abspath(static_folder), os.path.abspath(output))
+    print(f"Built {len(manifest)} static assets into {output}")
+    return 0
+
+
+# Configured by create_app()
+assets = Assets()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Batch Cart Pricing
+
+This module prices large files of carts offline. The live Promotions are
+loaded once into columnar NumPy arrays and every batch of carts is priced
+with array operations instead of a Python loop per line. Batches are spread
+over a pool of processes and the results are written back in input order.
+
+The discounts follow service.common.pricing and are computed in whole cents,
+so unit prices are rounded to the cent first. NumPy is an optional
+dependency, install it with ``poetry install --extras batch``.
+
+Input is NDJSON, one cart per line: {"id": "a1", "items": [{"product_id": 1,
+"quantity": 2, "unit_price": 9.99}]}. Output is NDJSON, one result per cart:
+{"id": "a1", "subtotal": 19.98, "discount": 9.99, "total": 9.99,
+"best_promo_ids": [7]}. A cart that cannot be parsed gets an "error" instead.
+"""
+import os
+import json
+import time
+import logging
+from datetime import date
+from itertools import islice
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from decimal import ROUND_HALF_UP
+import numpy as np
+from service.models import Type, DataValidationError
+from service.common.pricing import live_offers, parse_line
+
+logger = logging.getLogger("flask.app")
+
+# Live Promotions as parallel arrays sorted by product_id
+Catalog = namedtuple("Catalog", ["product_ids", "promo_ids", "types", "values"])
+
+PERCENT, SAVING, BOGO = Type.PERCENT.value, Type.SAVING.value, Type.BOGO.value
+
+# The catalog of a pool worker, set once by _init_worker()
+_CATALOG = None
+
+
+def load_catalog(day=None):
+    """Returns the Promotions live on day (default today) as a Catalog"""
+    rows = live_offers(day or date.today()).all()
+    logger.info("Loaded %d live promotions for batch pricing", len(rows))
+    return Catalog(
+        np.array([row.product_id for row in rows], dtype=np.int64),
+        np.array([row.promo_id for row in rows], dtype=np.int64),
+        np.array([row.type.value for row in rows], dtype=np.int8),
+        np.array([row.value or 0 for row in rows], dtype=np.int64),
+    )
+
+
+def discounts(catalog, product_ids, quantities, cents):
+    """Returns the best discount in cents and its promo_id (-1 for none)
+    for every cart line, given as parallel arrays"""
+    lines = len(product_ids)
+    first = np.searchsorted(catalog.product_ids, product_ids, side="left")
+    counts = np.searchsorted(catalog.product_ids, product_ids, side="right") - first
+
+    # one candidate per (line, offer for the line's product) pair
+    line = np.repeat(np.arange(lines), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    offer = np.arange(len(line)) - starts + np.repeat(first, counts)
+
+    kind = catalog.types[offer]
+    value = catalog.values[offer]
+    quantity = quantities[line]
+    price = cents[line]
+    amount = np.where(
+        kind == PERCENT,
+        (price * quantity * np.minimum(value, 100) + 50) // 100,
+        np.where(
+            kind == SAVING,
+            np.minimum(value * 100, price) * quantity,
+            price * (quantity // 2),
+        ),
+    )
+    amount = np.maximum(amount, 0)
+
+    # best per line: biggest discount, lowest promo_id on a tie
+    promo_id = catalog.promo_ids[offer]
+    order = np.lexsort((promo_id, -amount, line))
+    winners = order[np.r_[True, line[order][1:] != line[order][:-1]]] if len(order) else order
+    best = np.zeros(lines, dtype=np.int64)
+    best_promo = np.full(lines, -1, dtype=np.int64)
+    best[line[winners]] = amount[winners]
+    best_promo[line[winners]] = promo_id[winners]
+    return best, best_promo
+
+
+def price_batch(catalog, raw_carts):
+    """Prices a batch of NDJSON cart lines and returns the NDJSON results"""
+    carts, product_ids, quantities, cents, sizes = [], [], [], [], []
+    for raw in raw_carts:
+        try:
+            cart = json.loads(raw)
+            rows = [parse_line(item) for item in cart["items"]]
+        except (ValueError, TypeError, KeyError, DataValidationError) as error:
+            carts.append({"error": f"Invalid cart: {error}"})
+            sizes.append(0)
+            continue
+        carts.append({"id": cart.get("id")})
+        sizes.append(len(rows))
+        for product_id, quantity, unit_price in rows:
+            product_ids.append(product_id)
+            quantities.append(quantity)
+            cents.append(int((unit_price * 100).quantize(1, rounding=ROUND_HALF_UP)))
+
+    quantities = np.array(quantities, dtype=np.int64)
+    cents = np.array(cents, dtype=np.int64)
+    best, best_promo = discounts(catalog, np.array(product_ids, dtype=np.int64), quantities, cents)
+    subtotals = quantities * cents
+
+    output = []
+    start = 0
+    for cart, size in zip(carts, sizes):
+        if "error" not in cart:
+            end = start + size
+            subtotal, discount = int(subtotals[start:end].sum()), int(best[start:end].sum())
+            cart.update(
+                subtotal=subtotal / 100,
+                discount=discount / 100,
+                total=(subtotal - discount) / 100,
+                best_promo_ids=[int(p) if p >= 0 else None for p in best_promo[start:end]],
+            )
+            start = end
+        output.append(json.dumps(cart, separators=(",", ":")) + "\n")
+    return "".join(output)
+
+
+def _init_worker(catalog):
+    """Keeps the catalog in a pool worker so it is only sent once"""
+    global _CATALOG
+    _CATALOG = catalog
+
+
+def _price_in_worker(raw_carts):
+    """Prices a batch with the catalog of this pool worker"""
+    return price_batch(_CATALOG, raw_carts), len(raw_carts)
+
+
+def _batches(source, batch_size):
+    """Yields lists of up to batch_size non-blank lines from source"""
+    lines = (line for line in source if line.strip())
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def price_carts(source, sink, catalog, workers=None, batch_size=5000):
+    """Prices every cart in an NDJSON source and writes NDJSON results to sink
+
+    Args:
+        source (iterable): lines of NDJSON carts, such as an open file
+        sink (file): where the results are written, in input order
+        catalog (Catalog): the live Promotions from load_catalog()
+        workers (int): the number of processes, 0 prices in this process
+        batch_size (int): the number of carts priced per array operation
+
+    Returns:
+        the number of carts priced and the seconds it took
+    """
+    workers = os.cpu_count() if workers is None else workers
+    started = time.perf_counter()
+    count = 0
+    if workers <= 0:
+        for batch in _batches(source, batch_size):
+            sink.write(price_batch(catalog, batch))
+            count += len(batch)
+        return count, time.perf_counter() - started
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(catalog,)) as pool:
+        pending = deque()
+        for batch in _batches(source, batch_size):
+            pending.append(pool.submit(_price_in_worker, batch))
+            # keep a bounded number of batches in flight so memory stays flat
+            while len(pending) > 2 * workers:
+                count += _write(pending.popleft(), sink)
+        while pending:
+            count += _write(pending.popleft(), sink)
+    return count, time.perf_counter() - started
+
+
+def _write(future, sink):
+    """Writes the results of a finished batch and returns how many carts it had"""
+    output, priced = future.result()
+    sink.write(output)
+    return priced
@@ -0,0 +1,80 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+In-Process Caches
+
+This module contains a small bounded cache used to keep hot lookups out of
+the database. Entries are evicted least recently used first and expire after
+a time to live, which bounds how stale another worker's copy can get.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread safe least recently used cache whose entries expire"""
+
+    def __init__(self, maxsize=1024, ttl=30.0, timer=time.monotonic):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = timer
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, maxsize, ttl):
+        """Resizes the cache and changes the time to live, 0 disables it"""
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._entries.clear()
+
+    def get(self, key):
+        """Returns the value cached for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < self._timer():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Caches value under key, evicting the least recently used entry"""
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """Removes key from the cache if it is there"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self._lock:
+            self._entries.clear()
@@ -16,8 +16,11 @@
 """
 Flask CLI Command Extensions
 """
+import time
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.models import db, Promotions
+from service.common import migrations
 
 
 ######################################################################
@@ -31,6 +34,68 @@ def db_create():
     Recreates a local database. You probably should not use this on
     production. ;-)
     """
+    db.session.remove()
     db.drop_all()
-    db.create_all()
-    db.session.commit()
+    migrations.schema_migrations.drop(db.engine, checkfirst=True)
+    migrations.upgrade(db.engine)
+
+
+######################################################################
+# Command to run the pending schema migrations
+# Usage:
+#   flask db-upgrade
+######################################################################
+@app.cli.command("db-upgrade")
+@click.option("--to", "target", type=int, default=migrations.LATEST, help="Version to stop at (default: latest)")
+def db_upgrade(target):
+    """
+    Runs the schema migrations that have not run yet. Meant to run once per
+    deploy, before the new workers start.
+    """
+    start = time.perf_counter()
+    try:
+        applied = migrations.upgrade(db.engine, target)
+    except migrations.MigrationError as error:
+        raise click.ClickException(str(error)) from error
+    with db.engine.connect() as conn:
+        version = migrations.current_version(conn)
+    seconds = time.perf_counter() - start
+    click.echo(f"Ran {len(applied)} migration(s) in {seconds:.2f}s, the schema is at version {version}")
+
+
+######################################################################
+# Command to quickly remove every promotion
+# Usage:
+#   flask db-reset --yes
+######################################################################
+@app.cli.command("db-reset")
+@click.confirmation_option(prompt="This removes every promotion. Continue?")
+def db_reset():
+    """
+    Removes every promotion with TRUNCATE and restarts the promo_id
+    sequence. Meant for test environments and campaign purges.
+    """
+    Promotions.truncate()
+
+
+######################################################################
+# Command to price a file of carts offline
+# Usage:
+#   flask price-carts carts.ndjson priced.ndjson --workers 4
+######################################################################
+@app.cli.command("price-carts")
+@click.argument("source", type=click.File("r"))
+@click.argument("sink", type=click.File("w"))
+@click.option("--workers", type=int, default=None, help="Pricing processes (default: one per CPU, 0 for none)")
+@click.option("--batch-size", type=click.IntRange(min=1), default=5000, help="Carts priced per batch")
+def price_carts(source, sink, workers, batch_size):
+    """
+    Prices every cart in an NDJSON file against today's live promotions
+    and writes one NDJSON result per cart. Needs the batch extras (numpy).
+    """
+    # numpy is optional, so only import it when the command runs
+    from service.common import batch_pricing  # pylint: disable=import-outside-toplevel
+
+    catalog = batch_pricing.load_catalog()
+    count, seconds = batch_pricing.price_carts(source, sink, catalog, workers, batch_size)
+    click.echo(f"Priced {count} carts in {seconds:.2f}s ({count / max(seconds, 1e-9):.0f} carts/s)", err=True)
@@ -0,0 +1,145 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Compression
+
+API responses are compressed with brotli (when the optional brotli package
+is installed), gzip or deflate, whichever the client prefers in its
+Accept-Encoding. Bodies smaller than COMPRESSION_MIN_SIZE are sent as they
+are because the saving would not pay for the work. Streamed listings are
+compressed chunk by chunk and flushed after every chunk, so clients still
+receive rows as they are read.
+
+A compressed body is a different representation of the same resource, so
+its ETag is sent weak. If-None-Match is compared weakly, so conditional
+requests work with either.
+"""
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli comes with the compression extra
+    brotli = None
+
+# Most preferred first, for clients that accept several equally
+ENCODINGS = ("br", "gzip", "deflate") if brotli else ("gzip", "deflate")
+
+COMPRESSIBLE = {
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "image/svg+xml",
+}
+
+
+def compressible(mimetype):
+    """Returns True for media types that are worth compressing"""
+    return mimetype in COMPRESSIBLE or mimetype.startswith("text/")
+
+
+def negotiate(available=ENCODINGS):
+    """Returns the client's preferred encoding out of available, or None"""
+    return request.accept_encodings.best_match(available)
+
+
+def compressor(encoding, level=6, quality=4):
+    """Returns (compress, flush, finish) functions for an encoding
+
+    compress(data) returns what is ready to send, flush() whatever is still
+    buffered and finish() the end of the stream.
+    """
+    if encoding == "br":
+        encoder = brotli.Compressor(quality=quality)
+        return encoder.process, encoder.flush, encoder.finish
+    # 31 writes a gzip header and trailer, 15 a zlib one (HTTP's "deflate")
+    encoder = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    return encoder.compress, lambda: encoder.flush(zlib.Z_SYNC_FLUSH), encoder.flush
+
+
+class Compression:
+    """Compresses responses according to the request's Accept-Encoding"""
+
+    def __init__(self, enabled=True, min_size=1024, level=6, quality=4):
+        self.enabled = enabled
+        self.min_size = min_size
+        self.level = level
+        self.quality = quality
+
+    def init_app(self, app):
+        """Reads the settings and compresses every response of the app"""
+        self.enabled = app.config["COMPRESSION_ENABLED"]
+        self.min_size = app.config["COMPRESSION_MIN_SIZE"]
+        self.level = app.config["COMPRESSION_LEVEL"]
+        self.quality = app.config["BROTLI_QUALITY"]
+        app.after_request(self.compress)
+
+    def compress(self, response):
+        """Compresses a response if the client accepts it and it is worth it"""
+        if not self.enabled or response.direct_passthrough or "Content-Encoding" in response.headers:
+            return response
+        if "no-transform" in response.headers.get("Cache-Control", ""):
+            return response
+        if response.status_code == 304:
+            # answer for the representation the client would have received
+            if negotiate():
+                _weaken_etag(response)
+            return response
+        if response.status_code < 200 or response.status_code == 204 or not compressible(response.mimetype):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate()
+        if encoding is None:
+            return response
+        compress, flush, finish = compressor(encoding, self.level, self.quality)
+        if response.is_streamed:
+            response.response = _stream(response.response, compress, flush, finish)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(compress(data) + finish())
+        response.headers["Content-Encoding"] = encoding
+        _weaken_etag(response)
+        return response
+
+
+def _stream(chunks, compress, flush, finish):
+    """Yields the compressed chunks of a streamed body as they are produced"""
+    try:
+        for chunk in chunks:
+            data = compress(chunk.encode() if isinstance(chunk, str) else chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def _weaken_etag(response):
+    """Marks a strong ETag weak, since the bytes are not the original ones"""
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+# Configured by create_app()
+compression = Compression()
@@ -0,0 +1,175 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Promotion Query Filters
+
+This module turns listing filters into a single composed query so that the
+database does the filtering instead of the caller. Filters can come from a
+query string or from a JSON document and every filter narrows the previous
+one, for example ``?product_id=7&active=true&active_on=2024-12-25``
+
+It also validates the changes a bulk update applies to the matched rows.
+"""
+from datetime import date
+from service.models import Promotions, Type, DataValidationError
+
+
+######################################################################
+# Value parsers
+######################################################################
+def parse_type(value):
+    """Returns the Type named by value"""
+    try:
+        return Type[value]
+    except KeyError as error:
+        raise DataValidationError(f"Invalid type: {value}") from error
+
+
+def parse_int(value):
+    """Returns value as an integer"""
+    if isinstance(value, bool):
+        raise DataValidationError(f"Invalid integer: {value}")
+    try:
+        return int(value)
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid integer: {value}") from error
+
+
+def parse_bool(value):
+    """Returns value as a boolean"""
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("true", "1", "yes"):
+        return True
+    if str(value).lower() in ("false", "0", "no"):
+        return False
+    raise DataValidationError(f"Invalid boolean: {value}")
+
+
+def parse_date(value):
+    """Returns value as a date"""
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid date: {value}") from error
+
+
+######################################################################
+# Filters: name -> (parser, applies the parsed value to a query, multi)
+######################################################################
+FILTERS = {
+    "promo_id": (parse_int, Promotions.find_by_ids, True),
+    "type": (parse_type, Promotions.find_by_type, False),
+    "product_id": (parse_int, Promotions.find_by_product_id, True),
+    "active": (parse_bool, Promotions.find_by_active, False),
+    "cust_promo_code": (str, Promotions.find_by_cust_promo_code, False),
+    "active_on": (parse_date, Promotions.find_active_on, False),
+    "start_date": (
+        parse_date,
+        lambda start, query: Promotions.find_by_date_range(start=start, query=query),
+        False,
+    ),
+    "end_date": (
+        parse_date,
+        lambda end, query: Promotions.find_by_date_range(end=end, query=query),
+        False,
+    ),
+}
+
+
+def filter_promotions(args, blank=True):
+    """Returns a query for the Promotions matching every filter in args
+
+    Args:
+        args (dict): filter names mapped to a value or list of values, as
+            returned by ``request.args.to_dict(flat=False)`` or a JSON body
+        blank (bool): True to ignore empty values, False to refuse them
+
+    Returns:
+        the composed Query, or None if args contains no filters
+    """
+    query = None
+    for name, (parser, apply, multi) in FILTERS.items():
+        if name not in args:
+            continue
+        values = args[name]
+        if not isinstance(values, list):
+            values = [values]
+        if not blank and (not values or any(value in ("", None) for value in values)):
+            raise DataValidationError(f"Empty value for filter: {name}")
+        # blank form fields are sent as empty parameters, so they match anything
+        values = [value for value in values if value != ""]
+        if not values:
+            continue
+        if multi:
+            parsed = [parser(value) for value in values]
+            value = parsed if len(parsed) > 1 else parsed[0]
+        else:
+            value = parser(values[-1])
+        query = apply(value, query=query)
+    return query
+
+
+def check_filter_names(args, allowed=()):
+    """Raises DataValidationError for a key of args that is not a filter
+
+    Bulk changes call it so that a misspelled filter is refused rather than
+    ignored, which would change more rows than the caller asked for.
+
+    Args:
+        args (dict): the filters, as for filter_promotions()
+        allowed (tuple): other keys that may be present, like return_ids
+    """
+    unknown = sorted(name for name in args if name not in FILTERS and name not in allowed)
+    if unknown:
+        raise DataValidationError(
+            f"Unknown filter(s): {', '.join(unknown)}. Valid filters are: {', '.join(FILTERS)}"
+        )
+
+
+######################################################################
+# Changes a bulk update may make: name -> (parser, nullable)
+######################################################################
+CHANGES = {
+    "type": (parse_type, False),
+    "value": (parse_int, True),
+    "quantity": (parse_int, False),
+    "start_date": (parse_date, False),
+    "end_date": (parse_date, False),
+    "active": (parse_bool, False),
+    "product_id": (parse_int, True),
+}
+
+
+def parse_changes(changes):
+    """Returns the validated column values for a bulk update
+
+    Args:
+        changes (dict): new values by field name, as sent in a JSON body
+    """
+    if not isinstance(changes, dict) or not changes:
+        raise DataValidationError("Changes must be a non-empty JSON object")
+    values = {}
+    for name, value in changes.items():
+        if name not in CHANGES:
+            raise DataValidationError(f"Invalid change: {name} cannot be updated in bulk")
+        parser, nullable = CHANGES[name]
+        if value is None and nullable:
+            values[name] = None
+        else:
+            values[name] = parser(value)
+    return values
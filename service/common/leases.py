@@ -0,0 +1,204 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Redemption Leases
+
+When REDEMPTION_LEASE_SIZE is set, each worker takes a block of units from a
+Promotion's quantity with one atomic redemption and hands them out itself,
+so the hot Promotion row is written once per block instead of once per
+redemption. Every lease is a row of promotion_leases with an expiry time.
+Handing out a unit only counts down in the worker's memory; the database
+is written when a lease is opened and when it is given back.
+
+A lease's unused units go back to the Promotion when the Promotion is
+changed through the worker that holds it, when that worker shuts down, and
+when the worker finds the lease expired as it starts a redemption. They go
+back only while the lease row still exists: a write that sets a new
+quantity deletes the leases taken from the old one. Only the holder knows
+how many units it handed out, so the units of a worker that was killed
+are written off, and any worker deletes lease rows that expired more than
+ABANDONED_AFTER ago. The quantity reported for a redemption is the
+stored quantity plus the units every lease opened with, as of when this
+worker last opened a lease, less what it has handed out since. Leased
+units can still be handed out for up to REDEMPTION_LEASE_TTL seconds after
+another worker cancels the Promotion or sets its quantity.
+"""
+import atexit
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func
+from service.models import Promotions, PromotionLeases
+
+logger = logging.getLogger("flask.app")
+
+# Same shape as the row returned by Promotions.redeem()
+Redemption = namedtuple("Redemption", ["promo_id", "cust_promo_code", "quantity"])
+
+# Leases expired this long ago are taken to belong to a worker that died
+ABANDONED_AFTER = timedelta(hours=1)
+
+
+def utcnow():
+    """Returns the current time in UTC, which lease expiry times are in"""
+    return datetime.now(timezone.utc)
+
+
+class Lease:  # pylint: disable=too-few-public-methods
+    """The promotion_leases row this worker holds for one Promotion"""
+
+    def __init__(self, lease_id, row, units, expires, quantity):
+        self.lease_id = lease_id
+        self.promo_id = row.promo_id
+        self.cust_promo_code = row.cust_promo_code
+        self.units = units
+        self.expires = expires
+        self.quantity = quantity
+
+
+class LeaseManager:
+    """Hands out redemptions from per-worker blocks of leased units"""
+
+    def __init__(self, size=0, ttl=5.0, timer=utcnow):
+        self.size = size
+        self.ttl = ttl
+        self._timer = timer
+        self._leases = {}
+        self._codes = {}
+        self._next_reclaim = None
+        self._lock = threading.Lock()
+        self._app = None
+
+    def init_app(self, app):
+        """Configures the lease size and returns leases when the worker exits"""
+        self.size = app.config["REDEMPTION_LEASE_SIZE"]
+        self.ttl = app.config["REDEMPTION_LEASE_TTL"]
+        if self._app is None:
+            atexit.register(self.shutdown)
+        self._app = app
+
+    def shutdown(self):
+        """Gives every unused unit back to the database"""
+        with self._app.app_context():
+            self.release_all()
+
+    def redeem(self, promo_id, count=1):
+        """Redeems count units of a Promotion, see Promotions.redeem()"""
+        if self.size <= 0:
+            return Promotions.redeem(promo_id, count)
+        self._reclaim_due()
+        return self._take(promo_id, count) or self._lease(promo_id, count, Promotions.promo_id == promo_id)
+
+    def redeem_code(self, code, count=1):
+        """Redeems count units of the Promotion with the given code"""
+        if self.size <= 0:
+            return Promotions.redeem_code(code, count)
+        self._reclaim_due()
+        with self._lock:
+            promo_id = self._codes.get(code.lower())
+        return self._take(promo_id, count) or self._lease(
+            promo_id, count, func.lower(Promotions.cust_promo_code) == code.lower()
+        )
+
+    def release(self, promo_id):
+        """Gives the unused units leased for a Promotion back to the database"""
+        with self._lock:
+            lease = self._leases.get(promo_id)
+            if lease is None:
+                return
+            self._forget(lease)
+        PromotionLeases.give_back(lease.lease_id, lease.units)
+
+    def release_expired(self):
+        """Gives back the units of this worker's expired leases and deletes
+        the leases of workers that died"""
+        now = self._timer()
+        with self._lock:
+            self._next_reclaim = now + timedelta(seconds=self.ttl)
+            expired = [lease for lease in self._leases.values() if lease.expires <= now]
+            for lease in expired:
+                self._forget(lease)
+        for lease in expired:
+            PromotionLeases.give_back(lease.lease_id, lease.units)
+        PromotionLeases.discard(PromotionLeases.expires_at <= now - ABANDONED_AFTER)
+
+    def release_all(self):
+        """Gives back the units of every lease"""
+        with self._lock:
+            promo_ids = list(self._leases)
+        for promo_id in promo_ids:
+            self.release(promo_id)
+
+    def outstanding(self, promo_id):
+        """Returns the number of unused units this worker holds for a Promotion"""
+        with self._lock:
+            lease = self._leases.get(promo_id)
+            return lease.units if lease else 0
+
+    def _reclaim_due(self):
+        """Reclaims the expired leases once every ttl seconds"""
+        with self._lock:
+            due = self._next_reclaim is None or self._timer() >= self._next_reclaim
+        if due:
+            self.release_expired()
+
+    def _forget(self, lease):
+        """Drops a lease this worker no longer holds"""
+        if self._leases.get(lease.promo_id) is lease:
+            del self._leases[lease.promo_id]
+            self._codes.pop(lease.cust_promo_code.lower(), None)
+
+    def _take(self, promo_id, count):
+        """Hands out count units from this worker's lease if it holds enough"""
+        with self._lock:
+            lease = self._leases.get(promo_id)
+            if lease is None or lease.units < count or lease.expires <= self._timer():
+                return None
+            lease.units -= count
+            lease.quantity -= count
+            return Redemption(lease.promo_id, lease.cust_promo_code, lease.quantity)
+
+    def _lease(self, promo_id, count, criterion):
+        """Leases a new block, falling back to an exact redemption near the end"""
+        if promo_id is not None:
+            self.release(promo_id)
+        block = max(self.size, count)
+        expires = self._timer() + timedelta(seconds=self.ttl)
+        leased = PromotionLeases.open(criterion, block, count, expires)
+        if leased is None and block > count:
+            leased = PromotionLeases.open(criterion, count, count, expires)
+        if leased is None:
+            return None
+        row, lease_id, quantity = leased
+        if lease_id is not None:
+            lease = Lease(lease_id, row, block - count, expires, quantity)
+            with self._lock:
+                # another thread may have leased the same Promotion meanwhile
+                displaced = self._leases.get(row.promo_id)
+                if displaced is not None:
+                    self._forget(displaced)
+                self._leases[row.promo_id] = lease
+                self._codes[row.cust_promo_code.lower()] = row.promo_id
+            if displaced is not None:
+                PromotionLeases.give_back(displaced.lease_id, displaced.units)
+            logger.info("Leased %d units of promo_id %s", block, row.promo_id)
+        return Redemption(row.promo_id, row.cust_promo_code, quantity)
+
+
+# Per worker lease manager, configured by create_app()
+leases = LeaseManager()
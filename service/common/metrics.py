@@ -0,0 +1,185 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Metrics
+
+Every request is counted by route and status, and its latency, number of
+SQL statements and time spent in SQL go into histograms by route. The
+statements are timed with SQLAlchemy cursor events. GET /metrics returns
+everything in the Prometheus text format.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory before
+the workers start (see gunicorn.conf.py). Each worker then writes its
+samples to memory-mapped files there, and a scrape of any worker returns
+the sum over all of them.
+
+Recording a request takes around ten microseconds. The labelled children
+of each route are looked up once and kept, and the request's timing lives
+in a context variable rather than flask.g.
+"""
+import os
+import time
+from collections import namedtuple
+from contextvars import ContextVar
+from flask import request
+from sqlalchemy import event
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from service.models import db
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+LABELS = ["method", "route"]
+
+REQUESTS = Counter("promotions_http_requests", "HTTP requests handled", LABELS + ["status"])
+LATENCY = Histogram(
+    "promotions_http_request_duration_seconds", "Time to handle a request", LABELS, buckets=LATENCY_BUCKETS
+)
+IN_PROGRESS = Gauge(
+    "promotions_http_requests_in_progress", "Requests being handled", LABELS, multiprocess_mode="livesum"
+)
+QUERIES = Histogram(
+    "promotions_http_request_db_queries", "SQL statements executed per request", LABELS, buckets=QUERY_BUCKETS
+)
+DB_TIME = Histogram(
+    "promotions_http_request_db_seconds", "Time spent executing SQL per request", LABELS, buckets=LATENCY_BUCKETS
+)
+
+# The labelled metrics of one (method, route)
+Children = namedtuple("Children", ["latency", "in_progress", "queries", "db_time"])
+
+
+class Timing:  # pylint: disable=too-few-public-methods
+    """What is known about the request being handled"""
+
+    __slots__ = ("key", "children", "start", "status", "queries", "db_seconds")
+
+    def __init__(self, key, children):
+        self.key = key
+        self.children = children
+        self.status = 500
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.start = time.perf_counter()
+
+
+# The Timing of the request handled in this context
+_current = ContextVar("promotions_timing", default=None)
+
+
+class RequestMetrics:
+    """Records the metrics of every request an app handles"""
+
+    def __init__(self):
+        self.enabled = False
+        self._children = {}
+        self._counters = {}
+
+    def init_app(self, app):
+        """Hooks into the app's requests and its engines' statements"""
+        self.enabled = app.config["METRICS_ENABLED"]
+        if not self.enabled:
+            return
+        app.before_request(self.start)
+        app.after_request(self.status)
+        app.teardown_request(self.finish)
+        with app.app_context():
+            for engine in db.engines.values():
+                self.watch(engine)
+
+    @staticmethod
+    def watch(engine):
+        """Times the statements of an engine, once however often it is called"""
+        if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    def start(self):
+        """Marks a request as in progress"""
+        rule = request.url_rule
+        self.begin(request.method, rule.rule if rule else "unmatched")
+
+    def begin(self, method, route):
+        """Marks a request to a route as in progress, also for the ASGI app"""
+        key = (method, route)
+        children = self._children.get(key)
+        if children is None:
+            children = Children(
+                LATENCY.labels(*key), IN_PROGRESS.labels(*key), QUERIES.labels(*key), DB_TIME.labels(*key)
+            )
+            self._children[key] = children
+        children.in_progress.inc()
+        _current.set(Timing(key, children))
+
+    @staticmethod
+    def status(response):
+        """Remembers the status of the response for finish()"""
+        timing = _current.get()
+        if timing is not None:
+            timing.status = response.status_code
+        return response
+
+    def end(self, status_code):
+        """Records a request the ASGI app answered with status_code"""
+        timing = _current.get()
+        if timing is not None:
+            timing.status = status_code
+        self.finish()
+
+    def finish(self, _error=None):
+        """Records a request once it is over, streamed bodies included"""
+        timing = _current.get()
+        if timing is None:
+            return
+        _current.set(None)
+        children = timing.children
+        children.latency.observe(time.perf_counter() - timing.start)
+        children.in_progress.dec()
+        children.queries.observe(timing.queries)
+        children.db_time.observe(timing.db_seconds)
+        counter_key = (*timing.key, timing.status)
+        counter = self._counters.get(counter_key)
+        if counter is None:
+            counter = self._counters[counter_key] = REQUESTS.labels(*counter_key)
+        counter.inc()
+
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    if _current.get() is not None:
+        conn.info["metrics_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    timing = _current.get()
+    started = conn.info.pop("metrics_started", None)
+    if timing is not None and started is not None:
+        timing.queries += 1
+        timing.db_seconds += time.perf_counter() - started
+
+
+def render():
+    """Returns every metric in the Prometheus text format, summed over all
+    the workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+# Configured by create_app()
+metrics = RequestMetrics()
@@ -0,0 +1,329 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Schema Migrations
+
+The schema is built by the numbered migrations in MIGRATIONS and each one
+that has run is recorded in the schema_migrations table. ``flask db-upgrade``
+runs the pending ones once per deploy, for example from the Kubernetes job
+in k8s/migrate.yaml. A worker only reads the current version when it starts
+and refuses to run on an older schema, unless DB_MIGRATE_ON_BOOT lets it
+upgrade the database itself as development and tests do.
+
+Every migration describes the schema as it was at that version, so a later
+change to the models never rewrites history. A new migration appends to
+MIGRATIONS with the next version. Transactional migrations run in one
+transaction with their record. The others, like CREATE INDEX CONCURRENTLY
+on PostgreSQL, run in autocommit mode and must be safe to run again after
+a failure, so they use IF NOT EXISTS and drop the invalid indexes left
+behind by an interrupted build. A migration that cannot run on the data it
+finds raises MigrationError before it changes anything.
+
+A database that the code before the migrations built with db.create_all()
+is adopted: the first migration leaves its promotions table alone and the
+third adds what that table is missing.
+
+On PostgreSQL the runner holds an advisory lock, so two runners never
+overlap, and lifts the statement_timeout for its own connection.
+"""
+import time
+import logging
+from collections import namedtuple
+from datetime import datetime, timezone
+from sqlalchemy import (
+    BigInteger, Boolean, Column, Date, DateTime, Enum, Index, Integer, MetaData, Sequence, String, Table, func, inspect,
+    select, text
+)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger("flask.app")
+
+# An arbitrary key for pg_advisory_lock() shared by every migration runner
+LOCK_KEY = 7305316
+
+Migration = namedtuple("Migration", ["version", "name", "upgrade", "transactional"])
+
+history = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    history,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+
+class SchemaError(Exception):
+    """Raised when the database schema is older than the code"""
+
+
+class MigrationError(Exception):
+    """Raised when a migration cannot run on the data in the database"""
+
+
+######################################################################
+# Migrations
+######################################################################
+def _promotions(metadata):
+    """The promotions table as the first migration created it"""
+    return Table(
+        "promotions",
+        metadata,
+        Column("promo_id", Integer, primary_key=True),
+        Column("cust_promo_code", String(63), nullable=False),
+        Column("type", Enum("PERCENT", "SAVING", "BOGO", name="type"), nullable=False),
+        Column("value", Integer, nullable=True),
+        Column("quantity", Integer, nullable=False),
+        Column("start_date", Date, nullable=True),
+        Column("end_date", Date, nullable=True),
+        Column("active", Boolean, nullable=False),
+        Column("product_id", Integer, nullable=True),
+        Column("dev_created_at", Date, nullable=False),
+        Column("version", Integer, nullable=False, server_default="1"),
+    )
+
+
+def create_promotions(conn):
+    """Creates the promotions table and the sequence that numbers changes"""
+    metadata = MetaData()
+    _promotions(metadata)
+    Sequence("promotions_change_version_seq", metadata=metadata)
+    metadata.create_all(conn, checkfirst=True)
+
+
+def index_promotions(conn):
+    """Builds the promotions indexes, online on PostgreSQL"""
+    _check_unique_codes(conn)
+    table = _promotions(MetaData())
+    columns = table.c
+    online = {"postgresql_concurrently": True}
+    indexes = [
+        Index("ix_promotions_start_date_promo_id", columns.start_date, columns.promo_id, **online),
+        Index("ix_promotions_end_date_promo_id", columns.end_date, columns.promo_id, **online),
+        Index("ix_promotions_dev_created_at_promo_id", columns.dev_created_at, columns.promo_id, **online),
+        Index("ix_promotions_type_promo_id", columns.type, columns.promo_id, **online),
+        Index("ix_promotions_product_id_active", columns.product_id, columns.active, **online),
+        Index("ux_promotions_cust_promo_code_lower", func.lower(columns.cust_promo_code), unique=True, **online),
+        Index(
+            "ix_promotions_active_window",
+            columns.start_date,
+            columns.end_date,
+            postgresql_where=text("active"),
+            sqlite_where=text("active"),
+            **online,
+        ),
+    ]
+    for index in indexes:
+        if conn.dialect.name == "postgresql":
+            _drop_invalid(conn, index.name)
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _check_unique_codes(conn):
+    """Raises MigrationError when codes repeat, ignoring case, which would
+    fail the unique index on lower(cust_promo_code)"""
+    duplicates = conn.execute(
+        text(
+            "SELECT lower(cust_promo_code) FROM promotions GROUP BY lower(cust_promo_code) "
+            "HAVING count(*) > 1 ORDER BY 1 LIMIT 10"
+        )
+    ).scalars().all()
+    if duplicates:
+        raise MigrationError(
+            "Promotions share a cust_promo_code, ignoring case, so the unique index cannot be built. "
+            f"Rename or remove the duplicates of: {', '.join(duplicates)}"
+        )
+
+
+def _drop_invalid(conn, name):
+    """Drops an index that an interrupted CREATE INDEX CONCURRENTLY left invalid"""
+    invalid = conn.execute(
+        text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+        ),
+        {"name": name},
+    ).first()
+    if invalid:
+        logger.warning("Dropping the invalid index %s left by an interrupted build", name)
+        conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def version_promotions(conn):
+    """Adds the version column and the change sequence to a promotions table
+    built before the migrations, which has neither"""
+    columns = {column["name"] for column in inspect(conn).get_columns("promotions")}
+    if "version" not in columns:
+        conn.exec_driver_sql("ALTER TABLE promotions ADD COLUMN version INTEGER DEFAULT 1 NOT NULL")
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("CREATE SEQUENCE IF NOT EXISTS promotions_change_version_seq")
+
+
+def create_promotion_leases(conn):
+    """Creates the table that records the units each worker has leased"""
+    metadata = MetaData()
+    Table(
+        "promotion_leases",
+        metadata,
+        Column("lease_id", Integer, primary_key=True),
+        Column("promo_id", Integer, nullable=False),
+        Column("units", Integer, nullable=False),
+        Column("expires_at", DateTime(timezone=True), nullable=False),
+        Index("ix_promotion_leases_promo_id", "promo_id"),
+        Index("ix_promotion_leases_expires_at", "expires_at"),
+    )
+    metadata.create_all(conn, checkfirst=True)
+
+
+def create_promotion_changes(conn):
+    """Creates the list version row that every write raises. It starts from
+    the time in milliseconds, so a rebuilt database does not repeat the
+    versions, and the ETags, of the one before"""
+    metadata = MetaData()
+    changes = Table(
+        "promotion_changes",
+        metadata,
+        Column("change_id", Integer, primary_key=True, autoincrement=False),
+        Column("version", BigInteger, nullable=False),
+    )
+    metadata.create_all(conn, checkfirst=True)
+    if conn.execute(select(changes.c.change_id)).first() is None:
+        conn.execute(changes.insert().values(change_id=1, version=int(time.time() * 1000)))
+
+
+def log_promotion_changes(conn):
+    """Replaces the list version row, which made every write wait on its
+    lock, with a log of writes numbered by a sequence. The numbers go on from
+    the old version, so no ETag is reused"""
+    metadata = MetaData()
+    log = Table(
+        "promotion_change_log",
+        metadata,
+        Column("change_id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True),
+    )
+    metadata.create_all(conn, checkfirst=True)
+    if conn.execute(select(log.c.change_id)).first() is None:
+        start = conn.exec_driver_sql("SELECT max(version) FROM promotion_changes").scalar()
+        start = start or int(time.time() * 1000)
+        conn.execute(log.insert().values(change_id=start))
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT setval(pg_get_serial_sequence('promotion_change_log', 'change_id'), :start)"),
+                         {"start": start})
+    conn.exec_driver_sql("DROP TABLE IF EXISTS promotion_changes")
+
+
+MIGRATIONS = (
+    Migration(1, "create promotions", create_promotions, True),
+    Migration(2, "index promotions", index_promotions, False),
+    Migration(3, "version promotions", version_promotions, True),
+    Migration(4, "create promotion leases", create_promotion_leases, True),
+    Migration(5, "create promotion changes", create_promotion_changes, True),
+    Migration(6, "log promotion changes", log_promotion_changes, True),
+)
+
+LATEST = MIGRATIONS[-1].version
+
+
+######################################################################
+# Runner
+######################################################################
+def current_version(conn):
+    """Returns the version of the schema, 0 for an empty database"""
+    try:
+        version = conn.execute(select(func.max(schema_migrations.c.version))).scalar()
+    except DBAPIError:
+        conn.rollback()
+        if conn.dialect.has_table(conn, schema_migrations.name):
+            raise
+        return 0
+    return version or 0
+
+
+def upgrade(engine, target=LATEST):
+    """Runs the migrations up to target that have not run yet
+
+    Returns:
+        a list with the versions that ran
+    """
+    postgresql = engine.dialect.name == "postgresql"
+    applied = []
+    with engine.connect() as conn:
+        if postgresql:
+            conn.exec_driver_sql("SET statement_timeout = 0")
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": LOCK_KEY})
+        try:
+            schema_migrations.create(conn, checkfirst=True)
+            version = current_version(conn)
+            conn.commit()
+            for migration in MIGRATIONS:
+                if version < migration.version <= target:
+                    _run(conn, migration)
+                    applied.append(migration.version)
+        finally:
+            if postgresql:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+                conn.exec_driver_sql("RESET statement_timeout")
+                conn.commit()
+    return applied
+
+
+def _run(conn, migration):
+    """Runs one migration and records it"""
+    logger.info("Migrating the schema to version %d: %s", migration.version, migration.name)
+    record = schema_migrations.insert().values(
+        version=migration.version, name=migration.name, applied_at=datetime.now(timezone.utc)
+    )
+    if migration.transactional:
+        with conn.begin():
+            migration.upgrade(conn)
+            conn.execute(record)
+        return
+    conn.execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        migration.upgrade(conn)
+        conn.execute(record)
+        conn.commit()
+    finally:
+        conn.rollback()
+        conn.execution_options(isolation_level=conn.default_isolation_level)
+
+
+def check(engine, migrate=False, strict=True):
+    """Makes sure the schema is current when a worker starts
+
+    Reads the schema version, which is a single cheap query. An older schema
+    is upgraded when migrate is True, otherwise it raises SchemaError, or
+    only logs a warning when strict is False as for CLI commands.
+
+    Returns:
+        the version of the schema
+    """
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if version >= LATEST:
+        if version > LATEST:
+            logger.warning("The schema is at version %d, newer than this code's %d", version, LATEST)
+        return version
+    if migrate:
+        upgrade(engine)
+        return LATEST
+    message = f"The schema is at version {version} but this code needs {LATEST}, run flask db-upgrade"
+    if strict:
+        raise SchemaError(message)
+    logger.warning(message)
+    return version
@@ -0,0 +1,77 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Keyset Pagination Helpers
+
+This module encodes and decodes the opaque cursors handed out by paginated
+listings. A cursor records the sort order and the key of the last row on a
+page so the next page can seek straight to it.
+"""
+import json
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date
+from service.models import DataValidationError, SORT_KEYS
+
+
+def parse_sort(sort):
+    """Splits a sort parameter like "-end_date" into (key, descending)"""
+    sort = sort or "promo_id"
+    descending = sort.startswith("-")
+    key = sort.lstrip("-")
+    if key not in SORT_KEYS:
+        raise DataValidationError(
+            f"Invalid sort key '{key}', must be one of: {', '.join(SORT_KEYS)}"
+        )
+    return key, descending
+
+
+def encode_cursor(sort, key):
+    """Returns an opaque cursor for the row with the given sort key"""
+    values = [value.isoformat() if isinstance(value, date) else value for value in key]
+    payload = json.dumps({"s": sort, "k": values}, separators=(",", ":"))
+    return urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def row_key(row, sort):
+    """Returns the keyset position of a Promotion, or a row of its columns"""
+    if sort == "promo_id":
+        return (row.promo_id,)
+    return (getattr(row, sort), row.promo_id)
+
+
+def _is_id(value):
+    """Returns True for an integer promo_id, which a bool is not"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor, sort):
+    """Returns the row key recorded in a cursor created for the same sort"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(urlsafe_b64decode(padded.encode("ascii")))
+        values = payload["k"]
+        single = sort.lstrip("-") == "promo_id"
+        if payload["s"] != sort or len(values) != (1 if single else 2):
+            raise ValueError("cursor does not match the requested sort")
+        if not all(_is_id(value) for value in values[-1:]):
+            raise ValueError("cursor promo_id is not an integer")
+        if not single:
+            values[0] = date.fromisoformat(values[0])
+        return tuple(values)
+    except (ValueError, TypeError, KeyError, binascii.Error) as error:
+        raise DataValidationError(f"Invalid cursor: {cursor}") from error
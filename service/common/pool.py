@@ -0,0 +1,113 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Connection Pool Telemetry
+
+The engine's connections come from a MeteredQueuePool, a QueuePool that
+also times how long each checkout waited for a free connection and counts
+the checkouts that gave up after pool_timeout. pool_stats() reports those
+numbers together with the pool's current size, checked-out connections and
+overflow, so the pool can be sized against PostgreSQL's max_connections.
+"""
+import time
+import threading
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class CheckoutStats:  # pylint: disable=too-few-public-methods
+    """Running totals of the checkouts from one pool"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, waited, timed_out=False):
+        """Adds one checkout that waited for the given seconds"""
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that keeps CheckoutStats"""
+
+    def __init__(self, creator, *args, **kwargs):
+        super().__init__(creator, *args, **kwargs)
+        self.checkout_stats = CheckoutStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.checkout_stats.record(time.perf_counter() - start)
+        return connection
+
+
+class MeteredAsyncQueuePool(MeteredQueuePool, AsyncAdaptedQueuePool):
+    """The MeteredQueuePool of an async engine, see service.asgi"""
+
+
+def init_app(app):
+    """Makes the engine use a MeteredQueuePool, called before db.init_app()
+
+    SQLite in memory runs on a single connection, so the pool options are
+    dropped for it instead.
+    """
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        for name in ("pool_size", "max_overflow", "pool_timeout", "pool_recycle"):
+            options.pop(name, None)
+        return
+    options.setdefault("poolclass", MeteredQueuePool)
+
+
+def pool_stats(engine):
+    """Returns the current state of an engine's connection pool
+
+    Returns:
+        a dictionary with the configured ``size``, the connections
+        ``checked_out`` now and how many of them are ``overflow``, and since
+        the worker started: ``checkouts``, ``timeouts``, and the total
+        ``wait_seconds`` and ``max_wait_seconds`` spent waiting for one
+    """
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=max(0, pool.overflow()))
+    if isinstance(pool, MeteredQueuePool):
+        checkout = pool.checkout_stats
+        with checkout.lock:
+            stats.update(
+                checkouts=checkout.checkouts,
+                timeouts=checkout.timeouts,
+                wait_seconds=checkout.wait_seconds,
+                max_wait_seconds=checkout.max_wait_seconds,
+            )
+    return stats
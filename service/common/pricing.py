@@ -0,0 +1,186 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cart Pricing
+
+This module prices a cart against the live Promotions. The Promotions that
+are active today and still have quantity left are compiled once into an
+index of product_id -> Promotions, so evaluating a cart only looks up its
+own products and never touches the database.
+
+Discounts per line of ``quantity`` units at ``unit_price``:
+
+PERCENT - value percent off the line
+SAVING  - value off each unit, up to the unit price
+BOGO    - every second unit is free
+
+Promotions do not stack, each line gets the one with the biggest discount.
+"""
+import time
+import logging
+import threading
+from datetime import date
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+from service.models import Promotions, Type, DataValidationError, promotions_changed
+
+logger = logging.getLogger("flask.app")
+
+CENT = Decimal("0.01")
+
+# The columns of a Promotion that pricing needs
+Offer = namedtuple("Offer", ["promo_id", "cust_promo_code", "type", "value"])
+
+
+def discount(promo_type, value, quantity, unit_price):
+    """Returns the discount a Promotion gives a line, rounded to the cent
+
+    Args:
+        promo_type (Type): the type of the Promotion
+        value (int): the value of the Promotion, None counts as 0
+        quantity (int): the number of units on the line
+        unit_price (Decimal): the price of one unit
+    """
+    value = Decimal(value or 0)
+    if promo_type == Type.PERCENT:
+        amount = unit_price * quantity * min(value, 100) / 100
+    elif promo_type == Type.SAVING:
+        amount = min(value, unit_price) * quantity
+    else:
+        amount = unit_price * (quantity // 2)
+    return max(amount, Decimal(0)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class PromotionIndex:
+    """A product_id -> live Offers index that is rebuilt when it goes stale"""
+
+    def __init__(self, ttl=60.0, timer=time.monotonic):
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._offers = None
+        self._expires = 0.0
+        self._day = None
+
+    def invalidate(self, *_args, **kwargs):
+        """Forces a rebuild on the next lookup, unless only quantities moved
+        and none of them ran out or came back from zero"""
+        if not kwargs.get("quantity_only") or kwargs.get("crossed_zero"):
+            self._offers = None
+
+    def offers(self):
+        """Returns the product_id -> tuple of Offers index, rebuilding if stale"""
+        offers = self._offers
+        if offers is not None and self._timer() < self._expires and self._day == date.today():
+            return offers
+        with self._lock:
+            if self._offers is offers:
+                self._offers = self._build()
+            return self._offers
+
+    def _build(self):
+        """Reads the live Promotions into a new index"""
+        today = date.today()
+        index = {}
+        for product_id, *offer in live_offers(today):
+            index.setdefault(product_id, []).append(Offer(*offer))
+        logger.info("Compiled %d live promotions for %d products", sum(map(len, index.values())), len(index))
+        self._day = today
+        self._expires = self._timer() + self.ttl
+        return {product_id: tuple(offers) for product_id, offers in index.items()}
+
+
+def live_offers(day):
+    """Returns (product_id, promo_id, cust_promo_code, type, value) rows for
+    the Promotions that are live on day and still have quantity left"""
+    query = Promotions.find_active_on(day).filter(
+        Promotions.quantity > 0, Promotions.product_id.isnot(None)
+    )
+    return query.with_entities(
+        Promotions.product_id,
+        Promotions.promo_id,
+        Promotions.cust_promo_code,
+        Promotions.type,
+        Promotions.value,
+    ).order_by(Promotions.product_id, Promotions.promo_id)
+
+
+def parse_line(line):
+    """Returns a validated (product_id, quantity, unit_price) cart line"""
+    try:
+        product_id, quantity, unit_price = line["product_id"], line["quantity"], line["unit_price"]
+    except (KeyError, TypeError) as error:
+        raise DataValidationError(f"Invalid cart line, it needs product_id, quantity and unit_price: {line}") from error
+    if not isinstance(product_id, int) or isinstance(product_id, bool):
+        raise DataValidationError(f"Invalid product_id: {product_id}")
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+        raise DataValidationError(f"Invalid quantity: {quantity}")
+    if not isinstance(unit_price, (int, float)) or isinstance(unit_price, bool) or unit_price < 0:
+        raise DataValidationError(f"Invalid unit_price: {unit_price}")
+    return product_id, quantity, Decimal(str(unit_price))
+
+
+def evaluate(lines, offers):
+    """Prices a cart and picks the best Promotion for each line
+
+    Args:
+        lines (list): dictionaries with product_id, quantity and unit_price
+        offers (dict): a product_id -> Offers index from PromotionIndex
+
+    Returns:
+        a dictionary with the applicable Promotions and discount of every
+        line and the subtotal, discount and total of the cart
+    """
+    results = []
+    subtotal = best_total = Decimal(0)
+    for line in lines:
+        product_id, quantity, unit_price = parse_line(line)
+        line_subtotal = (unit_price * quantity).quantize(CENT, rounding=ROUND_HALF_UP)
+        applicable = [
+            {
+                "promo_id": offer.promo_id,
+                "cust_promo_code": offer.cust_promo_code,
+                "type": offer.type.name,
+                "discount": discount(offer.type, offer.value, quantity, unit_price),
+            }
+            for offer in offers.get(product_id, ())
+        ]
+        best = max(applicable, key=lambda a: (a["discount"], -a["promo_id"]), default=None)
+        best_discount = best["discount"] if best else Decimal(0)
+        subtotal += line_subtotal
+        best_total += best_discount
+        results.append({
+            "product_id": product_id,
+            "quantity": quantity,
+            "unit_price": float(unit_price),
+            "subtotal": float(line_subtotal),
+            "promotions": [dict(a, discount=float(a["discount"])) for a in applicable],
+            "best_promo_id": best["promo_id"] if best else None,
+            "discount": float(best_discount),
+            "total": float(line_subtotal - best_discount),
+        })
+    return {
+        "lines": results,
+        "subtotal": float(subtotal),
+        "discount": float(best_total),
+        "total": float(subtotal - best_total),
+    }
+
+
+# Per worker index of live Promotions, configured by create_app()
+promotion_index = PromotionIndex()
+promotions_changed.connect(promotion_index.invalidate)
@@ -0,0 +1,179 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+SQL Profiler
+
+An opt-in profile of the SQL each request runs. SQL_PROFILE chooses when:
+
+- ``off``: never, the default
+- ``header``: for requests sent with an ``X-SQL-Profile: 1`` header
+- ``on``: for every request
+
+A profiled request logs every statement with its duration and row count,
+and its response gets a Server-Timing header that splits the time into
+``db`` and ``app``. Statements slower than SQL_SLOW_MS are logged as
+warnings with their plan: ``EXPLAIN (ANALYZE, BUFFERS)`` for a PostgreSQL
+SELECT, plain ``EXPLAIN`` for writes so they are not run twice, and
+``EXPLAIN QUERY PLAN`` on SQLite. The plans are taken on a connection of
+their own once the response is ready, so they do not count in its timings.
+
+ANALYZE runs the query again. Only allow the header on services that
+cannot be reached by untrusted clients.
+"""
+import time
+import logging
+from collections import namedtuple
+from contextvars import ContextVar
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+MODES = ("off", "header", "on")
+HEADER = "X-SQL-Profile"
+
+Statement = namedtuple("Statement", ["engine", "statement", "parameters", "seconds", "rows", "executemany"])
+
+
+class Profile:  # pylint: disable=too-few-public-methods
+    """The statements of one profiled request"""
+
+    __slots__ = ("start", "statements")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = []
+
+    @property
+    def db_seconds(self):
+        """Time spent executing SQL"""
+        return sum(statement.seconds for statement in self.statements)
+
+
+# The Profile of the request handled in this context, None when it is not profiled
+_current = ContextVar("promotions_profile", default=None)
+
+
+class SQLProfiler:
+    """Profiles the SQL of the requests SQL_PROFILE selects"""
+
+    def __init__(self):
+        self.mode = "off"
+        self.slow_seconds = 0.1
+
+    def init_app(self, app):
+        """Hooks into the app's requests and its engines' statements"""
+        self.mode = app.config["SQL_PROFILE"]
+        if self.mode not in MODES:
+            raise ValueError(f"SQL_PROFILE must be one of {', '.join(MODES)}, not {self.mode!r}")
+        self.slow_seconds = app.config["SQL_SLOW_MS"] / 1000
+        if self.mode != "off":
+            app.logger.warning("Profiling SQL (%s), statements over %s ms are explained", self.mode, app.config["SQL_SLOW_MS"])
+        app.before_request(self.start)
+        app.after_request(self.timing)
+        app.teardown_request(self.finish)
+        with app.app_context():
+            for engine in db.engines.values():
+                if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+                    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+                    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    def start(self):
+        """Profiles the request if the mode or its header asks for it"""
+        if self.mode == "off":
+            return
+        if self.mode == "on" or request.headers.get(HEADER, "").lower() in ("1", "true", "on"):
+            _current.set(Profile())
+
+    @staticmethod
+    def timing(response):
+        """Adds the Server-Timing header of a profiled request"""
+        profile = _current.get()
+        if profile is not None:
+            total = time.perf_counter() - profile.start
+            db_seconds = profile.db_seconds
+            response.headers.add(
+                "Server-Timing",
+                f'db;dur={db_seconds * 1000:.2f};desc="{len(profile.statements)} statements", '
+                f"app;dur={max(0.0, total - db_seconds) * 1000:.2f}",
+            )
+        return response
+
+    def finish(self, _error=None):
+        """Logs the statements of a profiled request, explaining the slow ones"""
+        profile = _current.get()
+        if profile is None:
+            return
+        _current.set(None)
+        logger.info(
+            "%s %s ran %d statements in %.2f ms",
+            request.method,
+            request.path,
+            len(profile.statements),
+            profile.db_seconds * 1000,
+        )
+        for statement in profile.statements:
+            logger.info("%.2f ms, %s rows: %s", statement.seconds * 1000, statement.rows, statement.statement)
+            if statement.seconds >= self.slow_seconds and not statement.executemany:
+                logger.warning(
+                    "Slow statement took %.2f ms: %s %s\n%s",
+                    statement.seconds * 1000,
+                    statement.statement,
+                    statement.parameters,
+                    explain(statement.engine, statement.statement, statement.parameters),
+                )
+
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    if _current.get() is not None:
+        conn.info["profile_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, _context, executemany):
+    profile = _current.get()
+    started = conn.info.pop("profile_started", None)
+    if profile is not None and started is not None:
+        seconds = time.perf_counter() - started
+        profile.statements.append(Statement(conn.engine, statement, parameters, seconds, cursor.rowcount, executemany))
+
+
+def explain(engine, statement, parameters=None):
+    """Returns the plan of a statement as text
+
+    A SELECT on PostgreSQL is run again with EXPLAIN (ANALYZE, BUFFERS) for
+    its actual timings. Other statements are only planned.
+    """
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        reads = statement.lstrip().upper().startswith("SELECT")
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if reads else "EXPLAIN "
+    elif dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        return f"(no plan on {dialect})"
+    try:
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(prefix + statement, parameters or None).all()
+    except SQLAlchemyError as error:
+        return f"(no plan: {error})"
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+# Configured by create_app()
+profiler = SQLProfiler()
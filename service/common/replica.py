@@ -0,0 +1,80 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read Replica Routing
+
+When DATABASE_READ_URI is set, the SELECTs of GET and HEAD requests go to
+that read replica and everything else stays on the primary.
+
+A replica may lag behind the primary, so a client that has just written
+must not read from it:
+
+* every successful write response sets a cookie that lasts
+  REPLICA_STICKY_SECONDS, and requests carrying it read from the primary
+* a client that does not keep cookies sends the X-Read-Primary header on
+  the reads that must see its writes
+* once a request has written, its own later reads go to the primary
+
+Only the client that wrote is covered. Other clients can read data as old
+as the replica's lag, and the cookie does not cover a lag longer than
+REPLICA_STICKY_SECONDS.
+"""
+from flask import request
+from service.models import db, REPLICA
+
+COOKIE = "promotions_primary"
+HEADER = "X-Read-Primary"
+
+READS = ("GET", "HEAD")
+
+
+class ReplicaRouter:
+    """Chooses the database each request reads from"""
+
+    def __init__(self, sticky_seconds=5):
+        self.sticky_seconds = sticky_seconds
+
+    def init_app(self, app):
+        """Routes the app's reads once a replica is configured"""
+        self.sticky_seconds = app.config["REPLICA_STICKY_SECONDS"]
+        if REPLICA in app.config["SQLALCHEMY_BINDS"]:
+            app.logger.info("Reading from the replica, sticky for %s seconds after a write", self.sticky_seconds)
+        app.before_request(self.route)
+        app.after_request(self.stick)
+        app.teardown_request(self.reset)
+
+    @staticmethod
+    def route():
+        """Lets a read request use the replica unless its client just wrote
+        or asks for the primary"""
+        primary = COOKIE in request.cookies or request.headers.get(HEADER, "").lower() in ("true", "1", "yes")
+        db.session.info["replica"] = request.method in READS and not primary
+
+    def stick(self, response):
+        """Keeps a client that wrote on the primary for a while"""
+        if request.method not in READS and response.status_code < 400 and self.sticky_seconds > 0:
+            response.set_cookie(COOKIE, "1", max_age=self.sticky_seconds, httponly=True, samesite="Lax")
+        return response
+
+    @staticmethod
+    def reset(_error=None):
+        """Stops using the replica once the request is over"""
+        db.session.info.pop("replica", None)
+
+
+# Configured by create_app()
+replica = ReplicaRouter()
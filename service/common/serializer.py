@@ -0,0 +1,135 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Row Serializer
+
+Listings read the serialized columns of each Promotion as plain row tuples
+instead of ORM instances, which skips the identity map and attribute
+instrumentation, and write each row into a precompiled JSON template instead
+of building a dictionary for json.dumps().
+
+The output is byte for byte what jsonify() sends for Promotions.serialize()
+outside of debug mode: keys sorted, no spaces and non-ASCII escaped. A
+``fields`` selection narrows both the SELECT and the JSON to some columns.
+"""
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from service.models import Promotions, DataValidationError
+
+
+def _boolean(value):
+    return "true" if value else "false"
+
+
+def _number(value):
+    return "null" if value is None else value
+
+
+def _date(value):
+    return value.isoformat()
+
+
+def _name(value):
+    return value.name
+
+
+######################################################################
+# Serialized columns: name -> (placeholder, converter), in the sorted
+# key order that jsonify() writes
+######################################################################
+FORMATS = {
+    "active": ("%s", _boolean),
+    "cust_promo_code": ("%s", encode_basestring_ascii),
+    "dev_created_at": ('"%s"', _date),
+    "end_date": ('"%s"', _date),
+    "product_id": ("%s", _number),
+    "promo_id": ("%s", _number),
+    "quantity": ("%s", _number),
+    "start_date": ('"%s"', _date),
+    "type": ('"%s"', _name),
+    "value": ("%s", _number),
+}
+
+FIELDS = tuple(FORMATS)
+
+TEMPLATE = (
+    '{"active":%s,"cust_promo_code":%s,"dev_created_at":"%s","end_date":"%s","product_id":%s,'
+    '"promo_id":%s,"quantity":%s,"start_date":"%s","type":"%s","value":%s}'
+)
+
+
+def parse_fields(value):
+    """Returns the fields named in a comma separated fields parameter in
+    serialized order, or every field when value is empty"""
+    if not value:
+        return FIELDS
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = sorted(names - set(FIELDS))
+    if unknown:
+        raise DataValidationError(
+            f"Invalid fields '{', '.join(unknown)}', must be some of: {', '.join(FIELDS)}"
+        )
+    return tuple(field for field in FIELDS if field in names) or FIELDS
+
+
+def select_rows(query=None, *extra, fields=FIELDS):
+    """Returns a query for the serialized columns of Promotions as row tuples
+
+    Args:
+        query (Query): an optional query to narrow down (defaults to all)
+        extra (str): more columns to select after the fields, if not in them
+        fields (tuple): the serialized columns to select, from parse_fields()
+    """
+    query = Promotions.query if query is None else query
+    names = fields + tuple(dict.fromkeys(name for name in extra if name not in fields))
+    return query.with_entities(*(getattr(Promotions, name) for name in names))
+
+
+def encode_row(row):
+    """Returns the JSON bytes of a row from select_rows(), less any extra columns"""
+    active, code, created, end, product_id, promo_id, quantity, start, kind, value, *_ = row
+    return (TEMPLATE % (
+        "true" if active else "false",
+        encode_basestring_ascii(code),
+        created.isoformat(),
+        end.isoformat(),
+        "null" if product_id is None else product_id,
+        promo_id,
+        quantity,
+        start.isoformat(),
+        kind.name,
+        "null" if value is None else value,
+    )).encode()
+
+
+@lru_cache(maxsize=256)
+def encoder(fields):
+    """Returns a function that encodes the rows of select_rows(fields=fields)"""
+    if fields == FIELDS:
+        return encode_row
+    template = "{" + ",".join(f'"{field}":{FORMATS[field][0]}' for field in fields) + "}"
+    converters = [FORMATS[field][1] for field in fields]
+
+    def encode(row):
+        return (template % tuple(convert(value) for convert, value in zip(converters, row))).encode()
+
+    return encode
+
+
+def encode_rows(rows, fields=FIELDS):
+    """Returns the JSON array bytes of rows from select_rows()"""
+    return b"[" + b",".join(map(encoder(fields), rows)) + b"]"
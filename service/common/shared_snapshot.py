@@ -0,0 +1,235 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Shared Snapshot Files
+
+A generation of the promotion snapshot is written once to an immutable file
+and memory-mapped read-only by every worker in the pod, so the pages are
+shared instead of each worker holding its own copy. The file holds the JSON
+of every Promotion back to back inside a JSON array, so a listing is the
+whole blob and a single Promotion is a slice of it.
+
+Layout (little endian, 8 byte words):
+
+header      - magic, generation, count, number of codes, blob and codes sizes
+ids         - count promo_ids in ascending order
+versions    - the version of each Promotion
+offsets     - count + 1 offsets of each Promotion in the blob
+code_rows   - for each code in ascending order, the position of its Promotion
+code_starts - number of codes + 1 offsets of each code in the codes blob
+blob        - [{...},{...}] the serialized Promotions
+codes       - the lower case cust_promo_codes
+
+A small control file tells the workers which generation is current, the
+last change version it includes and when it was last confirmed fresh.
+A new generation is written under a temporary name, renamed into place and
+only then announced in the control file, so readers never see a partial one.
+The control file is replaced the same way on every update, and readers only
+re-read it when its inode changes, so they never see a torn record either.
+"""
+import os
+import mmap
+import hashlib
+import struct
+import fcntl
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+MAGIC = b"PROMSNP1"
+HEADER = struct.Struct("<8s5Q")
+# generation, version, confirmed (time.monotonic(), the same for the whole host)
+CONTROL = struct.Struct("<QQd")
+
+# A Promotion read from a snapshot. The body is its JSON, or in the database
+# fallback of the routes the Promotions itself, serialized only when needed
+Entry = namedtuple("Entry", ["promo_id", "version", "body"])
+
+
+class SnapshotFile:
+    """A read-only, memory-mapped generation of the snapshot"""
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        magic, self.generation, count, codes, blob_size, codes_size = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a promotion snapshot")
+        position = HEADER.size
+        self._ids, position = _words(view, position, count)
+        self._versions, position = _words(view, position, count)
+        self._offsets, position = _words(view, position, count + 1)
+        self._code_rows, position = _words(view, position, codes)
+        self._code_starts, position = _words(view, position, codes + 1)
+        self._blob = view[position:position + blob_size]
+        self._codes = view[position + blob_size:position + blob_size + codes_size]
+        self._digest = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, promo_id):
+        """Returns the Entry of a Promotion, or None if there is none"""
+        position = bisect_left(self._ids, promo_id)
+        if position == len(self._ids) or self._ids[position] != promo_id:
+            return None
+        return self._record(position)
+
+    def by_code(self, code):
+        """Returns the Entry of the Promotion with a code (any case), or None"""
+        key = code.lower().encode()
+        position = bisect_left(range(len(self._code_rows)), key, key=self._code)
+        if position == len(self._code_rows) or self._code(position) != key:
+            return None
+        return self._record(self._code_rows[position])
+
+    def list_version(self):
+        """Returns a digest of the listing, computed once per generation"""
+        if self._digest is None:
+            self._digest = digest(self._blob)
+        return self._digest
+
+    def listing(self):
+        """Returns the JSON array of every Promotion in promo_id order"""
+        return bytes(self._blob)
+
+    def _record(self, position):
+        body = bytes(self._blob[self._offsets[position]:self._offsets[position + 1] - 1])
+        return Entry(self._ids[position], self._versions[position], body)
+
+    def _code(self, position):
+        return bytes(self._codes[self._code_starts[position]:self._code_starts[position + 1]])
+
+
+def _words(view, position, count):
+    """Returns count 8 byte integers at position, and the position after them"""
+    end = position + 8 * count
+    return view[position:end].cast("q"), end
+
+
+def digest(listing):
+    """Returns the digest that versions a snapshot's listing"""
+    return hashlib.blake2b(listing, digest_size=12).hexdigest()
+
+
+def write_generation(directory, generation, rows):
+    """Writes a generation file and returns its path
+
+    Args:
+        directory (str): the shared snapshot directory
+        generation (int): the number of the new generation
+        rows (list): (promo_id, lower case code or None, JSON bytes, version)
+            tuples in promo_id order
+    """
+    ids, versions, offsets, blob = array("q"), array("q"), array("q"), bytearray(b"[")
+    for promo_id, _code, record, version in rows:
+        ids.append(promo_id)
+        versions.append(version)
+        offsets.append(len(blob))
+        blob += record + b","
+    if ids:
+        blob[-1:] = b"]"
+    else:
+        blob += b"]"
+    offsets.append(len(blob))
+
+    codes = sorted((row[1].encode(), position) for position, row in enumerate(rows) if row[1])
+    code_rows, code_starts, code_blob = array("q"), array("q", [0]), bytearray()
+    for code, position in codes:
+        code_rows.append(position)
+        code_blob += code
+        code_starts.append(len(code_blob))
+
+    path = os.path.join(directory, f"promotions.{generation}.snap")
+    with open(f"{path}.tmp", "wb") as file:
+        file.write(HEADER.pack(MAGIC, generation, len(ids), len(codes), len(blob), len(code_blob)))
+        for words in (ids, versions, offsets, code_rows, code_starts):
+            file.write(words.tobytes())
+        file.write(blob)
+        file.write(code_blob)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+class SharedStore:
+    """The shared snapshot directory of a pod"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._control = None
+        self._file = None
+        self._lock = None
+
+    def control(self):
+        """Returns the current (generation, version, confirmed), all 0 until
+        the first generation is written"""
+        try:
+            inode = os.stat(os.path.join(self.directory, "control")).st_ino
+        except FileNotFoundError:
+            return 0, 0, 0.0
+        if self._control is None or self._control[1] != inode:
+            self._read_control()
+        return self._control[2]
+
+    def _read_control(self):
+        """Reads the control file that was last renamed into place. The old
+        one stays open until then, so its inode is not reused meanwhile"""
+        # pylint: disable=consider-using-with
+        file = open(os.path.join(self.directory, "control"), "rb")
+        values = CONTROL.unpack(file.read(CONTROL.size))
+        if self._control is not None:
+            self._control[0].close()
+        self._control = (file, os.fstat(file.fileno()).st_ino, values)
+
+    def open(self, generation):
+        """Returns the SnapshotFile of a generation, or None if it is gone"""
+        if self._file is None or self._file.generation != generation:
+            try:
+                self._file = SnapshotFile(os.path.join(self.directory, f"promotions.{generation}.snap"))
+            except OSError:
+                return None
+        return self._file
+
+    def acquire(self):
+        """Blocks until this process is the pod's only snapshot builder"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = open(os.path.join(self.directory, "builder.lock"), "wb")  # pylint: disable=consider-using-with
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+
+    def publish(self, rows, version, confirmed):
+        """Writes rows as the next generation and announces it"""
+        old = self.control()[0]
+        write_generation(self.directory, old + 1, rows)
+        self.announce(old + 1, version, confirmed)
+        if old:
+            # workers that still map the old generation keep their pages
+            try:
+                os.unlink(os.path.join(self.directory, f"promotions.{old}.snap"))
+            except FileNotFoundError:
+                pass
+
+    def confirm(self, version, confirmed):
+        """Marks the current generation fresh as of confirmed"""
+        self.announce(self.control()[0], version, confirmed)
+
+    def announce(self, generation, version, confirmed):
+        """Replaces the control file that every worker reads"""
+        path = os.path.join(self.directory, "control")
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(CONTROL.pack(generation, version, confirmed))
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,362 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Promotion Snapshot
+
+When SNAPSHOT_ENABLED is set on PostgreSQL, each worker keeps every
+Promotion serialized in memory and serves unfiltered reads from it.
+
+Every write sends a NOTIFY on the promotions_changed channel carrying the
+changed promo_ids and a version number from promotions_change_version_seq.
+The NOTIFY runs in the write's own transaction, so PostgreSQL delivers it
+exactly when the write commits and drops it when the write rolls back.
+A listener thread in each worker re-reads just those rows, or the whole
+table when the ids are unknown or too many to send.
+
+The snapshot is only used while it is provably current:
+
+* the listener has confirmed a round trip to the database within the last
+  SNAPSHOT_MAX_STALENESS seconds, and every notification committed before
+  that round trip has been applied
+* every version this worker published has come back through the listener,
+  so a worker always reads its own writes
+* the whole table is re-read at least every SNAPSHOT_RESYNC seconds
+
+Otherwise, for example while the listener is reconnecting, reads go to the
+database as before.
+"""
+import os
+import json
+import time
+import select
+import logging
+import threading
+import psycopg
+from flask import current_app as app
+from sqlalchemy import text, event
+from sqlalchemy.orm import Session
+from service.models import db, Promotions, promotions_changing
+from service.common.shared_snapshot import Entry, SharedStore, digest
+from service.common.serializer import select_rows, encode_row
+
+logger = logging.getLogger("flask.app")
+
+CHANNEL = "promotions_changed"
+
+# Beyond this many ids a notification asks for a full reload instead, which
+# keeps the payload well under the 8000 byte NOTIFY limit
+MAX_NOTIFY_IDS = 500
+
+NOTIFY = text(
+    "WITH change AS (SELECT nextval('promotions_change_version_seq') AS version) "
+    "SELECT version, pg_notify(:channel, json_build_object('version', version, 'ids', CAST(:ids AS json))::text) "
+    "FROM change"
+)
+
+# Session.info key of the versions a transaction has published
+PUBLISHED = "snapshot_versions"
+
+
+class PromotionSnapshot:  # pylint: disable=too-many-instance-attributes
+    """An in-memory copy of the Promotions kept current by LISTEN/NOTIFY"""
+
+    def __init__(self, max_staleness=2.0, resync=300.0, timer=time.monotonic):
+        self.enabled = False
+        self.max_staleness = max_staleness
+        self.resync = resync
+        self.version = 0
+        self.shared = None
+        self._timer = timer
+        self._lock = threading.RLock()
+        self._rows = None
+        self._codes = {}
+        self._listing = None
+        self._changed = False
+        self._loaded = 0.0
+        self._confirmed = None
+        self._awaiting = set()
+        self._uncommitted = set()
+        self._inbox = []
+        self._app = None
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        """Turns the snapshot on for PostgreSQL when SNAPSHOT_ENABLED is set"""
+        self.max_staleness = app.config["SNAPSHOT_MAX_STALENESS"]
+        self.resync = app.config["SNAPSHOT_RESYNC"]
+        with app.app_context():
+            dialect = db.engine.dialect.name
+        self.enabled = app.config["SNAPSHOT_ENABLED"] and dialect == "postgresql"
+        if app.config["SNAPSHOT_ENABLED"] and not self.enabled:
+            app.logger.warning("The promotion snapshot needs PostgreSQL, reads will use %s", dialect)
+        if app.config["SNAPSHOT_SHARED_DIR"]:
+            self.shared = SharedStore(app.config["SNAPSHOT_SHARED_DIR"])
+        self._app = app
+
+    ######################################################################
+    # Reads
+    ######################################################################
+
+    def view(self):
+        """Returns something to serve reads from, or None when the snapshot
+        is not fresh and the database must be read. It has get(promo_id) and
+        by_code(code) returning an Entry, list_version() and listing()
+        returning the JSON array"""
+        if not self.enabled:
+            return None
+        if self._app is not None:
+            self._start()
+        if self.shared is not None:
+            return self._shared_view()
+        return self if self.fresh() else None
+
+    def fresh(self):
+        """Returns True when this worker's own copy is current"""
+        with self._lock:
+            now = self._timer()
+            return (
+                self._rows is not None
+                and not self._awaiting
+                and self._confirmed is not None
+                and now - self._confirmed <= self.max_staleness
+                and now - self._loaded <= self.resync
+            )
+
+    def get(self, promo_id):
+        """Returns the Entry of a Promotion from this worker's copy"""
+        row = self._rows.get(promo_id)
+        return Entry(promo_id, row[2], row[1]) if row else None
+
+    def by_code(self, code):
+        """Returns the Entry of the Promotion with a code from this worker's copy"""
+        return self.get(self._codes.get(code.lower()))
+
+    def list_version(self):
+        """Returns a digest of the listing, which versions exactly what is
+        served from this worker's copy"""
+        return self._listed()[0]
+
+    def listing(self):
+        """Returns the JSON array of this worker's copy in promo_id order"""
+        return self._listed()[1]
+
+    def _listed(self):
+        """Returns the digest and JSON array of the listing, built once per change"""
+        with self._lock:
+            if self._listing is None:
+                listing = b"[" + b",".join(self._rows[key][1] for key in sorted(self._rows)) + b"]"
+                self._listing = digest(listing), listing
+            return self._listing
+
+    def _shared_view(self):
+        """Returns the pod's current SnapshotFile if it is fresh enough"""
+        generation, version, confirmed = self.shared.control()
+        if not generation or self._timer() - confirmed > self.max_staleness:
+            return None
+        with self._lock:
+            if any(published > version for published in self._awaiting):
+                return None
+            self._awaiting.clear()
+        return self.shared.open(generation)
+
+    ######################################################################
+    # Updates
+    ######################################################################
+
+    def load(self):
+        """Reads every Promotion into a new snapshot"""
+        with self._lock:
+            # versions of open transactions are not in the load, wait for them
+            published = self._awaiting - self._uncommitted
+        started = self._timer()
+        rows = dict(map(_row, Promotions.stream(select_rows(None, "version"))))
+        with self._lock:
+            self._rows, self._listing, self._changed = rows, None, True
+            self._codes = {row[0]: promo_id for promo_id, row in rows.items() if row[0]}
+            self._loaded = started
+            # writes published before the load started are already in it
+            self._awaiting -= published
+        logger.info("Loaded %d promotions into the snapshot", len(rows))
+
+    def refresh(self, promo_ids):
+        """Re-reads the given Promotions, dropping the ones that are gone"""
+        found = dict(map(_row, Promotions.find_by_ids(list(promo_ids), select_rows(None, "version"))))
+        with self._lock:
+            for promo_id in promo_ids:
+                old = self._rows.pop(promo_id, None)
+                if old and self._codes.get(old[0]) == promo_id:
+                    del self._codes[old[0]]
+                if promo_id in found:
+                    self._rows[promo_id] = found[promo_id]
+                    self._codes[found[promo_id][0]] = promo_id
+            self._listing, self._changed = None, True
+
+    def apply(self, payloads):
+        """Applies a batch of notification payloads"""
+        versions, promo_ids, reload = set(), set(), self._rows is None
+        for payload in payloads:
+            try:
+                message = json.loads(payload)
+                versions.add(int(message["version"]))
+                ids = message["ids"]
+                if ids is None:
+                    reload = True
+                else:
+                    promo_ids.update(int(promo_id) for promo_id in ids)
+            except (ValueError, TypeError, KeyError):
+                logger.warning("Reloading the snapshot after a bad notification: %s", payload)
+                reload = True
+        if reload:
+            self.load()
+        elif promo_ids:
+            self.refresh(promo_ids)
+        with self._lock:
+            self._awaiting -= versions
+            self.version = max(versions | {self.version})
+
+    def confirm(self, since):
+        """Records that every change committed before since has been applied,
+        and in shared mode hands the changes on to the other workers"""
+        with self._lock:
+            self._confirmed = since
+            if self.shared is None or self._rows is None:
+                return
+            if self._changed:
+                rows = [(promo_id, *self._rows[promo_id]) for promo_id in sorted(self._rows)]
+                self.shared.publish(rows, self.version, since)
+                self._changed = False
+            else:
+                self.shared.confirm(self.version, since)
+
+    def notification(self, promo_ids):
+        """Returns the parameters of NOTIFY for a write that changed
+        promo_ids, or None when there is nothing to send"""
+        if not self.enabled:
+            return None
+        ids = None if promo_ids is None or len(promo_ids) > MAX_NOTIFY_IDS else sorted(set(promo_ids))
+        if ids == []:
+            return None
+        return {"channel": CHANNEL, "ids": json.dumps(ids)}
+
+    def expect(self, version):
+        """Waits for a version sent by a transaction that has not committed,
+        so this worker's reads go to the database until it comes back"""
+        with self._lock:
+            self._awaiting.add(version)
+            self._uncommitted.add(version)
+
+    def settle(self, versions, committed):
+        """Records that the transaction which sent versions has ended. The
+        versions of a rollback were never delivered and are not waited for"""
+        with self._lock:
+            self._uncommitted.difference_update(versions)
+            if not committed:
+                self._awaiting.difference_update(versions)
+
+    def publish(self, _sender, promo_ids=None, session=None, **_kwargs):
+        """Tells every worker's snapshot which Promotions a write changed,
+        from inside the write's transaction before it commits"""
+        params = self.notification(promo_ids)
+        if params is None:
+            return
+        session = db.session if session is None else session
+        version = session.execute(NOTIFY, params).scalar()
+        self.expect(version)
+        session.info.setdefault(PUBLISHED, []).append(version)
+
+    def ended(self, session, committed):
+        """Settles the versions a session's transaction published"""
+        versions = session.info.pop(PUBLISHED, None)
+        if versions:
+            self.settle(versions, committed)
+
+    ######################################################################
+    # Listener thread
+    ######################################################################
+
+    def _start(self):
+        """Starts the listener in this process if it is not running yet"""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            # a forked worker inherits the state but not the thread
+            self._rows, self._confirmed, self._pid = None, None, os.getpid()
+            self._thread = threading.Thread(target=self._run, name="promotion-snapshot", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the listener thread"""
+        self._stop.set()
+
+    def _run(self):
+        """Listens for changes, reconnecting until the worker stops"""
+        url = db.engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        if self.shared is not None:
+            # only one worker per pod keeps the snapshot, the others map its files
+            self.shared.acquire()
+            logger.info("Building the shared promotion snapshot in %s", self.shared.directory)
+        while not self._stop.is_set():
+            try:
+                with self._app.app_context(), psycopg.connect(url, autocommit=True) as conn:
+                    self._listen(conn)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Promotion snapshot listener failed, reading from the database: %s", error)
+            with self._lock:
+                self._confirmed = None
+            self._stop.wait(self.max_staleness)
+
+    def _listen(self, conn):
+        """Applies notifications as they arrive and confirms freshness"""
+        conn.add_notify_handler(lambda notify: self._inbox.append(notify.payload))
+        conn.execute(f"LISTEN {CHANNEL}")
+        self._inbox.clear()
+        self.load()
+        while not self._stop.is_set():
+            select.select([conn], [], [], self.max_staleness / 2)
+            since = self._timer()
+            # notifications committed before this round trip arrive with it
+            conn.execute("SELECT 1")
+            payloads, self._inbox = self._inbox, []
+            self.apply(payloads)
+            if since - self._loaded > self.resync / 2:
+                self.load()
+            db.session.remove()
+            self.confirm(since)
+
+
+def _row(row):
+    """Returns (promo_id, (lower case code, JSON, version)) for a row of
+    select_rows() with the version added"""
+    code = row.cust_promo_code.lower() if row.cust_promo_code else None
+    return row.promo_id, (code, encode_row(row), row.version)
+
+
+def encode(value):
+    """Returns the JSON bytes jsonify() would send for value, less the newline"""
+    return app.json.dumps(value, separators=(",", ":")).encode()
+
+
+# Per worker snapshot, configured by create_app()
+snapshot = PromotionSnapshot()
+promotions_changing.connect(snapshot.publish)
+# every Session, so the asyncio routes' sessions settle their versions too
+event.listen(Session, "after_commit", lambda session: snapshot.ended(session, True))
+event.listen(Session, "after_rollback", lambda session: snapshot.ended(session, False))
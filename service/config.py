@@ -13,7 +13,124 @@ DATABASE_URI = os.getenv(
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-# SQLALCHEMY_POOL_SIZE = 2
+
+# Optional read replica. The reads of GET requests go to it, except for
+# clients that wrote within the last REPLICA_STICKY_SECONDS or that send
+# X-Read-Primary, see service.common.replica
+DATABASE_READ_URI = os.getenv("DATABASE_READ_URI", "")
+SQLALCHEMY_BINDS = {"replica": DATABASE_READ_URI} if DATABASE_READ_URI else {}
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Connection pool of each worker. By default the workers of a pod (gunicorn
+# takes its worker count from WEB_CONCURRENCY) split DB_POD_CONNECTIONS
+# between them, half kept open and half as overflow. Size it so that every
+# pod's connections fit in PostgreSQL's max_connections
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+DB_POD_CONNECTIONS = int(os.getenv("DB_POD_CONNECTIONS", "10"))
+_WORKER_CONNECTIONS = max(2, DB_POD_CONNECTIONS // WEB_CONCURRENCY)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(_WORKER_CONNECTIONS // 2)))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", str(_WORKER_CONNECTIONS - _WORKER_CONNECTIONS // 2)))
+# Seconds to wait for a free connection, and to keep one before replacing it
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Tests each connection with a cheap round trip before handing it out
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "True").lower() in ("true", "1", "yes")
+# PostgreSQL only: milliseconds before a statement is cancelled (0 for no
+# limit), and the number of executions after which psycopg prepares a
+# statement on the server ("none" turns that off, as PgBouncer in transaction
+# mode needs)
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "15000"))
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "5")
+
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+if DATABASE_URI.startswith("postgresql"):
+    SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {
+        "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT}",
+        "prepare_threshold": None if DB_PREPARE_THRESHOLD.lower() == "none" else int(DB_PREPARE_THRESHOLD),
+    }
+
+# Lets a worker run the pending schema migrations when it starts, which is
+# convenient for development and tests, where it is set to True. Production
+# runs "flask db-upgrade" once per deploy, so workers only check the version
+DB_MIGRATE_ON_BOOT = os.getenv("DB_MIGRATE_ON_BOOT", "False").lower() in ("true", "1", "yes")
+
+# Threads of each ASGI worker (asgi.py) that run the routes it hands to Flask
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", "4"))
+
+# Listing pagination. A PAGE_SIZE_DEFAULT of 0 returns the whole list unless
+# the client asks for a page with limit or cursor; that list is streamed
+# STREAM_BATCH_SIZE rows at a time rather than loaded whole
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "0"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Number of rows fetched per round trip (and sent per chunk) when streaming
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+# Number of rows sent per multi-row INSERT by the bulk create endpoint
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+
+# Code lookup cache. Writes evict entries in the worker that made them, so the
+# TTL (in seconds) bounds how stale other workers can be. 0 disables the cache
+CODE_CACHE_SIZE = int(os.getenv("CODE_CACHE_SIZE", "1024"))
+CODE_CACHE_TTL = float(os.getenv("CODE_CACHE_TTL", "30"))
+
+# Redemption leases. When above 0 each worker takes this many units of a hot
+# promotion at a time and hands them out from memory. What is left of a
+# lease goes back when its worker finds it past the TTL (in seconds), or on
+# shutdown; a worker that died takes its units with it. 0 redeems straight
+# against the database
+REDEMPTION_LEASE_SIZE = int(os.getenv("REDEMPTION_LEASE_SIZE", "0"))
+REDEMPTION_LEASE_TTL = float(os.getenv("REDEMPTION_LEASE_TTL", "5"))
+
+# Seconds the compiled product_id -> live promotions index used to price carts
+# is kept before it is rebuilt. Writes made through this worker rebuild it
+PRICING_INDEX_TTL = float(os.getenv("PRICING_INDEX_TTL", "60"))
+
+# In-memory snapshot of the promotions kept current with LISTEN/NOTIFY
+# (PostgreSQL only). Unfiltered reads are served from it while it is at most
+# SNAPSHOT_MAX_STALENESS seconds behind, and it is fully re-read every
+# SNAPSHOT_RESYNC seconds
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "False").lower() in ("true", "1", "yes")
+SNAPSHOT_MAX_STALENESS = float(os.getenv("SNAPSHOT_MAX_STALENESS", "2"))
+SNAPSHOT_RESYNC = float(os.getenv("SNAPSHOT_RESYNC", "300"))
+
+# Directory shared by the workers of a pod (preferably on tmpfs). When set, one
+# worker keeps the snapshot and the others read its memory-mapped files
+SNAPSHOT_SHARED_DIR = os.getenv("SNAPSHOT_SHARED_DIR", "")
+
+# Cache-Control sent with promotion reads. Every read has an ETag, so the
+# default lets caches keep a copy but revalidate it with If-None-Match
+CACHE_CONTROL = os.getenv("CACHE_CONTROL", "no-cache")
+
+# Compression of responses the client accepts it for (brotli needs the
+# compression extra). Bodies under COMPRESSION_MIN_SIZE bytes are sent as is
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "True").lower() in ("true", "1", "yes")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+# Per route request and SQL metrics served by GET /metrics. Under gunicorn
+# PROMETHEUS_MULTIPROC_DIR sums them over the workers (see gunicorn.conf.py)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() in ("true", "1", "yes")
+
+# Opt-in SQL profiling: "off", "header" (requests sent with X-SQL-Profile: 1)
+# or "on". Profiled statements slower than SQL_SLOW_MS are logged with a plan
+SQL_PROFILE = os.getenv("SQL_PROFILE", "off").lower()
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "100"))
+
+# Build of the static files made by "python -m service.common.assets"
+# (defaults to service/static/dist). Without one service/static is served
+ASSETS_FOLDER = os.getenv("ASSETS_FOLDER", "")
+
+# Allows POST /promotions/reset to remove every promotion. Only turn this on
+# for test and development environments
+ALLOW_RESET = os.getenv("ALLOW_RESET", "False").lower() in ("true", "1", "yes")
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
@@ -20,23 +20,94 @@ end_date (date) - the date the promotion ends
 active (boolean) - True for promotions that are active to be used
 product_id (string) - the unique promo_id of the product the promotion is associated with
 dev_created_at (date) - the date the promotion is created in the system
+version (integer) - starts at 1 and goes up by one with every update
+
+PromotionLeases - blocks of a Promotion's units leased by a worker
+
+Attributes:
+-----------
+
+lease_id (integer) - the unique id of the lease
+promo_id (integer) - the promo_id of the Promotion the units were taken from
+units (integer) - the units leased when the lease was opened, which the worker
+    then hands out without writing them back
+expires_at (datetime) - when the worker stops handing the units out
+
+PromotionChanges - the log of writes that versions the list of Promotions
+
+Attributes:
+-----------
+
+change_id (integer) - numbers the writes in the order they took a number
 """
 
 import logging
 from enum import Enum
 from datetime import date, timedelta
+from blinker import Namespace
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Sequence, delete, func, insert, inspect, select, text, tuple_, update
+from service.common.cache import LRUCache
 
 logger = logging.getLogger("flask.app")
 
+# Engine of the optional read replica in SQLALCHEMY_BINDS
+REPLICA = "replica"
+
+
+class RoutingSession(Session):  # pylint: disable=too-few-public-methods
+    """A session that sends SELECTs to the read replica while
+    info["replica"] is set, see service.common.replica. Everything else,
+    and every statement while flushing, goes to the primary. A write also
+    clears info["replica"], so the reads after it see it"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self.info.get("replica") and (self._flushing or getattr(clause, "is_dml", False)):
+            self.info["replica"] = False
+        if bind is None and self.info.get("replica") and getattr(clause, "is_select", False):
+            engine = db.engines.get(REPLICA)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# Entries (promo_id, version, JSON) of Promotions keyed by lower case
+# cust_promo_code, sized in create_app()
+code_cache = LRUCache()
+
+# Sent after a write commits with the promo_ids it changed (None for unknown or
+# all of them) and quantity_only=True when only quantities moved, along with
+# crossed_zero=True when one ran out or came back from zero. Anything that
+# keeps a derived copy of the Promotions connects to it to stay current
+signals = Namespace()
+promotions_changed = signals.signal("promotions-changed")
+
+# Sent inside a write's transaction just before it commits, with promo_ids,
+# quantity_only and the session of the write. Receivers may add statements to the
+# transaction but never commit it, and an error they raise rolls the write back
+promotions_changing = signals.signal("promotions-changing")
+
+# Rows kept in the log of changes that versions the list, see PromotionChanges
+KEEP_CHANGES = 1000
+
+# Numbers the change notifications sent to the other workers' snapshots, see
+# service.common.snapshot. Only databases with sequences (PostgreSQL) create it
+change_versions = Sequence("promotions_change_version_seq", metadata=db.metadata)
 
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+# Columns that a listing can be ordered by. Each one is backed by a composite
+# (column, promo_id) index so that keyset pages are a single index range scan
+SORT_KEYS = ("promo_id", "start_date", "end_date", "dev_created_at")
+
+
 class Type(Enum):
     """Enumeration of valid Type"""
 
@@ -50,7 +121,7 @@ class Promotions(db.Model):
     Class that represents a Promotions
     """
 
-    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-instance-attributes, too-many-public-methods
 
     ##################################################
     # Table Schema
@@ -65,6 +136,28 @@ class Promotions(db.Model):
     active = db.Column(db.Boolean(), nullable=False)
     product_id = db.Column(db.Integer, nullable=True)
     dev_created_at = db.Column(db.Date(), nullable=False, default=date.today())
+    # Bumped by every UPDATE, including the set-based ones, and used for ETags
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1", onupdate=text("version + 1"))
+
+    __table_args__ = (
+        db.Index("ix_promotions_start_date_promo_id", "start_date", "promo_id"),
+        db.Index("ix_promotions_end_date_promo_id", "end_date", "promo_id"),
+        db.Index("ix_promotions_dev_created_at_promo_id", "dev_created_at", "promo_id"),
+        db.Index("ix_promotions_type_promo_id", "type", "promo_id"),
+        db.Index("ix_promotions_product_id_active", "product_id", "active"),
+        db.Index(
+            "ux_promotions_cust_promo_code_lower",
+            db.text("lower(cust_promo_code)"),
+            unique=True,
+        ),
+        db.Index(
+            "ix_promotions_active_window",
+            "start_date",
+            "end_date",
+            postgresql_where=db.text("active"),
+            sqlite_where=db.text("active"),
+        ),
+    )
 
     ##################################################
     # INSTANCE METHODS
@@ -79,39 +172,76 @@ class Promotions(db.Model):
         """
         logger.info("Creating %s", self.cust_promo_code)
         self.promo_id = None
+        codes = self.cached_codes()
         try:
             db.session.add(self)
+            db.session.flush()
+            Promotions.changing(db.session, promo_ids=[self.promo_id], quantity_only=False)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
+        Promotions.changed([self.promo_id], False, codes)
 
     def update(self):
         """
         Updates a Promotions to the database
         """
         logger.info("Saving %s", self.cust_promo_code)
+        if self.promo_id is None:
+            raise DataValidationError("Update called on a Promotion with no ID")
+        codes = self.cached_codes()
         try:
+            self.forfeit_leases(db.session)
+            Promotions.changing(db.session, promo_ids=[self.promo_id], quantity_only=False)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
-        if self.promo_id is None:
-            raise DataValidationError("Update called on a Promotion with no ID")
-        db.session.commit()
+        Promotions.changed([self.promo_id], False, codes)
 
     def delete(self):
         """Removes a Promotions from the data store"""
         logger.info("Deleting %s", self.cust_promo_code)
+        codes = self.cached_codes()
+        promo_id = self.promo_id
         try:
             db.session.delete(self)
+            Promotions.changing(db.session, promo_ids=[promo_id], quantity_only=False)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
+        Promotions.changed([promo_id], False, codes)
+
+    def column_values(self):
+        """Returns the columns to insert for this Promotion as a dictionary"""
+        return {
+            column.key: getattr(self, column.key)
+            for column in self.__table__.columns
+            if column.key != "promo_id"
+        }
+
+    def cached_codes(self):
+        """Returns every code this Promotion may be cached under, old and new"""
+        history = inspect(self).attrs.cust_promo_code.history
+        codes = (*history.added, *history.unchanged, *history.deleted)
+        return {code.lower() for code in codes if code}
+
+    def forfeit_leases(self, session):
+        """Drops the leases taken from this Promotion's old quantity when the
+        write in progress sets a new one, see PromotionLeases.forfeit()"""
+        if inspect(self).attrs.quantity.history.has_changes():
+            PromotionLeases.forfeit(session, PromotionLeases.promo_id == self.promo_id)
+
+    @staticmethod
+    def forget_codes(codes):
+        """Drops the given codes from the code cache after a write commits"""
+        for code in codes:
+            code_cache.discard(code)
 
     def serialize(self):
         """Serializes a Promotions into a dictionary"""
@@ -175,6 +305,273 @@ class Promotions(db.Model):
     # CLASS METHODS
     ##################################################
 
+    @classmethod
+    def create_many(cls, promotions, batch_size=1000, atomic=True):
+        """Creates many Promotions with batched multi-row INSERTs
+
+        Args:
+            promotions (list): the Promotions to create
+            batch_size (int): the number of rows sent per INSERT statement
+            atomic (bool): True to create all of them or none of them in one
+                transaction, False to commit each batch and skip bad rows
+
+        Returns:
+            a list with the new promo_id of each Promotion (None for the rows
+            that failed) and a dictionary of error messages by list index.
+            When an atomic batch fails nothing is created and the messages
+            name the rows that made it fail
+        """
+        logger.info("Creating %d Promotions in batches of %d", len(promotions), batch_size)
+        statement = insert(cls).returning(cls.promo_id, sort_by_parameter_order=True)
+        rows = [promotion.column_values() for promotion in promotions]
+        promo_ids = [None] * len(rows)
+        errors = {}
+        try:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                try:
+                    result = db.session.execute(statement, batch)
+                    promo_ids[start:start + len(batch)] = result.scalars().all()
+                    if not atomic:
+                        cls.changing(db.session, promo_ids=promo_ids[start:start + len(batch)], quantity_only=False)
+                        db.session.commit()
+                except Exception:  # pylint: disable=broad-except
+                    if atomic:
+                        raise
+                    db.session.rollback()
+                    cls._create_one_by_one(statement, batch, start, promo_ids, errors)
+            if atomic:
+                cls.changing(db.session, promo_ids=promo_ids, quantity_only=False)
+                db.session.commit()
+        except Exception as e:  # pylint: disable=broad-except
+            db.session.rollback()
+            logger.error("Error creating records: %s", e)
+            errors = cls._find_bad_rows(statement, rows)
+            if not errors:
+                raise DataValidationError("The Promotions could not be created") from e
+            return [None] * len(rows), errors
+        created = [promo_id for promo_id in promo_ids if promo_id is not None]
+        cls.changed(created, False, codes=())
+        return promo_ids, errors
+
+    @classmethod
+    def _create_one_by_one(cls, statement, batch, start, promo_ids, errors):
+        """Retries a failed batch row by row to find out which rows are bad"""
+        for index, row in enumerate(batch, start):
+            try:
+                promo_ids[index] = db.session.execute(statement, [row]).scalar_one()
+                cls.changing(db.session, promo_ids=[promo_ids[index]], quantity_only=False)
+                db.session.commit()
+            except Exception as e:  # pylint: disable=broad-except
+                db.session.rollback()
+                logger.error("Error creating record %d: %s", index, e)
+                errors[index] = cls._insert_error(e, row)
+
+    @classmethod
+    def _find_bad_rows(cls, statement, rows):
+        """Returns error messages by index for the rows that failed an atomic
+        create, which has been rolled back, without creating any of them
+
+        Codes repeated within the rows or already taken are found with one
+        query per thousand codes. Only when none are, each row is inserted
+        on its own and rolled back to find the ones the database rejects
+        """
+        errors = {}
+        first = {}
+        for index, row in enumerate(rows):
+            code = row["cust_promo_code"].lower()
+            if code in first:
+                errors[index] = f"cust_promo_code '{row['cust_promo_code']}' repeats the one at index {first[code]}"
+            first.setdefault(code, index)
+        codes = list(first)
+        lower = func.lower(cls.cust_promo_code)
+        taken = set()
+        for start in range(0, len(codes), 1000):
+            taken.update(db.session.execute(select(lower).where(lower.in_(codes[start:start + 1000]))).scalars())
+        db.session.rollback()
+        for code in taken:
+            errors[first[code]] = f"cust_promo_code '{rows[first[code]]['cust_promo_code']}' already exists"
+        if errors:
+            return errors
+        for index, row in enumerate(rows):
+            try:
+                db.session.execute(statement, [row])
+            except Exception as e:  # pylint: disable=broad-except
+                errors[index] = cls._insert_error(e, row)
+            finally:
+                db.session.rollback()
+        return errors
+
+    @staticmethod
+    def _insert_error(error, row):
+        """Returns the message for a row the database rejected, without the
+        database's own text, which names its internals"""
+        if "ux_promotions_cust_promo_code_lower" in str(error):
+            return f"cust_promo_code '{row['cust_promo_code']}' already exists"
+        return "The database rejected this Promotion"
+
+    @classmethod
+    def update_where(cls, query, changes, returning=False):
+        """Applies the same changes to every Promotion matched by a query
+
+        This runs as one set-based UPDATE without loading any Promotions
+
+        Args:
+            query (Query): a filtered query such as find_by_type() returns
+            changes (dict): the new values by column name
+            returning (bool): True to also return the ids that were changed
+
+        Returns:
+            the number of Promotions changed and their ids (or None)
+        """
+        logger.info("Updating %s where %s", sorted(changes), query.whereclause)
+        statement = (
+            update(cls)
+            .where(query.whereclause)
+            .values(**changes)
+            .execution_options(synchronize_session=False)
+        )
+        if returning:
+            statement = statement.returning(cls.promo_id)
+        try:
+            if "quantity" in changes:
+                matched = select(cls.promo_id).where(query.whereclause)
+                PromotionLeases.forfeit(db.session, PromotionLeases.promo_id.in_(matched))
+            result = db.session.execute(statement)
+            promo_ids = result.scalars().all() if returning else None
+            count = len(promo_ids) if returning else result.rowcount
+            cls.changing(db.session, promo_ids=promo_ids, quantity_only=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error updating records: %s", e)
+            raise DataValidationError(e) from e
+        cls.changed(promo_ids, False)
+        return count, promo_ids
+
+    @classmethod
+    def cancel_where(cls, query, returning=False):
+        """Cancels every Promotion matched by a query with one UPDATE"""
+        changes = {"end_date": date.today() - timedelta(days=1), "active": False}
+        return cls.update_where(query, changes, returning)
+
+    @classmethod
+    def delete_where(cls, query, returning=False):
+        """Removes every Promotion matched by a query with one DELETE
+
+        Args:
+            query (Query): a filtered query such as find_by_type() returns
+            returning (bool): True to also return the ids that were removed
+
+        Returns:
+            the number of Promotions removed and their ids (or None)
+        """
+        logger.info("Deleting where %s", query.whereclause)
+        statement = (
+            delete(cls)
+            .where(query.whereclause)
+            .execution_options(synchronize_session=False)
+        )
+        if returning:
+            statement = statement.returning(cls.promo_id)
+        try:
+            result = db.session.execute(statement)
+            promo_ids = result.scalars().all() if returning else None
+            count = len(promo_ids) if returning else result.rowcount
+            cls.changing(db.session, promo_ids=promo_ids, quantity_only=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error deleting records: %s", e)
+            raise DataValidationError(e) from e
+        cls.changed(promo_ids, False)
+        return count, promo_ids
+
+    @classmethod
+    def truncate(cls):
+        """Removes every Promotion and its leases and restarts the promo_id sequence"""
+        logger.warning("Removing all Promotions")
+        table = cls.__table__.name
+        if db.engine.dialect.name == "postgresql":
+            statements = [text(f"TRUNCATE TABLE {table}, {PromotionLeases.__tablename__} RESTART IDENTITY")]
+        else:
+            statements = [delete(cls), delete(PromotionLeases)]
+        try:
+            for statement in statements:
+                db.session.execute(statement)
+            cls.changing(db.session, promo_ids=None, quantity_only=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error truncating records: %s", e)
+            raise DataValidationError(e) from e
+        cls.changed(None, False)
+
+    @classmethod
+    def redeem(cls, promo_id, count=1):
+        """Uses up count units of a live Promotion's quantity
+
+        Args:
+            promo_id (int): the promo_id of the Promotion to redeem
+            count (int): the number of units to use up
+
+        Returns:
+            a (promo_id, cust_promo_code, quantity) row with the quantity
+            left, or None if the Promotion does not exist, is not live or
+            does not have count units left
+        """
+        logger.info("Redeeming %d of promo_id %s ...", count, promo_id)
+        return cls._redeem(cls.promo_id == promo_id, count)
+
+    @classmethod
+    def redeem_code(cls, code, count=1):
+        """Uses up count units of the Promotion with the given code, ignoring case
+
+        Returns the same row as redeem(), or None if it cannot be redeemed
+        """
+        logger.info("Redeeming %d of code %s ...", count, code)
+        return cls._redeem(func.lower(cls.cust_promo_code) == code.lower(), count)
+
+    @classmethod
+    def _redeem(cls, criterion, count):
+        """Decrements the quantity with a single conditional UPDATE
+
+        The check and the decrement happen in the same statement and the
+        transaction commits right away, so concurrent redemptions can never
+        oversell and no row lock is held while Python code runs
+        """
+        statement = cls._redeem_statement(criterion, count)
+        try:
+            row = db.session.execute(statement).first()
+            if row is not None:
+                cls.changing(db.session, promo_ids=[row.promo_id], quantity_only=True)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error redeeming record: %s", e)
+            raise DataValidationError(e) from e
+        if row is not None:
+            cls.changed([row.promo_id], True, {row.cust_promo_code.lower()}, crossed_zero=row.quantity == 0)
+        return row
+
+    @classmethod
+    def _redeem_statement(cls, criterion, count):
+        """Returns the UPDATE that takes count units from a live Promotion"""
+        today = date.today()
+        return (
+            update(cls)
+            .where(
+                criterion,
+                cls.active,
+                cls.quantity >= count,
+                cls.start_date <= today,
+                cls.end_date >= today,
+            )
+            .values(quantity=cls.quantity - count)
+            .returning(cls.promo_id, cls.cust_promo_code, cls.quantity)
+            .execution_options(synchronize_session=False)
+        )
+
     @classmethod
     def all(cls):
         """Returns all of the Promotions in the database"""
@@ -182,17 +579,356 @@ class Promotions(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find_by_type(cls, promo_type):
+    def list_version(cls):
+        """Returns the version of the whole list for ETags, which every write
+        but a redemption changes when it commits, see PromotionChanges"""
+        return PromotionChanges.version(db.session)
+
+    @classmethod
+    def changing(cls, session, promo_ids, quantity_only):
+        """Logs the change for the list version, unless only quantities moved,
+        and sends promotions_changing, from inside a write's transaction just
+        before it commits. The asyncio routes call it through run_sync"""
+        if not quantity_only:
+            PromotionChanges.record(session)
+        promotions_changing.send(cls, promo_ids=promo_ids, quantity_only=quantity_only, session=session)
+
+    @classmethod
+    def changed(cls, promo_ids, quantity_only, codes=None, crossed_zero=False):
+        """Forgets the cached codes of a write that committed, or every code
+        when they are not known, and sends promotions_changed. crossed_zero
+        tells when a quantity ran out or came back from zero"""
+        if codes is None:
+            code_cache.clear()
+        else:
+            cls.forget_codes(codes)
+        promotions_changed.send(cls, promo_ids=promo_ids, quantity_only=quantity_only, crossed_zero=crossed_zero)
+
+    @classmethod
+    def find_by_type(cls, promo_type, query=None):
         """Returns all promotions with the given promo_type
 
         Args:
             promo_type (string): the val of the promo_type you want to get
+            query (Query): an optional query to narrow down (defaults to all)
         """
         logger.info("Processing type query for %s ...", promo_type)
-        return cls.query.filter(cls.type == promo_type)
+        query = cls.query if query is None else query
+        return query.filter(cls.type == promo_type)
+
+    @classmethod
+    def find_by_ids(cls, promo_ids, query=None):
+        """Returns the promotions with the given promo_id or list of promo_ids
+
+        Args:
+            promo_ids (int or list): the promo_id(s) you want to match
+            query (Query): an optional query to narrow down (defaults to all)
+        """
+        logger.info("Processing id query for %s ...", promo_ids)
+        query = cls.query if query is None else query
+        if isinstance(promo_ids, (list, tuple)):
+            return query.filter(cls.promo_id.in_(promo_ids))
+        return query.filter(cls.promo_id == promo_ids)
+
+    @classmethod
+    def find_by_product_id(cls, product_ids, query=None):
+        """Returns all promotions for the given product or list of products
+
+        Args:
+            product_ids (int or list): the product_id(s) you want to match
+            query (Query): an optional query to narrow down (defaults to all)
+        """
+        logger.info("Processing product query for %s ...", product_ids)
+        query = cls.query if query is None else query
+        if isinstance(product_ids, (list, tuple)):
+            return query.filter(cls.product_id.in_(product_ids))
+        return query.filter(cls.product_id == product_ids)
+
+    @classmethod
+    def find_by_active(cls, active=True, query=None):
+        """Returns all promotions with the given active flag
+
+        Args:
+            active (boolean): True for active promotions, False for inactive
+            query (Query): an optional query to narrow down (defaults to all)
+        """
+        logger.info("Processing active query for %s ...", active)
+        query = cls.query if query is None else query
+        return query.filter(cls.active if active else ~cls.active)
+
+    @classmethod
+    def find_by_cust_promo_code(cls, code, query=None):
+        """Returns all promotions with the given customer facing code, ignoring case
+
+        Args:
+            code (string): the cust_promo_code you want to match
+            query (Query): an optional query to narrow down (defaults to all)
+        """
+        logger.info("Processing code query for %s ...", code)
+        query = cls.query if query is None else query
+        return query.filter(func.lower(cls.cust_promo_code) == code.lower())
+
+    @classmethod
+    def find_active_on(cls, day, query=None):
+        """Returns all active promotions that are running on the given day
+
+        Args:
+            day (date): the day the promotions must be live on
+            query (Query): an optional query to narrow down (defaults to all)
+        """
+        logger.info("Processing live query for %s ...", day)
+        query = cls.query if query is None else query
+        return query.filter(cls.active, cls.start_date <= day, cls.end_date >= day)
+
+    @classmethod
+    def find_by_date_range(cls, start=None, end=None, query=None):
+        """Returns all promotions that run within the given window
+
+        Args:
+            start (date): the earliest start_date to match, if any
+            end (date): the latest end_date to match, if any
+            query (Query): an optional query to narrow down (defaults to all)
+        """
+        logger.info("Processing date range query for %s to %s ...", start, end)
+        query = cls.query if query is None else query
+        if start is not None:
+            query = query.filter(cls.start_date >= start)
+        if end is not None:
+            query = query.filter(cls.end_date <= end)
+        return query
+
+    @classmethod
+    def find_by_code(cls, code):
+        """Finds a Promotions by its customer facing code, ignoring case"""
+        logger.info("Processing lookup for code %s ...", code)
+        return cls.find_by_cust_promo_code(code).first()
 
     @classmethod
     def find(cls, by_id):
         """Finds a Promotions by it's ID"""
         logger.info("Processing lookup for promo_id %s ...", by_id)
         return cls.query.session.get(cls, by_id)
+
+    @classmethod
+    def stream(cls, query=None, batch_size=500):
+        """Iterates over Promotions in promo_id order without loading them all
+
+        The rows are fetched ``batch_size`` at a time through a server-side
+        cursor, so memory use is bounded by the batch and not the table.
+
+        Args:
+            query (Query): an optional query to iterate over (defaults to all)
+            batch_size (int): the number of rows to fetch per round trip
+        """
+        logger.info("Processing streamed query in batches of %d ...", batch_size)
+        query = cls.query if query is None else query
+        return query.order_by(cls.promo_id).yield_per(batch_size)
+
+    @classmethod
+    def find_page(cls, query=None, sort="promo_id", limit=50, after=None, descending=False):
+        """Returns one page of Promotions using keyset (seek) pagination
+
+        Rows are ordered by the sort key with promo_id as the tie breaker, and
+        the page starts right after the ``after`` key instead of using OFFSET,
+        so every page costs the same no matter how deep it is.
+
+        Args:
+            query (Query): an optional query to page through (defaults to all)
+            sort (string): one of SORT_KEYS
+            limit (int): the maximum number of Promotions to return
+            after (tuple): the (sort value, promo_id) key of the last row seen
+            descending (bool): True to walk the sort key from high to low
+        """
+        if sort not in SORT_KEYS:
+            raise DataValidationError(f"Invalid sort key: {sort}")
+        logger.info("Processing page query on %s after %s ...", sort, after)
+        query = cls.query if query is None else query
+        if sort == "promo_id":
+            columns = (cls.promo_id,)
+        else:
+            columns = (getattr(cls, sort), cls.promo_id)
+        if after is not None:
+            key, bound = columns[0], after[0]
+            if len(columns) > 1:
+                key, bound = tuple_(*columns), tuple_(*after)
+            query = query.filter(key < bound if descending else key > bound)
+        order = [column.desc() if descending else column.asc() for column in columns]
+        return query.order_by(*order).limit(limit).all()
+
+    def sort_key(self, sort):
+        """Returns the keyset position of this Promotion for the given sort key"""
+        if sort == "promo_id":
+            return (self.promo_id,)
+        return (getattr(self, sort), self.promo_id)
+
+
+class PromotionLeases(db.Model):
+    """
+    Class that represents a block of a Promotion's units leased by a worker,
+    see service.common.leases. The units are already taken out of the
+    Promotion's quantity and the unused ones go back when the worker gives
+    the lease back
+    """
+
+    __tablename__ = "promotion_leases"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    lease_id = db.Column(db.Integer, primary_key=True)
+    promo_id = db.Column(db.Integer, nullable=False)
+    units = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_promotion_leases_promo_id", "promo_id"),
+        db.Index("ix_promotion_leases_expires_at", "expires_at"),
+    )
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def open(cls, criterion, units, count, expires_at):
+        """Redeems units of a live Promotion and leases the ones beyond count
+
+        The UPDATE of the Promotion and the INSERT of the lease commit
+        together, so no unit is lost if the worker dies in between.
+
+        Args:
+            criterion: picks the Promotion, as for Promotions.redeem()
+            units (int): the units to take from the Promotion
+            count (int): the units redeemed now, the rest are leased
+            expires_at (datetime): when the worker stops handing units out
+
+        Returns:
+            (row, lease_id, quantity) with the row of Promotions.redeem(),
+            the id of the lease (None when nothing was leased) and the
+            quantity left counting every lease as it was opened, or None
+            if it cannot be redeemed
+        """
+        logger.info("Leasing %d units ...", units)
+        try:
+            row = db.session.execute(Promotions._redeem_statement(criterion, units)).first()
+            lease_id = quantity = None
+            if row is not None:
+                if units > count:
+                    lease_id = db.session.execute(
+                        insert(cls)
+                        .values(promo_id=row.promo_id, units=units - count, expires_at=expires_at)
+                        .returning(cls.lease_id)
+                    ).scalar()
+                quantity = cls._remaining(row.promo_id)
+                Promotions.changing(db.session, promo_ids=[row.promo_id], quantity_only=True)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error leasing units: %s", e)
+            raise DataValidationError(e) from e
+        if row is None:
+            return None
+        Promotions.changed([row.promo_id], True, {row.cust_promo_code.lower()}, crossed_zero=row.quantity == 0)
+        return row, lease_id, quantity
+
+    @classmethod
+    def give_back(cls, lease_id, units):
+        """Deletes a lease and gives the units its worker did not hand out back
+
+        Only the worker that holds a lease knows how many units are left, so
+        it is the only one that gives them back. Nothing goes back when the
+        lease is already gone because a write set a new quantity for the
+        Promotion, see forfeit(), or it was discarded as abandoned.
+
+        Returns:
+            the number of units given back
+        """
+        quantity = None
+        try:
+            promo_id = db.session.execute(delete(cls).where(cls.lease_id == lease_id).returning(cls.promo_id)).scalar()
+            if promo_id is None:
+                units = 0
+            elif units:
+                quantity = db.session.execute(
+                    update(Promotions.__table__)
+                    .where(Promotions.promo_id == promo_id)
+                    .values(quantity=Promotions.quantity + units)
+                    .returning(Promotions.quantity)
+                ).scalar()
+                Promotions.changing(db.session, promo_ids=[promo_id], quantity_only=True)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error giving back leased units: %s", e)
+            raise DataValidationError(e) from e
+        if promo_id is not None and units:
+            logger.info("Gave back %d leased units of promo_id %s", units, promo_id)
+            Promotions.changed([promo_id], True, codes=(), crossed_zero=quantity == units)
+        return units
+
+    @classmethod
+    def discard(cls, criterion):
+        """Deletes the matching leases without giving any units back
+
+        Returns:
+            the number of leases deleted
+        """
+        try:
+            count = db.session.execute(delete(cls).where(criterion)).rowcount
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error discarding leases: %s", e)
+            raise DataValidationError(e) from e
+        if count:
+            logger.warning("Discarded %d abandoned leases", count)
+        return count
+
+    @classmethod
+    def forfeit(cls, session, criterion):
+        """Deletes the matching leases inside a write that sets a new quantity
+        for their Promotions, so their units are never added back to it"""
+        session.execute(delete(cls).where(criterion).execution_options(synchronize_session=False))
+
+    @classmethod
+    def _remaining(cls, promo_id):
+        """Returns a Promotion's quantity plus the units its leases opened with"""
+        leased = select(func.coalesce(func.sum(cls.units), 0)).where(cls.promo_id == promo_id).scalar_subquery()
+        return db.session.execute(
+            select(Promotions.quantity + leased).where(Promotions.promo_id == promo_id)
+        ).scalar()
+
+
+class PromotionChanges(db.Model):
+    """
+    Class that represents the log of writes that versions the list of
+    Promotions. Every write but a redemption inserts a row numbered by the
+    table's sequence, which never makes another writer wait. The version is
+    the highest number together with the number of rows: a write that took
+    its number before a later one but commits after it still raises the
+    count, so no two different lists ever share a version
+    """
+
+    __tablename__ = "promotion_change_log"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    change_id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+
+    @classmethod
+    def record(cls, session):
+        """Logs a write in its own transaction and returns its number
+
+        Now and then the writer that takes a number deletes the rows that
+        are more than KEEP_CHANGES behind it, so the log stays small
+        """
+        change_id = session.execute(insert(cls).returning(cls.change_id)).scalar_one()
+        if change_id % KEEP_CHANGES == 0:
+            session.execute(delete(cls).where(cls.change_id <= change_id - KEEP_CHANGES))
+        return change_id
+
+    @classmethod
+    def version(cls, session):
+        """Returns (highest number, number of rows) of the committed writes"""
+        return tuple(session.execute(select(func.max(cls.change_id), func.count(cls.change_id))).one())
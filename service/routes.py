@@ -20,11 +20,24 @@ Product Promotion Service
 This service implements a REST API that allows you to Create, Read, Update
 and Delete Promotions from the inventory of promotions
 """
+import json
+import hashlib
+from itertools import chain, islice
 from datetime import date, timedelta
-from flask import jsonify, request, url_for, abort
+from flask import jsonify, request, url_for, abort, Response, stream_with_context
 from flask import current_app as app  # Import Flask application
-from service.models import Promotions, Type
+from prometheus_client import CONTENT_TYPE_LATEST
+from service.models import Promotions, DataValidationError, code_cache
 from service.common import status  # HTTP Status Codes
+from service.common.pagination import parse_sort, encode_cursor, decode_cursor, row_key
+from service.common.filters import check_filter_names, filter_promotions, parse_changes
+from service.common.leases import leases
+from service.common.pricing import evaluate, promotion_index
+from service.common.snapshot import snapshot, encode
+from service.common.shared_snapshot import Entry
+from service.common.assets import assets
+from service.common.metrics import render
+from service.common.serializer import FIELDS, parse_fields, select_rows, encoder, encode_rows
 
 
 ######################################################################
@@ -36,15 +49,35 @@ def health_check():
     return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
 
 
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics")
+def get_metrics():
+    """Returns the request and SQL metrics in the Prometheus text format"""
+    return Response(render(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
 @app.route("/")
 def index():
     """Root URL response"""
+    if assets.enabled:
+        return assets.send_index()
     return app.send_static_file("index.html")
 
 
+######################################################################
+# GET A HASHED STATIC ASSET
+######################################################################
+@app.route("/assets/<path:filename>")
+def get_asset(filename):
+    """Returns a content-hashed static file, precompressed when possible"""
+    return assets.send_asset(filename)
+
+
 ######################################################################
 #  R E S T   A P I   E N D P O I N T S
 ######################################################################
@@ -75,27 +108,120 @@ def create_promotions():
     return jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+# CREATE MANY PROMOTIONS
+######################################################################
+@app.route("/promotions/bulk", methods=["POST"])
+def create_promotions_bulk():
+    """
+    Creates many Promotions
+
+    This endpoint takes a JSON array, or one Promotion per line with a
+    Content-Type of application/x-ndjson, and inserts them in batches.
+    With the default ``mode=atomic`` either every Promotion is created or,
+    if any is invalid, none are. With ``mode=best_effort`` the valid ones
+    are created and the rest are reported. Errors are listed by index
+    """
+    app.logger.info("Request to create promotions in bulk")
+    mode = request.args.get("mode", "atomic")
+    if mode not in ("atomic", "best_effort"):
+        raise DataValidationError(f"Invalid mode: {mode}")
+
+    promotions = []
+    errors = {}
+    for position, data in enumerate(bulk_records()):
+        try:
+            promotions.append((position, Promotions().deserialize(data)))
+        except DataValidationError as err:
+            errors[position] = str(err)
+
+    if errors and mode == "atomic":
+        return bulk_rejected(errors)
+
+    promo_ids, failures = Promotions.create_many(
+        [promotion for _, promotion in promotions],
+        app.config["BULK_BATCH_SIZE"],
+        atomic=mode == "atomic",
+    )
+    for position, message in failures.items():
+        errors[promotions[position][0]] = message
+    if errors and mode == "atomic":
+        return bulk_rejected(errors)
+    created = [promo_id for promo_id in promo_ids if promo_id is not None]
+
+    app.logger.info("Created %d promotions in bulk.", len(created))
+    return jsonify(
+        created=len(created), promo_ids=created, errors=bulk_errors(errors)
+    ), status.HTTP_201_CREATED
+
+
 ######################################################################
 # LIST ALL PROMOTIONS
 ######################################################################
 @app.route("/promotions", methods=["GET"])
 def list_promotions():
-    """Returns all of the Promotions"""
-    app.logger.info("Request for promotion list")
+    """Returns all of the Promotions
 
-    promotions = []
+    The list can be narrowed with any combination of the ``type``,
+    ``product_id`` (repeat for several), ``active``, ``cust_promo_code``,
+    ``active_on``, ``start_date`` (on or after) and ``end_date`` (on or
+    before) query parameters.
+
+    Pass ``limit`` and/or ``cursor`` to page through the list with keyset
+    pagination, optionally ordered by ``sort`` (prefix with - for descending).
+    The cursor for the next page is returned in the X-Next-Cursor and Link
+    headers and is absent on the last page.
+
+    Send ``Accept: application/x-ndjson`` to stream one Promotion per line,
+    or ``stream=true`` to stream a chunked JSON array.
+
+    Pass ``fields`` (comma separated) to read and return only some fields.
+    """
+    app.logger.info("Request for promotion list")
 
     # See if any query filters were passed in
-    promo_type = request.args.get("type")
-    if promo_type:
-        promo_type = getattr(Type, request.args.get("type"))
-        promotions = Promotions.find_by_type(promo_type)
+    query = filter_promotions(request.args.to_dict(flat=False))
+
+    limit = page_size()
+    mimetype = stream_mimetype()
+    fields = parse_fields(request.args.get("fields"))
+    whole = query is None and not limit and not mimetype and fields == FIELDS
+    view = snapshot.view() if whole else None
+    headers = {"Vary": "Accept", "Cache-Control": app.config["CACHE_CONTROL"]}
+    if not limit and not mimetype:
+        # pages and streams go straight to the rows, without an ETag
+        version = view.list_version() if view is not None else Promotions.list_version()
+        key = repr((sorted(request.args.items(multi=True)), version)).encode()
+        etag = hashlib.blake2b(key, digest_size=12).hexdigest()
+        headers.update(cache_headers(etag))
+        if request.if_none_match.contains_weak(etag):
+            return "", status.HTTP_304_NOT_MODIFIED, headers
+    if view is not None:
+        app.logger.info("Returning promotions from the snapshot")
+        return json_response(view.listing(), headers)
+
+    # plain rows straight into JSON, without loading Promotions objects
+    if limit:
+        rows, links = paginate(query, limit, fields)
+        headers.update(links)
+        if not mimetype:
+            app.logger.info("Returning %d promotions", len(rows))
+            return json_response(encode_rows(rows, fields), headers)
     else:
-        promotions = Promotions.all()
-
-    results = [promotion.serialize() for promotion in promotions]
-    app.logger.info("Returning %d promotions", len(results))
-    return jsonify(results), status.HTTP_200_OK
+        # an unpaged listing is read and sent a batch at a time, never whole;
+        # one that fits in the first batch is still sent with a length
+        batch_size = app.config["STREAM_BATCH_SIZE"]
+        rows = iter(Promotions.stream(select_rows(query, fields=fields), batch_size))
+        first = list(islice(rows, batch_size + 1))
+        if not mimetype and len(first) <= batch_size:
+            app.logger.info("Returning %d promotions", len(first))
+            return json_response(encode_rows(first, fields), headers)
+        rows = chain(first, rows)
+
+    mimetype = mimetype or "application/json"
+    app.logger.info("Streaming promotions as %s", mimetype)
+    body = stream_with_context(generate_promotions(rows, mimetype, fields))
+    return Response(body, status.HTTP_200_OK, headers, mimetype=mimetype)
 
 
 ######################################################################
@@ -106,19 +232,59 @@ def get_promotions(promo_id):
     """
     Retrieve a single Promotion
 
-    This endpoint will return a Promotion based on it's id
+    This endpoint will return a Promotion based on it's id. Pass ``fields``
+    (comma separated) to read and return only some fields.
     """
     app.logger.info("Request for promotion with id: %s", promo_id)
 
-    promotion = Promotions.find(promo_id)
-    if not promotion:
+    fields = parse_fields(request.args.get("fields"))
+    view = snapshot.view() if fields == FIELDS else None
+    if view is not None:
+        entry = view.get(promo_id)
+    elif fields != FIELDS:
+        row = select_rows(Promotions.find_by_ids(promo_id), "promo_id", "version", fields=fields).first()
+        entry = row and Entry(row.promo_id, row.version, encoder(fields)(row))
+    else:
+        promotion = Promotions.find(promo_id)
+        entry = promotion and Entry(promotion.promo_id, promotion.version, promotion)
+    if not entry:
         error(
             status.HTTP_404_NOT_FOUND,
             f"Promotion with id '{promo_id}' was not found.",
         )
 
-    app.logger.info("Returning promotion: %s", promotion.promo_id)
-    return jsonify(promotion.serialize()), status.HTTP_200_OK
+    app.logger.info("Returning promotion: %s", promo_id)
+    return entry_response(entry, fields)
+
+
+######################################################################
+# READ A PROMOTION BY CODE
+######################################################################
+@app.route("/promotions/code/<string:code>", methods=["GET"])
+def get_promotions_by_code(code):
+    """
+    Retrieve a single Promotion by its customer facing code
+
+    This endpoint will return a Promotion based on its cust_promo_code,
+    ignoring case. Hot codes are answered from an in-process cache.
+    """
+    app.logger.info("Request for promotion with code: %s", code)
+
+    view = snapshot.view()
+    entry = view.by_code(code) if view is not None else code_cache.get(code.lower())
+    if entry is None and view is None:
+        promotion = Promotions.find_by_code(code)
+        if promotion:
+            entry = Entry(promotion.promo_id, promotion.version, encode(promotion.serialize()))
+            code_cache.set(code.lower(), entry)
+    if not entry:
+        error(
+            status.HTTP_404_NOT_FOUND,
+            f"Promotion with code '{code}' was not found.",
+        )
+
+    app.logger.info("Returning promotion: %s", entry.promo_id)
+    return entry_response(entry)
 
 
 ######################################################################
@@ -133,6 +299,7 @@ def delete_promotion(promo_id):
     """
     app.logger.info("Request to delete promo with id: %d", promo_id)
 
+    leases.release(promo_id)
     promotion = Promotions.find(promo_id)
     if promotion:
         promotion.delete()
@@ -141,6 +308,50 @@ def delete_promotion(promo_id):
     return "", status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+# DELETE PROMOTIONS BY FILTER
+######################################################################
+@app.route("/promotions", methods=["DELETE"])
+def delete_promotions_bulk():
+    """
+    Delete every Promotion matching the filters in the query string
+
+    This endpoint takes the same filters as list_promotions plus
+    ``promo_id`` and refuses to run without one, or with a parameter that
+    is not a filter. Pass ``return_ids=true`` to get the ids that were deleted
+    """
+    app.logger.info("Request to delete promotions in bulk")
+    query = required_filter(request.args.to_dict(flat=False), allowed=("return_ids",))
+
+    leases.release_all()
+    count, promo_ids = Promotions.delete_where(query, returning=return_ids())
+
+    app.logger.info("Deleted %d promotions.", count)
+    return jsonify(bulk_result(count, promo_ids)), status.HTTP_200_OK
+
+
+######################################################################
+# RESET ALL PROMOTIONS
+######################################################################
+@app.route("/promotions/reset", methods=["POST"])
+def reset_promotions():
+    """
+    Delete every Promotion
+
+    This endpoint truncates the table and restarts the promo_id sequence.
+    It is only available when ALLOW_RESET is turned on
+    """
+    app.logger.warning("Request to reset all promotions")
+    if not app.config["ALLOW_RESET"]:
+        error(status.HTTP_403_FORBIDDEN, "Resetting promotions is not allowed here.")
+
+    leases.release_all()
+    Promotions.truncate()
+
+    app.logger.warning("All promotions removed.")
+    return "", status.HTTP_204_NO_CONTENT
+
+
 ######################################################################
 # Update a promotion
 ######################################################################
@@ -156,6 +367,7 @@ def update_promotions(promo_id):
     app.logger.info("Request to update promotion with id: %d", promo_id)
     check_content_type("application/json")
 
+    leases.release(promo_id)
     promotion = Promotions.find(promo_id)
     if not promotion:
         error(
@@ -181,6 +393,7 @@ def cancel_promotions(promo_id):
     """
     Cancel a Promotion
     """
+    leases.release(promo_id)
     promotion = Promotions.find(promo_id)
     if promotion is None:
         # Promotion not found, return 404
@@ -194,11 +407,267 @@ def cancel_promotions(promo_id):
     return jsonify(promotion.serialize()), status.HTTP_200_OK
 
 
+######################################################################
+#  CANCEL PROMOTIONS BY FILTER
+######################################################################
+@app.route("/promotions/cancel", methods=["POST"])
+def cancel_promotions_bulk():
+    """
+    Cancel every Promotion matching a filter
+
+    The body is a JSON object of filters, the same ones list_promotions
+    takes plus ``promo_id``, and lists of values are matched as any of.
+    Unknown keys are refused. Pass ``return_ids=true`` to get the ids that
+    were cancelled
+    """
+    app.logger.info("Request to cancel promotions in bulk")
+    check_content_type("application/json")
+    check_bulk_args()
+    query = required_filter(request.get_json())
+
+    leases.release_all()
+    count, promo_ids = Promotions.cancel_where(query, returning=return_ids())
+
+    app.logger.info("Cancelled %d promotions.", count)
+    return jsonify(bulk_result(count, promo_ids)), status.HTTP_200_OK
+
+
+######################################################################
+#  UPDATE PROMOTIONS BY FILTER
+######################################################################
+@app.route("/promotions", methods=["PATCH"])
+def update_promotions_bulk():
+    """
+    Update every Promotion matching a filter
+
+    The body is {"filter": {...}, "changes": {...}} where filter takes the
+    same filters as cancel_promotions_bulk and changes holds the new values
+    for any of type, value, quantity, start_date, end_date, active and
+    product_id. Unknown keys are refused. Pass ``return_ids=true`` to get
+    the ids that were changed
+    """
+    app.logger.info("Request to update promotions in bulk")
+    check_content_type("application/json")
+    check_bulk_args()
+    data = request.get_json()
+    if not isinstance(data, dict):
+        raise DataValidationError("Request body must be a JSON object")
+    unknown = sorted(set(data) - {"filter", "changes"})
+    if unknown:
+        raise DataValidationError(f"Unknown field(s): {', '.join(unknown)}, the body holds a filter and changes")
+    query = required_filter(data.get("filter"))
+    changes = parse_changes(data.get("changes"))
+
+    leases.release_all()
+    count, promo_ids = Promotions.update_where(query, changes, returning=return_ids())
+
+    app.logger.info("Updated %d promotions.", count)
+    return jsonify(bulk_result(count, promo_ids)), status.HTTP_200_OK
+
+
+######################################################################
+#  REDEEM A PROMOTION
+######################################################################
+@app.route("/promotions/<int:promo_id>/redeem", methods=["POST"])
+def redeem_promotions(promo_id):
+    """
+    Redeem a Promotion
+
+    This endpoint uses up one unit of a live Promotion's quantity, or the
+    number given as {"quantity": n} in the body. It returns 409_CONFLICT
+    when the Promotion is not live or does not have enough units left
+    """
+    app.logger.info("Request to redeem promotion with id: %d", promo_id)
+    count = redemption_count()
+
+    redemption = leases.redeem(promo_id, count)
+    if redemption is None:
+        if not Promotions.find(promo_id):
+            error(
+                status.HTTP_404_NOT_FOUND,
+                f"Promotion with id '{promo_id}' was not found.",
+            )
+        error(
+            status.HTTP_409_CONFLICT,
+            f"Promotion with id '{promo_id}' cannot be redeemed {count} time(s).",
+        )
+
+    app.logger.info("Promotion with ID: %d redeemed.", promo_id)
+    return jsonify(redemption_message(redemption, count)), status.HTTP_200_OK
+
+
+@app.route("/promotions/code/<string:code>/redeem", methods=["POST"])
+def redeem_promotions_by_code(code):
+    """
+    Redeem a Promotion by its customer facing code
+
+    This endpoint works like redeem_promotions but finds the Promotion by
+    its cust_promo_code, ignoring case
+    """
+    app.logger.info("Request to redeem promotion with code: %s", code)
+    count = redemption_count()
+
+    redemption = leases.redeem_code(code, count)
+    if redemption is None:
+        if not Promotions.find_by_code(code):
+            error(
+                status.HTTP_404_NOT_FOUND,
+                f"Promotion with code '{code}' was not found.",
+            )
+        error(
+            status.HTTP_409_CONFLICT,
+            f"Promotion with code '{code}' cannot be redeemed {count} time(s).",
+        )
+
+    app.logger.info("Promotion with code: %s redeemed.", code)
+    return jsonify(redemption_message(redemption, count)), status.HTTP_200_OK
+
+
+######################################################################
+#  EVALUATE A CART
+######################################################################
+@app.route("/promotions/evaluate", methods=["POST"])
+def evaluate_cart():
+    """
+    Price a cart against the live Promotions
+
+    The body is {"items": [{"product_id": 1, "quantity": 2, "unit_price": 9.99}]}
+    and the response lists the applicable Promotions and their discounts
+    for every line, the best one per line and the discounted cart total
+    """
+    app.logger.info("Request to evaluate a cart")
+    check_content_type("application/json")
+    data = request.get_json()
+    lines = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(lines, list):
+        raise DataValidationError("Request body must be {\"items\": [...]}")
+
+    result = evaluate(lines, promotion_index.offers())
+
+    app.logger.info("Evaluated a cart of %d lines.", len(lines))
+    return jsonify(result), status.HTTP_200_OK
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
 
+######################################################################
+# Reads the records posted to a bulk endpoint
+######################################################################
+def bulk_records():
+    """Returns the list of records in a JSON array or NDJSON request body"""
+    if request.mimetype == "application/x-ndjson":
+        records = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError as err:
+                raise DataValidationError(f"Invalid JSON on line {number}: {err}") from err
+        return records
+
+    check_content_type("application/json")
+    records = request.get_json()
+    if not isinstance(records, list):
+        raise DataValidationError("Request body must be a JSON array of promotions")
+    return records
+
+
+######################################################################
+# Reads the filter of a bulk change
+######################################################################
+def required_filter(filters, allowed=()):
+    """Returns the query for a filter, refusing one that matches everything,
+    has an empty value or has keys that are neither filters nor in allowed"""
+    if not isinstance(filters, dict):
+        raise DataValidationError("Filter must be a JSON object")
+    check_filter_names(filters, allowed)
+    # a blank filter would match more rows than the caller asked for
+    query = filter_promotions(filters, blank=False)
+    if query is None:
+        raise DataValidationError("A filter is required to change promotions in bulk")
+    return query
+
+
+######################################################################
+# Refuses the query parameters a bulk change with a JSON body would ignore
+######################################################################
+def check_bulk_args():
+    """Raises DataValidationError for any query parameter but return_ids"""
+    unknown = sorted(name for name in request.args if name != "return_ids")
+    if unknown:
+        raise DataValidationError(f"Unknown query parameter(s): {', '.join(unknown)}")
+
+
+######################################################################
+# Reads whether a bulk change should return the affected ids
+######################################################################
+def return_ids():
+    """Returns True if the request asked for the affected ids"""
+    return request.args.get("return_ids", "").lower() in ("true", "1", "yes")
+
+
+######################################################################
+# Builds the response body of a bulk change
+######################################################################
+def bulk_result(count, promo_ids):
+    """Returns the count of affected Promotions and their ids if known"""
+    result = {"count": count}
+    if promo_ids is not None:
+        result["promo_ids"] = sorted(promo_ids)
+    return result
+
+
+######################################################################
+# Lists the errors of a bulk request in order
+######################################################################
+def bulk_errors(errors):
+    """Returns a list of {index, message} sorted by index"""
+    return [{"index": position, "message": errors[position]} for position in sorted(errors)]
+
+
+def bulk_rejected(errors):
+    """Returns the 400 response of an atomic bulk create that created nothing"""
+    app.logger.warning("Bulk create rejected: %d invalid records", len(errors))
+    return jsonify(
+        status=status.HTTP_400_BAD_REQUEST,
+        error="Bad Request",
+        message=f"{len(errors)} invalid promotion(s), none were created",
+        errors=bulk_errors(errors),
+    ), status.HTTP_400_BAD_REQUEST
+
+
+######################################################################
+# Reads the number of units to redeem
+######################################################################
+def redemption_count():
+    """Returns the quantity asked for in the body of a redemption, default 1"""
+    if not request.content_length:
+        return 1
+    check_content_type("application/json")
+    data = request.get_json(silent=True)
+    count = data.get("quantity", 1) if isinstance(data, dict) else None
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        raise DataValidationError(f"Invalid redemption quantity: {count}")
+    return count
+
+
+######################################################################
+# Builds the response body for a redemption
+######################################################################
+def redemption_message(redemption, count):
+    """Returns the body describing a successful redemption"""
+    return {
+        "promo_id": redemption.promo_id,
+        "cust_promo_code": redemption.cust_promo_code,
+        "redeemed": count,
+        "remaining": redemption.quantity,
+    }
+
+
 ######################################################################
 # Checks the ContentType of a request
 ######################################################################
@@ -221,6 +690,117 @@ def check_content_type(content_type):
     )
 
 
+######################################################################
+# Reads the page size for a paginated listing
+######################################################################
+def page_size():
+    """Returns the requested page size, or 0 for an unpaginated listing"""
+    limit = request.args.get("limit")
+    if limit is None:
+        limit = app.config["PAGE_SIZE_DEFAULT"]
+        if not limit and "cursor" in request.args:
+            limit = app.config["PAGE_SIZE_MAX"]
+        return limit
+    try:
+        limit = int(limit)
+    except ValueError as err:
+        raise DataValidationError(f"Invalid limit: {limit}") from err
+    if limit < 1:
+        raise DataValidationError(f"Invalid limit: {limit}")
+    return min(limit, app.config["PAGE_SIZE_MAX"])
+
+
+######################################################################
+# Fetches one keyset page of a listing
+######################################################################
+def paginate(query, limit, fields):
+    """Returns a page of rows and the headers that link to the next one"""
+    sort = request.args.get("sort", "promo_id")
+    key, descending = parse_sort(sort)
+    after = request.args.get("cursor")
+    if after:
+        after = decode_cursor(after, sort)
+    # the cursor needs the sort key even when it is not one of the fields
+    query = select_rows(query, key, "promo_id", fields=fields)
+    rows = Promotions.find_page(query, key, limit + 1, after, descending)
+    if len(rows) <= limit:
+        return rows, {}
+
+    rows = rows[:limit]
+    cursor = encode_cursor(sort, row_key(rows[-1], key))
+    args = request.args.to_dict(flat=False)
+    args["cursor"] = cursor
+    next_url = url_for("list_promotions", _external=True, **args)
+    return rows, {"X-Next-Cursor": cursor, "Link": f'<{next_url}>; rel="next"'}
+
+
+######################################################################
+# Chooses a streaming format for a listing
+######################################################################
+def stream_mimetype():
+    """Returns the mimetype to stream a listing as, or None to send it whole"""
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    if best == "application/x-ndjson":
+        return best
+    if request.args.get("stream", "").lower() in ("true", "1", "yes"):
+        return "application/json"
+    return None
+
+
+######################################################################
+# Serializes a listing in chunks as it is read from the database
+######################################################################
+def generate_promotions(rows, mimetype, fields):
+    """Yields a listing as NDJSON lines or as the pieces of a JSON array"""
+    ndjson = mimetype == "application/x-ndjson"
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+    encode_row = encoder(fields)
+
+    count = 0
+    chunk = [] if ndjson else [b"["]
+    for row in rows:
+        if ndjson:
+            chunk.append(encode_row(row) + b"\n")
+        else:
+            chunk.append((b"," if count else b"") + encode_row(row))
+        count += 1
+        if len(chunk) >= batch_size:
+            yield b"".join(chunk)
+            chunk = []
+    if not ndjson:
+        chunk.append(b"]\n")
+    yield b"".join(chunk)
+    app.logger.info("Streamed %d promotions", count)
+
+
+######################################################################
+# Sends JSON that is already encoded, such as from the snapshot
+######################################################################
+def json_response(body, headers=None):
+    """Returns a 200 response with the same bytes jsonify() would send"""
+    return app.response_class(body + b"\n", status.HTTP_200_OK, headers, mimetype=app.json.mimetype)
+
+
+######################################################################
+# Conditional GET
+######################################################################
+def cache_headers(etag):
+    """Returns the ETag and Cache-Control headers of a read"""
+    return {"ETag": f'"{etag}"', "Cache-Control": app.config["CACHE_CONTROL"]}
+
+
+def entry_response(entry, fields=FIELDS):
+    """Returns a Promotion, or 304 Not Modified if the client has this version"""
+    etag = f"{entry.promo_id}.{entry.version}"
+    if fields != FIELDS:
+        etag += ":" + ",".join(fields)
+    headers = cache_headers(etag)
+    if request.if_none_match.contains_weak(etag):
+        return "", status.HTTP_304_NOT_MODIFIED, headers
+    body = entry.body if isinstance(entry.body, bytes) else encode(entry.body.serialize())
+    return json_response(body, headers)
+
+
 ######################################################################
 # Logs error messages before aborting
 ######################################################################
@@ -0,0 +1,7 @@
+"""
+Test suites for the Promotions service
+"""
+import os
+
+# The test databases start out empty, so the app migrates them when it starts
+os.environ.setdefault("DB_MIGRATE_ON_BOOT", "True")
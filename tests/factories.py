@@ -18,7 +18,7 @@ class PromotionsFactory(factory.Factory):
         model = Promotions
 
     promo_id = factory.Sequence(lambda n: n)
-    cust_promo_code = factory.Faker("word")
+    cust_promo_code = factory.Sequence(lambda n: f"PROMO{n}")
     type = FuzzyChoice(choices=[Type.PERCENT, Type.SAVING, Type.BOGO])
     value = FuzzyInteger(0, 100)
     quantity = FuzzyInteger(0, 1000)
@@ -0,0 +1,81 @@
+"""
+Records the SQL statements, commits and allocations of a block of code
+
+Used by test_budgets.py to hold every route to the budget declared for it
+in budgets.json, down to the shape and order of each statement.
+"""
+import re
+import difflib
+import tracemalloc
+from sqlalchemy import event
+from service.models import db, RoutingSession
+
+# The verb of a statement and the tables it names
+VERB = re.compile(r"^\s*(\w+)")
+TABLES = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN|TABLE)\s+\"?(\w+)", re.IGNORECASE)
+
+
+def fingerprint(statement):
+    """Returns the shape of a statement, like "SELECT promotions" """
+    verb = VERB.match(statement)
+    tables = dict.fromkeys(table.lower() for table in TABLES.findall(statement))
+    return " ".join([verb.group(1).upper() if verb else "?", *tables])
+
+
+class Recorder:
+    """Context manager that records what the code inside it costs
+
+    Attributes:
+        statements (list): the SQL of every statement executed
+        commits (int): the session commits, including empty ones
+        allocated (int): the peak bytes allocated above the starting point
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+        self.allocated = 0
+        self._start = 0
+
+    def __enter__(self):
+        event.listen(db.engine, "before_cursor_execute", self._statement)
+        event.listen(RoutingSession, "after_commit", self._commit)
+        tracemalloc.start()
+        self._start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc):
+        self.allocated = tracemalloc.get_traced_memory()[1] - self._start
+        tracemalloc.stop()
+        event.remove(RoutingSession, "after_commit", self._commit)
+        event.remove(db.engine, "before_cursor_execute", self._statement)
+
+    def _statement(self, _conn, _cursor, statement, _parameters, _context, _executemany):
+        self.statements.append(statement)
+
+    def _commit(self, _session):
+        self.commits += 1
+
+    @property
+    def fingerprints(self):
+        """The shape of each statement, in order"""
+        return [fingerprint(statement) for statement in self.statements]
+
+    def over(self, budget):
+        """Returns a description of how the recording went over a budget or
+        issued other statements than it lists, in order, or an empty string
+        when it kept to it"""
+        problems = []
+        if len(self.statements) > len(budget["statements"]):
+            problems.append(f"{len(self.statements)} statements, budget {len(budget['statements'])}")
+        elif self.fingerprints != budget["statements"]:
+            problems.append("statements differ from the budget")
+        if self.commits > budget["commits"]:
+            problems.append(f"{self.commits} commits, budget {budget['commits']}")
+        if self.allocated > budget["allocated_kb"] * 1024:
+            problems.append(f"{self.allocated / 1024:.0f} KB allocated, budget {budget['allocated_kb']} KB")
+        if not problems:
+            return ""
+        diff = difflib.unified_diff(budget["statements"], self.fingerprints, "budget", "issued", lineterm="")
+        issued = (f"  {number}: {statement}" for number, statement in enumerate(self.statements, 1))
+        return "\n".join(["; ".join(problems), *diff, "statements issued:", *issued])
@@ -0,0 +1,63 @@
+"""
+Test cases for the in-process caches
+"""
+from unittest import TestCase
+from service.common.cache import LRUCache
+
+
+class FakeTimer:  # pylint: disable=too-few-public-methods
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(TestCase):
+    """LRUCache Tests"""
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = LRUCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_get_and_set(self):
+        """It should return cached values and None for misses"""
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("c"), 3)
+
+    def test_entries_expire(self):
+        """It should expire entries after the time to live"""
+        self.cache.set("a", 1)
+        self.timer.now = 11
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_discard_and_clear(self):
+        """It should discard one entry or clear them all"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.discard("a")
+        self.cache.discard("missing")
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_disabled(self):
+        """It should not cache anything when configured off"""
+        self.cache.configure(maxsize=10, ttl=0)
+        self.cache.set("a", 1)
+        self.assertIsNone(self.cache.get("a"))
@@ -2,12 +2,17 @@
 CLI Command Extensions for Flask
 """
 import os
+import json
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
+import numpy as np
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import db_create, db_upgrade, db_reset, price_carts  # noqa: E402
+from service.common.migrations import LATEST, MigrationError
+from service.common.batch_pricing import Catalog
 
 
 class TestFlaskCLI(TestCase):
@@ -16,10 +21,55 @@ class TestFlaskCLI(TestCase):
     def setUp(self):
         self.runner = CliRunner()
 
+    @patch('service.common.cli_commands.migrations')
     @patch('service.common.cli_commands.db')
-    def test_db_create(self, db_mock):
+    def test_db_create(self, db_mock, migrations_mock):
         """It should call the db-create command"""
         db_mock.return_value = MagicMock()
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+            migrations_mock.upgrade.assert_called_once_with(db_mock.engine)
+
+    def test_db_upgrade(self):
+        """It should run the pending migrations with the db-upgrade command"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True), app.app_context():
+            result = self.runner.invoke(db_upgrade)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Ran 0 migration(s)", result.output)
+        self.assertIn(f"the schema is at version {LATEST}", result.output)
+
+    @patch('service.common.cli_commands.migrations.upgrade')
+    def test_db_upgrade_error(self, upgrade_mock):
+        """It should report a migration that cannot run"""
+        upgrade_mock.side_effect = MigrationError("duplicate codes")
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True), app.app_context():
+            result = self.runner.invoke(db_upgrade)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("duplicate codes", result.output)
+
+    @patch('service.common.cli_commands.Promotions')
+    def test_db_reset(self, promotions_mock):
+        """It should call the db-reset command only once confirmed"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_reset, input="n\n")
+            self.assertNotEqual(result.exit_code, 0)
+            promotions_mock.truncate.assert_not_called()
+            result = self.runner.invoke(db_reset, ["--yes"])
+            self.assertEqual(result.exit_code, 0)
+            promotions_mock.truncate.assert_called_once()
+
+    @patch('service.common.batch_pricing.load_catalog')
+    def test_price_carts(self, load_mock):
+        """It should price a file of carts with the price-carts command"""
+        load_mock.return_value = Catalog(np.array([1]), np.array([5]), np.array([3], dtype=np.int8), np.array([0]))
+        cart = {"id": "a", "items": [{"product_id": 1, "quantity": 2, "unit_price": 4}]}
+        with tempfile.TemporaryDirectory() as folder:
+            source, sink = os.path.join(folder, "carts.ndjson"), os.path.join(folder, "priced.ndjson")
+            with open(source, "w", encoding="utf-8") as carts:
+                carts.write(json.dumps(cart) + "\n")
+            result = self.runner.invoke(price_carts, [source, sink, "--workers", "0"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Priced 1 carts", result.output)
+            with open(sink, encoding="utf-8") as priced:
+                self.assertEqual(json.loads(priced.read())["best_promo_ids"], [5])
@@ -6,9 +6,10 @@ import os
 import logging
 from unittest import TestCase
 from unittest.mock import patch
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import func, insert, select
 from wsgi import app
-from service.models import Promotions, Type, DataValidationError, db
+from service.models import Promotions, PromotionChanges, PromotionLeases, Type, DataValidationError, db, code_cache
 from .factories import PromotionsFactory
 
 DATABASE_URI = os.getenv(
@@ -41,6 +42,7 @@ class TestCaseBase(TestCase):
         """This runs before each test"""
         db.session.query(Promotions).delete()  # clean up the last tests
         db.session.commit()
+        code_cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -121,6 +123,25 @@ class TestCaseBase(TestCase):
         self.assertEqual(found_promotions.product_id, promotions.product_id)
         self.assertEqual(found_promotions.dev_created_at, promotions.dev_created_at)
 
+    def test_create_many(self):
+        """It should create many Promotions in batches"""
+        promotions = [PromotionsFactory() for _ in range(5)]
+        promo_ids, errors = Promotions.create_many(promotions, batch_size=2)
+        self.assertEqual(errors, {})
+        self.assertEqual(len(promo_ids), 5)
+        for promo_id, promotion in zip(promo_ids, promotions):
+            found = Promotions.find(promo_id)
+            self.assertEqual(found.cust_promo_code, promotion.cust_promo_code)
+
+    def test_create_many_atomic_errors(self):
+        """It should name the rows that failed an atomic create and create none"""
+        promotions = [PromotionsFactory() for _ in range(3)]
+        promotions[2].quantity = None
+        promo_ids, errors = Promotions.create_many(promotions)
+        self.assertEqual(promo_ids, [None, None, None])
+        self.assertEqual(errors, {2: "The database rejected this Promotion"})
+        self.assertEqual(Promotions.all(), [])
+
     def test_update_a_promotion(self):
         """It should Update a Promotion"""
         promotions = PromotionsFactory()
@@ -170,6 +191,122 @@ class TestCaseBase(TestCase):
         promotions = Promotions.all()
         self.assertEqual(len(promotions), 5)
 
+    def test_find_page(self):
+        """It should return keyset pages of Promotions"""
+        for _ in range(5):
+            PromotionsFactory().create()
+        page = Promotions.find_page(limit=3)
+        self.assertEqual(len(page), 3)
+        rest = Promotions.find_page(after=page[-1].sort_key("promo_id"), limit=3)
+        self.assertEqual(len(rest), 2)
+        ids = [promotion.promo_id for promotion in page + rest]
+        self.assertEqual(ids, sorted(ids))
+        page = Promotions.find_page(sort="end_date", limit=5, descending=True)
+        keys = [promotion.sort_key("end_date") for promotion in page]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertRaises(DataValidationError, Promotions.find_page, sort="value")
+
+    def test_find_by_filters(self):
+        """It should find Promotions by product, active flag, code and dates"""
+        today = date.today()
+        live = PromotionsFactory(
+            product_id=7, active=True, cust_promo_code="LIVE",
+            start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+        )
+        live.create()
+        ended = PromotionsFactory(
+            product_id=7, active=True, cust_promo_code="ENDED",
+            start_date=today - timedelta(days=9), end_date=today - timedelta(days=2),
+        )
+        ended.create()
+        other = PromotionsFactory(
+            product_id=8, active=False, cust_promo_code="OTHER",
+            start_date=today, end_date=today,
+        )
+        other.create()
+
+        def ids(query):
+            return sorted(promotion.promo_id for promotion in query)
+
+        self.assertEqual(ids(Promotions.find_by_product_id(7)), sorted([live.promo_id, ended.promo_id]))
+        self.assertEqual(len(Promotions.find_by_product_id([7, 8]).all()), 3)
+        self.assertEqual(ids(Promotions.find_by_active(False)), [other.promo_id])
+        self.assertEqual(ids(Promotions.find_by_cust_promo_code("ENDED")), [ended.promo_id])
+        self.assertEqual(ids(Promotions.find_active_on(today)), [live.promo_id])
+        self.assertEqual(
+            ids(Promotions.find_by_date_range(start=today - timedelta(days=1))),
+            sorted([live.promo_id, other.promo_id]),
+        )
+        self.assertEqual(ids(Promotions.find_by_date_range(end=today)), sorted([ended.promo_id, other.promo_id]))
+        # filters compose when a query is passed along
+        query = Promotions.find_by_product_id(7)
+        self.assertEqual(ids(Promotions.find_active_on(today, query=query)), [live.promo_id])
+
+    def test_find_by_code(self):
+        """It should find a Promotion by its code ignoring case"""
+        promotion = PromotionsFactory(cust_promo_code="Summer10")
+        promotion.create()
+        found = Promotions.find_by_code("SUMMER10")
+        self.assertEqual(found.promo_id, promotion.promo_id)
+        self.assertIsNone(Promotions.find_by_code("WINTER10"))
+
+    def test_code_is_unique(self):
+        """It should not create two Promotions with the same code"""
+        PromotionsFactory(cust_promo_code="ONCE").create()
+        duplicate = PromotionsFactory(cust_promo_code="once")
+        self.assertRaises(DataValidationError, duplicate.create)
+
+    def test_writes_evict_cached_codes(self):
+        """It should evict cached codes when a Promotion changes"""
+        promotion = PromotionsFactory(cust_promo_code="OLD")
+        promotion.create()
+        code_cache.set("old", promotion.serialize())
+        promotion = Promotions.find(promotion.promo_id)
+        promotion.cust_promo_code = "NEW"
+        code_cache.set("new", {})
+        promotion.update()
+        self.assertIsNone(code_cache.get("old"))
+        self.assertIsNone(code_cache.get("new"))
+        code_cache.set("new", promotion.serialize())
+        code_cache.set("other", {})
+        promotion.cancel()
+        self.assertIsNone(code_cache.get("new"))
+        self.assertEqual(code_cache.get("other"), {})
+        promotion = Promotions.find(promotion.promo_id)
+        code_cache.set("new", promotion.serialize())
+        promotion.delete()
+        self.assertIsNone(code_cache.get("new"))
+
+    def test_redeem(self):
+        """It should redeem a live Promotion until its quantity runs out"""
+        today = date.today()
+        promotion = PromotionsFactory(
+            active=True, quantity=3, start_date=today, end_date=today
+        )
+        promotion.create()
+        redemption = Promotions.redeem(promotion.promo_id, 2)
+        self.assertEqual(redemption.quantity, 1)
+        self.assertIsNone(Promotions.redeem(promotion.promo_id, 2))
+        redemption = Promotions.redeem_code(promotion.cust_promo_code.lower())
+        self.assertEqual(redemption.promo_id, promotion.promo_id)
+        self.assertEqual(redemption.quantity, 0)
+        self.assertIsNone(Promotions.redeem(promotion.promo_id))
+        self.assertEqual(Promotions.find(promotion.promo_id).quantity, 0)
+
+    def test_redeem_not_live(self):
+        """It should not redeem an inactive, expired or missing Promotion"""
+        today = date.today()
+        inactive = PromotionsFactory(active=False, quantity=5, start_date=today, end_date=today)
+        inactive.create()
+        expired = PromotionsFactory(
+            active=True, quantity=5, start_date=today - timedelta(days=5),
+            end_date=today - timedelta(days=1),
+        )
+        expired.create()
+        self.assertIsNone(Promotions.redeem(inactive.promo_id))
+        self.assertIsNone(Promotions.redeem(expired.promo_id))
+        self.assertIsNone(Promotions.redeem(0))
+
     def test_serialize_a_promotions(self):
         """It should serialize a Promotions"""
         promotions = PromotionsFactory()
@@ -272,6 +409,43 @@ class TestCaseBase(TestCase):
         )
         self.assertEqual(promotions[0].active, False)
 
+    def test_versions(self):
+        """It should bump the version on every kind of update"""
+        promotion = PromotionsFactory(active=True, quantity=5, start_date=date.today(), end_date=date.today())
+        promotion.create()
+        self.assertEqual(promotion.version, 1)
+        list_versions = {Promotions.list_version()}
+        promotion.value = 7
+        promotion.update()
+        self.assertEqual(promotion.version, 2)
+        self.assertNotIn(Promotions.list_version(), list_versions)
+        list_versions.add(Promotions.list_version())
+        # redemptions only move quantities and leave the list version alone
+        Promotions.redeem(promotion.promo_id, 1)
+        self.assertIn(Promotions.list_version(), list_versions)
+        Promotions.update_where(Promotions.find_by_ids([promotion.promo_id]), {"value": 8})
+        db.session.expire_all()
+        self.assertEqual(Promotions.find(promotion.promo_id).version, 4)
+        self.assertNotIn(Promotions.list_version(), list_versions)
+        list_versions.add(Promotions.list_version())
+        # the list version keeps changing after a reset, so ETags never repeat
+        Promotions.truncate()
+        self.assertNotIn(Promotions.list_version(), list_versions)
+
+    def test_change_log(self):
+        """It should version the list with a log that stays small"""
+        highest, count = Promotions.list_version()
+        # a write that took its number first but commits last still counts
+        lowest = db.session.execute(select(func.min(PromotionChanges.change_id))).scalar()
+        db.session.execute(insert(PromotionChanges).values(change_id=lowest - 1))
+        db.session.commit()
+        self.assertEqual(Promotions.list_version(), (highest, count + 1))
+        with patch("service.models.KEEP_CHANGES", 2):
+            while PromotionChanges.record(db.session) % 2:
+                pass
+            db.session.commit()
+        self.assertEqual(Promotions.list_version()[1], 2)
+
 
 ######################################################################
 #  T E S T   E X C E P T I O N   H A N D L E R S
@@ -293,6 +467,48 @@ class TestExceptionHandlers(TestCaseBase):
         promotions = PromotionsFactory()
         self.assertRaises(DataValidationError, promotions.update)
 
+    @patch("service.models.db.session.commit")
+    def test_create_many_exception(self, exception_mock):
+        """It should catch a create many exception"""
+        exception_mock.side_effect = Exception()
+        promotions = [PromotionsFactory()]
+        self.assertRaises(DataValidationError, Promotions.create_many, promotions)
+
+    @patch("service.models.db.session.commit")
+    def test_update_where_exception(self, exception_mock):
+        """It should catch a bulk update exception"""
+        exception_mock.side_effect = Exception()
+        query = Promotions.find_by_ids([1, 2])
+        self.assertRaises(DataValidationError, Promotions.cancel_where, query)
+
+    @patch("service.models.db.session.commit")
+    def test_delete_where_exception(self, exception_mock):
+        """It should catch a bulk delete exception"""
+        exception_mock.side_effect = Exception()
+        query = Promotions.find_by_ids([1, 2])
+        self.assertRaises(DataValidationError, Promotions.delete_where, query)
+
+    @patch("service.models.db.session.commit")
+    def test_truncate_exception(self, exception_mock):
+        """It should catch a truncate exception"""
+        exception_mock.side_effect = Exception()
+        self.assertRaises(DataValidationError, Promotions.truncate)
+
+    @patch("service.models.db.session.commit")
+    def test_redeem_exception(self, exception_mock):
+        """It should catch a redeem exception"""
+        exception_mock.side_effect = Exception()
+        self.assertRaises(DataValidationError, Promotions.redeem, 1)
+
+    @patch("service.models.db.session.commit")
+    def test_lease_exceptions(self, exception_mock):
+        """It should catch lease exceptions"""
+        exception_mock.side_effect = Exception()
+        now = datetime.now(timezone.utc)
+        self.assertRaises(DataValidationError, PromotionLeases.open, Promotions.promo_id == 1, 10, 1, now)
+        self.assertRaises(DataValidationError, PromotionLeases.give_back, 1, 1)
+        self.assertRaises(DataValidationError, PromotionLeases.discard, PromotionLeases.expires_at <= now)
+
     @patch("service.models.db.session.commit")
     def test_delete_exception(self, exception_mock):
         """It should catch a delete exception"""
@@ -0,0 +1,72 @@
+"""
+Test cases for the Connection Pool settings and telemetry
+"""
+import os
+import sqlite3
+import importlib
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from sqlalchemy import exc
+from sqlalchemy.pool import StaticPool
+from wsgi import app
+from service import config
+from service.models import db
+from service.common import pool
+from service.common.pool import MeteredQueuePool, pool_stats
+
+
+class TestPool(TestCase):
+    """Connection Pool Tests"""
+
+    def tearDown(self):
+        importlib.reload(config)
+
+    def test_engine_options(self):
+        """It should build the engine from SQLALCHEMY_ENGINE_OPTIONS"""
+        options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+        self.assertEqual(options["pool_size"], app.config["DB_POOL_SIZE"])
+        self.assertTrue(options["pool_pre_ping"])
+        with app.app_context():
+            self.assertIsInstance(db.engine.pool, MeteredQueuePool)
+            self.assertEqual(db.engine.pool.size(), app.config["DB_POOL_SIZE"])
+
+    def test_worker_defaults(self):
+        """It should split the pod's connections between its workers"""
+        environment = {"WEB_CONCURRENCY": "4", "DB_POD_CONNECTIONS": "20", "DATABASE_URI": "postgresql+psycopg://x/y"}
+        with patch.dict(os.environ, environment):
+            importlib.reload(config)
+        self.assertEqual((config.DB_POOL_SIZE, config.DB_MAX_OVERFLOW), (2, 3))
+        connect_args = config.SQLALCHEMY_ENGINE_OPTIONS["connect_args"]
+        self.assertEqual(connect_args, {"options": "-c statement_timeout=15000", "prepare_threshold": 5})
+
+        environment = {"WEB_CONCURRENCY": "16", "DB_PREPARE_THRESHOLD": "none", "DATABASE_URI": "postgresql://x/y"}
+        with patch.dict(os.environ, environment):
+            importlib.reload(config)
+        self.assertEqual((config.DB_POOL_SIZE, config.DB_MAX_OVERFLOW), (1, 1))
+        self.assertIsNone(config.SQLALCHEMY_ENGINE_OPTIONS["connect_args"]["prepare_threshold"])
+
+    def test_memory_database(self):
+        """It should drop the pool options for SQLite in memory"""
+        other = Flask(__name__)
+        other.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        other.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_size": 3, "max_overflow": 1, "pool_pre_ping": True}
+        pool.init_app(other)
+        self.assertEqual(other.config["SQLALCHEMY_ENGINE_OPTIONS"], {"pool_pre_ping": True})
+
+    def test_stats(self):
+        """It should count checkouts, waits and timeouts"""
+        metered = MeteredQueuePool(lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=1, timeout=0.01)
+        engine = type("Engine", (), {"pool": metered})
+        first, second = metered.connect(), metered.connect()
+        stats = pool_stats(engine)
+        self.assertEqual((stats["size"], stats["checked_out"], stats["overflow"]), (1, 2, 1))
+        self.assertRaises(exc.TimeoutError, metered.connect)
+        first.close()
+        second.close()
+        stats = pool_stats(engine)
+        self.assertEqual((stats["checked_out"], stats["checkouts"], stats["timeouts"]), (0, 2, 1))
+        self.assertGreaterEqual(stats["max_wait_seconds"], 0.01)
+        self.assertGreaterEqual(stats["wait_seconds"], stats["max_wait_seconds"])
+        static = type("Engine", (), {"pool": StaticPool(lambda: sqlite3.connect(":memory:"))})
+        self.assertEqual(pool_stats(static), {"pool": "StaticPool"})
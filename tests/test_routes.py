@@ -3,12 +3,18 @@ TestPromotions API Service Test Suite
 """
 
 import os
+import json
 import logging
 from datetime import date, timedelta
+from types import SimpleNamespace
 from unittest import TestCase
+from unittest.mock import patch
 from wsgi import app
 from service.common import status
-from service.models import db, Promotions
+from service.models import db, Promotions, Type, code_cache
+from service.common.snapshot import snapshot, encode
+from service.common.pagination import encode_cursor
+from service.common.shared_snapshot import Entry
 from .factories import PromotionsFactory
 
 DATABASE_URI = os.getenv(
@@ -45,6 +51,7 @@ class TestYourResourceService(TestCase):
         self.client = app.test_client()
         db.session.query(Promotions).delete()  # clean up the last tests
         db.session.commit()
+        code_cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -133,6 +140,119 @@ class TestYourResourceService(TestCase):
             new_promotions["dev_created_at"], test_promotions.dev_created_at.isoformat()
         )
 
+    def test_create_promotions_bulk(self):
+        """It should Create many Promotions from a JSON array"""
+        records = [PromotionsFactory().serialize() for _ in range(5)]
+        app.config["BULK_BATCH_SIZE"] = 2
+        try:
+            response = self.client.post(f"{BASE_URL}/bulk", json=records)
+        finally:
+            app.config["BULK_BATCH_SIZE"] = 1000
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(data["created"], 5)
+        self.assertEqual(data["errors"], [])
+        for promo_id, record in zip(data["promo_ids"], records):
+            response = self.client.get(f"{BASE_URL}/{promo_id}")
+            self.assertEqual(response.get_json()["cust_promo_code"], record["cust_promo_code"])
+
+    def test_create_promotions_bulk_ndjson(self):
+        """It should Create many Promotions from NDJSON"""
+        body = "\n".join(json.dumps(PromotionsFactory().serialize()) for _ in range(3))
+        response = self.client.post(
+            f"{BASE_URL}/bulk", data=body + "\n\n", content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.get_json()["created"], 3)
+        response = self.client.post(
+            f"{BASE_URL}/bulk", data="{not json}", content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_promotions_bulk_atomic(self):
+        """It should not Create any Promotions if one of them is bad"""
+        records = [PromotionsFactory().serialize() for _ in range(3)]
+        del records[1]["type"]
+        response = self.client.post(f"{BASE_URL}/bulk", json=records)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([e["index"] for e in response.get_json()["errors"]], [1])
+        # a duplicate code is only caught by the database
+        records = [PromotionsFactory().serialize() for _ in range(3)]
+        records[2]["cust_promo_code"] = records[0]["cust_promo_code"].lower()
+        response = self.client.post(f"{BASE_URL}/bulk", json=records)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.get_json()["errors"]
+        self.assertEqual([e["index"] for e in errors], [2])
+        self.assertIn("repeats the one at index 0", errors[0]["message"])
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
+        # and so is a code that is already taken
+        taken = PromotionsFactory()
+        taken.create()
+        records = [PromotionsFactory().serialize() for _ in range(3)]
+        records[1]["cust_promo_code"] = taken.cust_promo_code.upper()
+        response = self.client.post(f"{BASE_URL}/bulk", json=records)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.get_json()["errors"]
+        message = f"cust_promo_code '{records[1]['cust_promo_code']}' already exists"
+        self.assertEqual(errors, [{"index": 1, "message": message}])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)
+
+    def test_create_promotions_bulk_best_effort(self):
+        """It should Create the good Promotions and report the bad ones"""
+        records = [PromotionsFactory().serialize() for _ in range(4)]
+        records[1]["active"] = "yes"
+        records[3]["cust_promo_code"] = records[0]["cust_promo_code"]
+        response = self.client.post(
+            f"{BASE_URL}/bulk", query_string={"mode": "best_effort"}, json=records
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(data["created"], 2)
+        self.assertEqual([e["index"] for e in data["errors"]], [1, 3])
+        self.assertEqual(data["errors"][1]["message"], f"cust_promo_code '{records[3]['cust_promo_code']}' already exists")
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_create_promotions_bulk_bad_request(self):
+        """It should not Create Promotions in bulk from a bad request"""
+        response = self.client.post(f"{BASE_URL}/bulk", json={"not": "a list"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/bulk", query_string={"mode": "some"}, json=[])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/bulk", data="[]", content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_delete_promotions_bulk(self):
+        """It should Delete every Promotion matching a filter"""
+        promotions = self._create_promotions(3)
+        promo_ids = [promotion.promo_id for promotion in promotions[:2]]
+        response = self.client.delete(
+            BASE_URL, query_string={"promo_id": promo_ids, "return_ids": "true"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"count": 2, "promo_ids": sorted(promo_ids)})
+        remaining = self.client.get(BASE_URL).get_json()
+        self.assertEqual([p["promo_id"] for p in remaining], [promotions[2].promo_id])
+        response = self.client.delete(
+            BASE_URL, query_string={"cust_promo_code": promotions[2].cust_promo_code}
+        )
+        self.assertEqual(response.get_json(), {"count": 1})
+        # a filter is required
+        response = self.client.delete(BASE_URL)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_reset_promotions(self):
+        """It should remove every Promotion only when resets are allowed"""
+        self._create_promotions(3)
+        response = self.client.post(f"{BASE_URL}/reset")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        app.config["ALLOW_RESET"] = True
+        try:
+            response = self.client.post(f"{BASE_URL}/reset")
+        finally:
+            app.config["ALLOW_RESET"] = False
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
+
     def test_update_promotion(self):
         """It should Update an existing Promotion"""
         self._create_promotions(1)
@@ -169,6 +289,140 @@ class TestYourResourceService(TestCase):
         response = self.client.get(BASE_URL + "?type=BOGO")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_get_promotion_list_paginated(self):
+        """It should page through Promotions with a cursor"""
+        promotions = self._create_promotions(5)
+        response = self.client.get(BASE_URL, query_string={"limit": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        seen = [promotion["promo_id"] for promotion in response.get_json()]
+        self.assertEqual(len(seen), 2)
+        while "X-Next-Cursor" in response.headers:
+            self.assertIn('rel="next"', response.headers["Link"])
+            response = self.client.get(
+                BASE_URL,
+                query_string={"limit": 2, "cursor": response.headers["X-Next-Cursor"]},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(promotion["promo_id"] for promotion in response.get_json())
+        self.assertEqual(seen, sorted(promotion.promo_id for promotion in promotions))
+
+    def test_get_promotion_list_sorted(self):
+        """It should page through Promotions sorted by a date in descending order"""
+        promotions = self._create_promotions(5)
+        expected = sorted(
+            promotions, key=lambda p: (p.end_date, p.promo_id), reverse=True
+        )
+        response = self.client.get(BASE_URL, query_string={"limit": 3, "sort": "-end_date"})
+        data = response.get_json()
+        cursor = response.headers["X-Next-Cursor"]
+        response = self.client.get(
+            BASE_URL, query_string={"sort": "-end_date", "cursor": cursor}
+        )
+        data.extend(response.get_json())
+        self.assertNotIn("X-Next-Cursor", response.headers)
+        self.assertEqual(
+            [promotion["promo_id"] for promotion in data],
+            [promotion.promo_id for promotion in expected],
+        )
+
+    def test_get_promotion_list_bad_page(self):
+        """It should not page with a bad limit, sort or cursor"""
+        for args in (
+            {"limit": "ten"},
+            {"limit": 0},
+            {"limit": 5, "sort": "value"},
+            {"cursor": "not-a-cursor"},
+            {"cursor": encode_cursor("promo_id", ["abc"])},
+            {"cursor": encode_cursor("promo_id", [True])},
+            {"sort": "end_date", "cursor": encode_cursor("end_date", [5, 1])},
+            {"sort": "end_date", "cursor": encode_cursor("end_date", ["2024-01-01", "1"])},
+        ):
+            response = self.client.get(BASE_URL, query_string=args)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_promotion_list_ndjson(self):
+        """It should stream a list of Promotions as NDJSON"""
+        promotions = self._create_promotions(3)
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        ids = [json.loads(line)["promo_id"] for line in lines]
+        self.assertEqual(ids, sorted(promotion.promo_id for promotion in promotions))
+
+    def test_stream_promotion_list_json(self):
+        """It should stream a list of Promotions as a chunked JSON array"""
+        response = self.client.get(BASE_URL, query_string={"stream": "true"})
+        self.assertEqual(response.get_data(as_text=True), "[]\n")
+        self._create_promotions(3)
+        expected = self.client.get(BASE_URL).get_json()
+        app.config["STREAM_BATCH_SIZE"] = 2
+        try:
+            response = self.client.get(BASE_URL, query_string={"stream": "true"})
+        finally:
+            app.config["STREAM_BATCH_SIZE"] = 500
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), expected)
+
+    def test_stream_long_promotion_list(self):
+        """It should stream an unpaged list longer than one batch"""
+        self._create_promotions(3)
+        expected = self.client.get(BASE_URL)
+        self.assertIn("Content-Length", expected.headers)
+        app.config["STREAM_BATCH_SIZE"] = 2
+        try:
+            response = self.client.get(BASE_URL)
+            self.assertNotIn("Content-Length", response.headers)
+            self.assertEqual(response.get_data(), expected.get_data())
+        finally:
+            app.config["STREAM_BATCH_SIZE"] = 500
+        self.assertEqual(response.headers["ETag"], expected.headers["ETag"])
+
+    def test_get_promotion_list_filtered(self):
+        """It should filter the list of Promotions on the server"""
+        today = date.today()
+        for code, product_id, active, days in (
+            ("LIVE", 7, True, 1),
+            ("DONE", 7, True, -2),
+            ("OFF", 8, False, 1),
+        ):
+            promotion = PromotionsFactory(
+                cust_promo_code=code,
+                product_id=product_id,
+                active=active,
+                start_date=today - timedelta(days=3),
+                end_date=today + timedelta(days=days),
+            )
+            response = self.client.post(BASE_URL, json=promotion.serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        def codes(**args):
+            response = self.client.get(BASE_URL, query_string=args)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return sorted(promotion["cust_promo_code"] for promotion in response.get_json())
+
+        self.assertEqual(codes(product_id=7), ["DONE", "LIVE"])
+        self.assertEqual(codes(product_id=[7, 8], active="false"), ["OFF"])
+        self.assertEqual(codes(cust_promo_code="LIVE"), ["LIVE"])
+        self.assertEqual(codes(active_on=today.isoformat()), ["LIVE"])
+        self.assertEqual(codes(product_id=8, active_on=today.isoformat()), [])
+        self.assertEqual(codes(end_date=today.isoformat()), ["DONE"])
+        self.assertEqual(codes(start_date=today.isoformat()), [])
+        self.assertEqual(codes(type="", cust_promo_code=""), ["DONE", "LIVE", "OFF"])
+
+    def test_get_promotion_list_bad_filter(self):
+        """It should not filter Promotions with bad values"""
+        for args in (
+            {"type": "percent"},
+            {"product_id": "seven"},
+            {"product_id": "true"},
+            {"active": "maybe"},
+            {"active_on": "tomorrow"},
+        ):
+            response = self.client.get(BASE_URL, query_string=args)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_promotion(self):
         """It should Get a single Promotion"""
         # get the id of a promotion
@@ -181,6 +435,29 @@ class TestYourResourceService(TestCase):
         data = response.get_json()
         self.assertEqual(data["promo_id"], test_promotion.promo_id)
 
+    def test_get_promotion_by_code(self):
+        """It should Get a single Promotion by its code"""
+        test_promotion = self._create_promotions(1)[0]
+        code = test_promotion.cust_promo_code
+        response = self.client.get(f"{BASE_URL}/code/{code.lower()}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["promo_id"], test_promotion.promo_id)
+        # served from the cache until the promotion changes
+        self.assertIsNotNone(code_cache.get(code.lower()))
+        data["value"] = 99
+        response = self.client.put(f"{BASE_URL}/{test_promotion.promo_id}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(code_cache.get(code.lower()))
+        response = self.client.get(f"{BASE_URL}/code/{code}")
+        self.assertEqual(response.get_json()["value"], 99)
+
+    def test_get_promotion_by_code_not_found(self):
+        """It should not Get a Promotion by a code that is not found"""
+        response = self.client.get(f"{BASE_URL}/code/NOPE")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("was not found", response.get_json()["message"])
+
     def test_get_promotion_not_found(self):
         """It should not Get a Promotion thats not found"""
         response = self.client.get(f"{BASE_URL}/0")
@@ -199,6 +476,79 @@ class TestYourResourceService(TestCase):
         response = self.client.get(f"{BASE_URL}/{test_promotion.promo_id}")
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def _create_live_promotion(self, quantity):
+        """Creates a Promotion that can be redeemed today"""
+        promotion = PromotionsFactory(
+            active=True, quantity=quantity, start_date=date.today(), end_date=date.today()
+        )
+        response = self.client.post(BASE_URL, json=promotion.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.get_json()
+
+    def test_redeem_promotion(self):
+        """It should redeem a Promotion until it runs out"""
+        promotion = self._create_live_promotion(3)
+        url = f"{BASE_URL}/{promotion['promo_id']}/redeem"
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["redeemed"], 1)
+        self.assertEqual(data["remaining"], 2)
+        response = self.client.post(url, json={"quantity": 2})
+        self.assertEqual(response.get_json()["remaining"], 0)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.client.post(f"{BASE_URL}/0/redeem")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_redeem_promotion_by_code(self):
+        """It should redeem a Promotion by its code"""
+        promotion = self._create_live_promotion(1)
+        url = f"{BASE_URL}/code/{promotion['cust_promo_code']}/redeem"
+        response = self.client.post(url, json={"quantity": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["promo_id"], promotion["promo_id"])
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.client.post(f"{BASE_URL}/code/NOPE/redeem")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_redeem_promotion_bad_quantity(self):
+        """It should not redeem a bad quantity"""
+        promotion = self._create_live_promotion(5)
+        url = f"{BASE_URL}/{promotion['promo_id']}/redeem"
+        for body in ({"quantity": 0}, {"quantity": "2"}, {"quantity": True}, [1]):
+            response = self.client.post(url, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, data="2", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_evaluate_cart(self):
+        """It should price a cart with the best live Promotion per line"""
+        promotion = PromotionsFactory(
+            type=Type.PERCENT, value=50, product_id=5, active=True, quantity=10,
+            start_date=date.today(), end_date=date.today(),
+        )
+        response = self.client.post(BASE_URL, json=promotion.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        promo_id = response.get_json()["promo_id"]
+        cart = {"items": [{"product_id": 5, "quantity": 2, "unit_price": 3.0}]}
+        response = self.client.post(f"{BASE_URL}/evaluate", json=cart)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["lines"][0]["best_promo_id"], promo_id)
+        self.assertEqual(data["total"], 3.0)
+        # the index is rebuilt once the promotion changes
+        self.client.put(f"{BASE_URL}/cancel/{promo_id}")
+        data = self.client.post(f"{BASE_URL}/evaluate", json=cart).get_json()
+        self.assertEqual(data["total"], 6.0)
+
+    def test_evaluate_cart_bad_request(self):
+        """It should not price a cart that is not a list of lines"""
+        for body in ([], {"items": "none"}, {"items": [{"product_id": 5}]}):
+            response = self.client.post(f"{BASE_URL}/evaluate", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_cancel_promotion(self):
         """It should cancel a promotion by changing its end date to yesterday."""
         cancel_promotion = self._create_promotions(1)[0]
@@ -213,6 +563,228 @@ class TestYourResourceService(TestCase):
         promotion = response.get_json()
         self.assertEqual(promotion, new_promotion)
 
+    def test_cancel_promotions_bulk(self):
+        """It should cancel every Promotion matching a filter"""
+        promotions = self._create_promotions(4)
+        targets = sorted(promotion.promo_id for promotion in promotions[:3])
+        response = self.client.post(
+            f"{BASE_URL}/cancel",
+            query_string={"return_ids": "true"},
+            json={"promo_id": targets},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"count": 3, "promo_ids": targets})
+        yesterday = (date.today() - timedelta(days=1)).isoformat()
+        for promo_id in targets:
+            data = self.client.get(f"{BASE_URL}/{promo_id}").get_json()
+            self.assertFalse(data["active"])
+            self.assertEqual(data["end_date"], yesterday)
+        response = self.client.post(
+            f"{BASE_URL}/cancel",
+            json={"promo_id": promotions[3].promo_id, "type": "NOPE"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(
+            f"{BASE_URL}/cancel", json={"product_id": promotions[3].product_id}
+        )
+        self.assertEqual(response.get_json(), {"count": 1})
+
+    def test_update_promotions_bulk(self):
+        """It should apply the same changes to every Promotion matching a filter"""
+        promotions = self._create_promotions(3)
+        body = {
+            "filter": {"promo_id": [p.promo_id for p in promotions[:2]]},
+            "changes": {"value": 42, "product_id": None, "type": "SAVING"},
+        }
+        response = self.client.patch(BASE_URL, json=body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["count"], 2)
+        for promotion in promotions[:2]:
+            data = self.client.get(f"{BASE_URL}/{promotion.promo_id}").get_json()
+            self.assertEqual((data["value"], data["product_id"], data["type"]), (42, None, "SAVING"))
+        data = self.client.get(f"{BASE_URL}/{promotions[2].promo_id}").get_json()
+        self.assertEqual(data["product_id"], promotions[2].product_id)
+
+    def test_update_promotions_bulk_bad_request(self):
+        """It should not change Promotions in bulk without a filter or valid changes"""
+        for body in (
+            [],
+            {"changes": {"value": 1}},
+            {"filter": {}, "changes": {"value": 1}},
+            {"filter": {"type": "BOGO"}, "changes": {}},
+            {"filter": {"type": "BOGO"}, "changes": {"cust_promo_code": "SAME"}},
+            {"filter": {"type": "BOGO"}, "changes": {"quantity": None}},
+            {"filter": {"type": "BOGO"}, "changes": {"active": "sure"}},
+        ):
+            response = self.client.patch(BASE_URL, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/cancel", json={})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_unknown_keys(self):
+        """It should refuse a bulk change with a key it does not know or an empty value"""
+        promotions = self._create_promotions(2)
+        product_id = promotions[0].product_id
+        requests = [
+            ("DELETE", BASE_URL, {"product_id": product_id, "prodcut_id": 5}, None),
+            ("POST", f"{BASE_URL}/cancel", {}, {"product_id": product_id, "prodcut_id": 5}),
+            ("POST", f"{BASE_URL}/cancel", {"prodcut_id": 5}, {"product_id": product_id}),
+            ("PATCH", BASE_URL, {}, {"filter": {"product_id": product_id, "typo": 1}, "changes": {"value": 1}}),
+            ("PATCH", BASE_URL, {"prodcut_id": 5}, {"filter": {"product_id": product_id}, "changes": {"value": 1}}),
+            ("PATCH", BASE_URL, {}, {"filter": {"product_id": product_id}, "changes": {"value": 1}, "limit": 1}),
+            # an empty value is refused rather than dropped, which would widen the filter
+            ("DELETE", BASE_URL, {"product_id": product_id, "type": ""}, None),
+            ("POST", f"{BASE_URL}/cancel", {}, {"product_id": product_id, "active": ""}),
+            ("POST", f"{BASE_URL}/cancel", {}, {"product_id": product_id, "type": None}),
+            ("PATCH", BASE_URL, {}, {"filter": {"product_id": product_id, "promo_id": []}, "changes": {"value": 1}}),
+            ("PATCH", BASE_URL, {}, {"filter": {"product_id": [product_id, ""]}, "changes": {"value": 1}}),
+        ]
+        for method, path, args, body in requests:
+            with self.subTest(request=f"{method} {path} {args} {body}"):
+                response = self.client.open(path, method=method, query_string=args, json=body)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for promotion in promotions:
+            data = self.client.get(f"{BASE_URL}/{promotion.promo_id}").get_json()
+            self.assertEqual(data, promotion.serialize())
+
+    def test_reads_from_snapshot(self):
+        """It should serve unfiltered reads from a fresh snapshot"""
+        promotion = self._create_promotions(1)[0]
+        cached = dict(promotion.serialize(), value=-1)
+        entry = Entry(promotion.promo_id, 1, encode(cached))
+        view = SimpleNamespace(
+            get=lambda promo_id: entry if promo_id == promotion.promo_id else None,
+            by_code=lambda code: entry if code == promotion.cust_promo_code else None,
+            list_version=lambda: "digest",
+            listing=lambda: encode([cached]),
+        )
+        response = self.client.get(f"{BASE_URL}/{promotion.promo_id}")
+        direct = response.data
+        list_etag = self.client.get(BASE_URL).headers["ETag"]
+        with patch.object(snapshot, "view", return_value=view):
+            response = self.client.get(f"{BASE_URL}/{promotion.promo_id}")
+            self.assertEqual(response.get_json(), cached)
+            self.assertEqual(response.data, direct.replace(f'"value":{promotion.value}'.encode(), b'"value":-1'))
+            response = self.client.get(f"{BASE_URL}/{promotion.promo_id + 1}")
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get(f"{BASE_URL}/code/{promotion.cust_promo_code}")
+            self.assertEqual(response.get_json(), cached)
+            response = self.client.get(f"{BASE_URL}/code/NOPE")
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get(BASE_URL)
+            self.assertEqual(response.get_json(), [cached])
+            # the snapshot versions the list by what it serves
+            self.assertNotEqual(response.headers["ETag"], list_etag)
+            response = self.client.get(BASE_URL, headers={"If-None-Match": response.headers["ETag"]})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            # filtered reads still go to the database
+            response = self.client.get(BASE_URL, query_string={"type": promotion.type.name})
+            self.assertEqual(response.get_json()[0]["value"], promotion.value)
+
+    def test_conditional_get(self):
+        """It should answer 304 Not Modified until a Promotion changes"""
+        promotion = self._create_promotions(1)[0]
+        for url in (f"{BASE_URL}/{promotion.promo_id}", f"{BASE_URL}/code/{promotion.cust_promo_code}"):
+            response = self.client.get(url)
+            etag = response.headers["ETag"]
+            self.assertEqual(etag, f'"{promotion.promo_id}.1"')
+            self.assertEqual(response.headers["Cache-Control"], "no-cache")
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response.data, b"")
+            self.assertEqual(response.headers["ETag"], etag)
+            response = self.client.get(url, headers={"If-None-Match": "*"})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.put(f"{BASE_URL}/cancel/{promotion.promo_id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/{promotion.promo_id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], f'"{promotion.promo_id}.2"')
+
+    def test_conditional_list(self):
+        """It should version the list with every create, update and delete"""
+        promotions = self._create_promotions(2)
+        etags = set()
+
+        def check():
+            response = self.client.get(BASE_URL)
+            etag = response.headers["ETag"]
+            self.assertNotIn(etag, etags)
+            etags.add(etag)
+            response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response.headers["Vary"], "Accept")
+
+        check()
+        self.client.put(f"{BASE_URL}/cancel/{promotions[1].promo_id}")
+        check()
+        self.client.delete(f"{BASE_URL}/{promotions[0].promo_id}")
+        check()
+        self._create_promotions(1)
+        check()
+        # a reset that restarts the ids and puts the same rows back is a change too
+        promotions = [Promotions().deserialize(row) for row in self.client.get(BASE_URL).get_json()]
+        Promotions.truncate()
+        Promotions.create_many(promotions)
+        check()
+        # each filter and field set has its own version
+        response = self.client.get(BASE_URL, query_string={"product_id": -1})
+        self.assertNotIn(response.headers["ETag"], etags)
+        response = self.client.get(BASE_URL, query_string={"fields": "promo_id"})
+        self.assertNotIn(response.headers["ETag"], etags)
+        # streams and pages are read without versioning the list
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertNotIn("ETag", response.headers)
+        response = self.client.get(BASE_URL, query_string={"limit": 1})
+        self.assertNotIn("ETag", response.headers)
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+
+    def test_sparse_fieldsets(self):
+        """It should return only the requested fields"""
+        promotions = self._create_promotions(3)
+        fields = {"promo_id", "cust_promo_code", "type", "value"}
+        query = {"fields": "value, type,cust_promo_code,promo_id"}
+        response = self.client.get(BASE_URL, query_string=query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = [{field: promotion.serialize()[field] for field in fields} for promotion in promotions]
+        self.assertEqual(response.get_json(), expected)
+        self.assertEqual(response.data, json.dumps(expected, separators=(",", ":"), sort_keys=True).encode() + b"\n")
+
+        # the cursor still works when the sort key is not one of the fields
+        query = {"fields": "value", "limit": 2, "sort": "-end_date"}
+        response = self.client.get(BASE_URL, query_string=query)
+        page = response.get_json()
+        query["cursor"] = response.headers["X-Next-Cursor"]
+        page += self.client.get(BASE_URL, query_string=query).get_json()
+        self.assertEqual(len(page), 3)
+        self.assertEqual({tuple(row) for row in page}, {("value",)})
+
+        response = self.client.get(
+            BASE_URL, query_string={"fields": "active"}, headers={"Accept": "application/x-ndjson"}
+        )
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(lines, [{"active": promotion.active} for promotion in promotions])
+
+        promotion = promotions[0]
+        url = f"{BASE_URL}/{promotion.promo_id}"
+        response = self.client.get(url, query_string={"fields": "promo_id,quantity"})
+        self.assertEqual(response.get_json(), {"promo_id": promotion.promo_id, "quantity": promotion.quantity})
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, f'"{promotion.promo_id}.1:promo_id,quantity"')
+        response = self.client.get(url, query_string={"fields": "quantity,promo_id"}, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/0", query_string={"fields": "value"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_sparse_fieldsets_bad_request(self):
+        """It should reject unknown fields"""
+        for url in (BASE_URL, f"{BASE_URL}/1"):
+            response = self.client.get(url, query_string={"fields": "promo_id,version"})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("version", response.get_json()["message"])
+
     def test_cancel_promotion_error(self):
         """It should give 404 error on cancel promotion"""
         _ = self._create_promotions(1)[0]
@@ -0,0 +1,85 @@
+"""
+Test cases for the Shared Snapshot Files
+"""
+import os
+import json
+import tempfile
+from unittest import TestCase
+from service.common.shared_snapshot import Entry, SharedStore, SnapshotFile, digest, write_generation
+
+ROWS = [
+    (3, "alpha", b'{"promo_id":3}', 1),
+    (7, None, b'{"promo_id":7}', 4),
+    (12, "beta", b'{"promo_id":12}', 2),
+]
+
+
+class TestSharedSnapshot(TestCase):
+    """Shared Snapshot File Tests"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.directory = self.folder.name
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_round_trip(self):
+        """It should find Promotions by id and code in a written generation"""
+        snapshot = SnapshotFile(write_generation(self.directory, 4, ROWS))
+        self.assertEqual(snapshot.generation, 4)
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot.get(7), Entry(7, 4, b'{"promo_id":7}'))
+        self.assertEqual(snapshot.get(12), Entry(12, 2, b'{"promo_id":12}'))
+        self.assertIsNone(snapshot.get(5))
+        self.assertIsNone(snapshot.get(99))
+        self.assertEqual(snapshot.by_code("ALPHA"), Entry(3, 1, b'{"promo_id":3}'))
+        self.assertEqual(snapshot.by_code("beta").promo_id, 12)
+        self.assertIsNone(snapshot.by_code("gamma"))
+        self.assertIsNone(snapshot.by_code(""))
+        self.assertEqual(json.loads(snapshot.listing()), [{"promo_id": 3}, {"promo_id": 7}, {"promo_id": 12}])
+        self.assertEqual(snapshot.list_version(), digest(snapshot.listing()))
+
+    def test_empty(self):
+        """It should write and read a generation without Promotions"""
+        snapshot = SnapshotFile(write_generation(self.directory, 1, []))
+        self.assertEqual(snapshot.listing(), b"[]")
+        self.assertEqual(snapshot.list_version(), digest(b"[]"))
+        self.assertIsNone(snapshot.get(1))
+        self.assertIsNone(snapshot.by_code("alpha"))
+
+    def test_not_a_snapshot(self):
+        """It should refuse files that are not snapshots"""
+        path = os.path.join(self.directory, "other")
+        with open(path, "wb") as file:
+            file.write(bytes(64))
+        self.assertRaises(ValueError, SnapshotFile, path)
+
+    def test_store_generations(self):
+        """It should swap generations and tell readers through the control file"""
+        builder, reader = SharedStore(self.directory), SharedStore(self.directory)
+        self.assertEqual(reader.control(), (0, 0, 0.0))
+        builder.acquire()
+        builder.publish(ROWS, 5, 10.0)
+        self.assertEqual(reader.control(), (1, 5, 10.0))
+        first = reader.open(1)
+        self.assertEqual(first.get(3).body, b'{"promo_id":3}')
+        self.assertIs(reader.open(1), first)
+
+        builder.publish(ROWS[:1], 6, 11.0)
+        self.assertEqual(reader.control(), (2, 6, 11.0))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "promotions.1.snap")))
+        # the old generation stays readable for anyone still holding it
+        self.assertEqual(first.get(12).body, b'{"promo_id":12}')
+        self.assertIsNone(reader.open(2).get(12))
+        self.assertIsNone(reader.open(1))
+
+        builder.confirm(7, 12.5)
+        self.assertEqual(reader.control(), (2, 7, 12.5))
+        # the control file is replaced whole, never written where it is read
+        path = os.path.join(self.directory, "control")
+        inode = os.stat(path).st_ino
+        builder.confirm(8, 13.0)
+        self.assertNotEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(reader.control(), (2, 8, 13.0))
+        self.assertEqual(reader.control(), (2, 8, 13.0))